@@ -79,7 +79,7 @@ REST_FRAMEWORK = {
         'rest_framework.renderers.AdminRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer'
     ],
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
+    'DEFAULT_PAGINATION_CLASS': 'main.pagination.DateCreatedCursorPagination',
     'PAGE_SIZE': 100
 }
 
@@ -206,3 +206,30 @@ INV_CURRENCY_SYMBOL = "₹"
 INV_CURRENCY_PREFIX = "INR"
 INV_CURRENCY = "Indian Rupees"
 GST_NUMBER = "00000000"
+INV_STORE_ON_DISK = True  # keep rendered invoices in INV_CACHE_ROOT, False renders every print in memory
+INV_CACHE_ROOT = os.path.join(INV_ROOT, "cache")  # rendered invoices, keyed on their content
+INV_CACHE_MAX_SIZE = 256 * 1024 * 1024  # in bytes
+INV_CACHE_MAX_AGE = 30 * 24 * 60 * 60  # in seconds
+INV_BATCH_WORKERS = None  # processes rendering invoices in bulk, None for one per CPU
+INV_NUMBER_START = 1000  # first invoice number of a new series
+INV_NUMBER_FY_PREFIX = False  # start a new series every financial year i.e. 2018-19/1000
+INV_NUMBER_BLOCK_SIZE = 1  # numbers reserved per process at once, more than 1 may leave gaps in the series
+IMEI_LOOKUP_LIMIT = 1000  # IMEIs resolved per batched lookup request
+CUSTOMER_SEARCH_LIMIT = 100  # customers returned by one search
+SYNC_BATCH_SIZE = 500  # changed rows per collection in one delta sync response
+SYNC_TOMBSTONE_MAX_AGE = 90  # in days, clients last synced before must download everything again
+SYNC_SAFETY_LAG = 60  # in seconds, rows changed this recently are sent again by the next sync
+API_CACHE_TIMEOUT = 300  # in seconds, cached API lists are served at most this long after a change elsewhere
+API_CACHE_ROOT = os.path.join(BASE_DIR, "cache")  # API responses, shared by the worker processes of the host
+CACHES = {
+    # the API response cache is only used with a backend shared between processes, i.e. not LocMemCache
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': API_CACHE_ROOT,
+    }
+}
+REORDER_COVER_DAYS = 14  # products with stock for fewer days at the current sales velocity need reordering
+REORDER_VELOCITY_HALF_LIFE = 14  # in days, weight of a sale in the sales velocity halves every half life
+AGEING_BUCKETS = (30, 60, 90)  # in days, last day of each ageing bucket of outstanding bills, older ones in one more
+GST_EXPORT_BATCH_SIZE = 2000  # sales whose lines are read per query by the line by line GST export
+LINE_TERMS_BATCH_SIZE = 5000  # bill lines updated per statement by the backfill_line_terms command
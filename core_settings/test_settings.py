@@ -0,0 +1,18 @@
+# coding=utf-8
+"""
+Settings of the test suite, run it with::
+
+    python manage.py test --settings=core_settings.test_settings
+
+The apps keep no migrations in the repository, so the test database is
+created straight from the models.
+"""
+from core_settings.settings import *
+
+__author__ = "Gahan Saraiya"
+
+MIGRATION_MODULES = dict((app, None) for app in ("main", "inventory_management", "sale_record"))
+CACHES = {
+    # tests start with an empty cache, those of the API response cache use :data:`main.tests.SHARED_CACHES`
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
@@ -2,10 +2,11 @@
 from easy_select2.utils import select2_modelform
 from nested_inline.admin import NestedModelAdmin
 from django.contrib import admin
+from django.db.models import F, Prefetch
 # from import_export import resources
 
 from main.admin import *
-from core_settings.settings import COMPANY_TITLE
+from core_settings.settings import COMPANY_TITLE, REORDER_COVER_DAYS
 from .models import *
 from .admin_inlines import *
 
@@ -71,6 +72,65 @@ class PurchaseRecordAdmin(BasePurchaseRecordAdmin):
         ("Other Details", {'fields': ["purchased_from", "purchase_date"]}),
     )
 
+    def get_queryset(self, request):
+        items = EffectiveCost.objects.select_related('cost')
+        return super().get_queryset(request).select_related('purchased_from').prefetch_related(
+            Prefetch('items', queryset=items))
+
+
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ["id", "product", "quantity", "reason", "bill_type", "bill_id", "line_id", "date_created"]
+    list_filter = ["reason", "bill_type"]
+    list_select_related = ["product"]
+    search_fields = ["product__name"]
+    readonly_fields = ["product", "quantity", "reason", "bill_type", "bill_id", "line_id"]
+
+    def has_add_permission(self, *args, **kwargs):
+        return False
+
+    def has_delete_permission(self, *args, **kwargs):
+        return False
+
+
+class ReorderFilter(admin.SimpleListFilter):
+    title = "reorder"
+    parameter_name = "reorder"
+
+    def lookups(self, request, model_admin):
+        return [("yes", "Below {} days of cover".format(REORDER_COVER_DAYS))]
+
+    def queryset(self, request, queryset):
+        if self.value() == "yes":
+            return queryset.low_stock()
+        return queryset
+
+
+class StockCoverAdmin(admin.ModelAdmin):
+    list_display = ["product", "stock", "get_velocity", "get_days_of_cover"]
+    list_filter = [ReorderFilter]
+    list_select_related = ["product"]
+    search_fields = ["product__name"]
+    readonly_fields = ["product", "stock", "log_demand", "cover_key"]
+
+    def get_ordering(self, request):
+        return [F("cover_key").asc(nulls_last=True), "pk"]  # never sold last
+
+    def get_velocity(self, obj):
+        return "{:.2f}".format(obj.velocity)
+
+    def get_days_of_cover(self, obj):
+        days = obj.days_of_cover
+        return "-" if days is None else "{:.1f}".format(days)
+
+    get_velocity.short_description = "Sold per day"
+    get_days_of_cover.short_description = "Days of cover"
+
+    def has_add_permission(self, *args, **kwargs):
+        return False
+
+    def has_delete_permission(self, *args, **kwargs):
+        return False
+
 
 # class PurchaseResource(resources.ModelResource):
 #     class Meta:
@@ -81,6 +141,8 @@ admin.site.register(Distributor, DistributorAdmin)
 admin.site.register(EffectiveCost, EffectiveCostAdmin)
 admin.site.register(ProductRecord, ProductRecordAdmin)
 admin.site.register(PurchaseRecord, PurchaseRecordAdmin)
+admin.site.register(StockMovement, StockMovementAdmin)
+admin.site.register(StockCover, StockCoverAdmin)
 
 admin.site.site_header = COMPANY_TITLE + ' administration'
 admin.site.site_title = COMPANY_TITLE + ' administration'
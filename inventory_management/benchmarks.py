@@ -0,0 +1,173 @@
+# coding=utf-8
+import os
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import ExpressionWrapper, F, FloatField, Q, Sum
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.pagination import Cursor, PageNumberPagination
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from inventory_management.models import *
+from inventory_management.serializers import BulkPurchaseRecordSerializer, ProductRecordSerializer
+from inventory_management.views import EffectiveCostViewSet, ProductRecordViewSet, ReorderViewSet
+from main.benchmark import measure, register, report
+from main.pagination import DateCreatedCursorPagination
+
+__author__ = "Gahan Saraiya"
+
+
+@register("bulk_purchase", size=5000)
+def bulk_purchase(out, size):
+    """Import of a ``size`` line supplier invoice, per object vs. the bulk endpoint serializer"""
+    distributor = Distributor.objects.create(name="Supplier")
+    ProductRecord.objects.bulk_create([ProductRecord(name="Handset {}".format(i), price=9999, launched_by="Brand")
+                                       for i in range(50)])
+    products = list(ProductRecord.objects.values_list('pk', flat=True))
+
+    with measure() as result:
+        bill = PurchaseRecord.objects.create(invoice_id="P-1", purchased_from=distributor, payment_mode=1)
+        for i in range(size):
+            bill.items.add(EffectiveCost.objects.create(cost_id=products[i % 50], quantity=1))
+    report(out, "per object, {} lines".format(size), result['seconds'], count=size, unit="lines",
+           queries=result['queries'])
+
+    data = {"invoice_id": "P-2", "purchased_from": distributor.pk, "payment_mode": 1,
+            "items": [{"cost": products[i % 50], "quantity": 1, "discount": 0} for i in range(size)]}
+    with measure() as result:
+        serializer = BulkPurchaseRecordSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+    report(out, "bulk, {} lines".format(size), result['seconds'], count=size, unit="lines",
+           queries=result['queries'])
+
+
+@register("pagination", size=1000000)
+def pagination(out, size):
+    """First and last page of ``size`` effective costs, page numbers vs. the (date_created, id) cursor"""
+    product = ProductRecord.objects.create(name="Handset", price=9999, launched_by="Brand")
+    for offset in range(0, size, 50000):
+        EffectiveCost.objects.bulk_create(EffectiveCost.take_terms_of_products([
+            EffectiveCost(cost=product, quantity=1) for _ in range(min(50000, size - offset))]))
+    user = User.objects.create_superuser("bench", "bench@example.com", "password")
+    factory = APIRequestFactory()
+
+    def get(pagination_class, **params):
+        request = factory.get("/api/v1/effective_cost/", params)
+        force_authenticate(request, user)
+        view = EffectiveCostViewSet.as_view({'get': 'list'}, pagination_class=pagination_class,
+                                            queryset=EffectiveCost.objects.order_by('-date_created', '-id'))
+        with measure() as result:
+            for _ in range(10):
+                view(request).render()
+        return result
+
+    paginator = DateCreatedCursorPagination()
+    paginator.base_url = "/"
+    last = EffectiveCost.objects.order_by('date_created', 'id').values('date_created', 'id')[paginator.page_size]
+    deep = paginator.encode_cursor(Cursor(offset=0, reverse=False, position=paginator._get_position_from_instance(
+        last, paginator.ordering))).split("cursor=")[1]
+    for label, pagination_class, params in [
+            ("page numbers, first page", PageNumberPagination, {}),
+            ("page numbers, last page", PageNumberPagination, {"page": size // PageNumberPagination.page_size}),
+            ("cursor, first page", DateCreatedCursorPagination, {}),
+            ("cursor, last page", DateCreatedCursorPagination, {"cursor": deep})]:
+        result = get(pagination_class, **params)
+        report(out, "{}, {} rows".format(label, size), result['seconds'] / 10, queries=result['queries'] / 10)
+
+
+@register("product_serialization", size=1000)
+def product_serialization(out, size):
+    """Serialization of ``size`` products, model serializer vs. values() rows, full and sparse"""
+    ProductRecord.objects.bulk_create([
+        ProductRecord(name="Handset {}".format(i), price=9999, launched_by="Brand", specs="Specification " * 100,
+                      product_image="uploads/{}.png".format(i)) for i in range(size)])
+    factory = APIRequestFactory()
+    for label, params in [("all fields", {}), ("?fields=url,name,price", {"fields": "url,name,price"})]:
+        request = Request(factory.get("/api/v1/product/", params))
+        with measure() as result:
+            for _ in range(5):
+                ProductRecordSerializer(ProductRecord.objects.all(), many=True, context={"request": request}).data
+        report(out, "model serializer, {}".format(label), result['seconds'] / 5, count=size, unit="products",
+               queries=result['queries'] / 5)
+        with measure() as result:
+            for _ in range(5):
+                serializer = ProductRecordSerializer(context={"request": request})
+                serializer.flat_data(ProductRecord.objects.values(*serializer.flat_columns()))
+        report(out, "values() rows, {}".format(label), result['seconds'] / 5, count=size, unit="products",
+               queries=result['queries'] / 5)
+
+
+@register("catalogue_polling", size=10000)
+def catalogue_polling(out, size):
+    """Unchanged product list polled by counters against ``size`` products: full, cached and 304 responses"""
+    ProductRecord.objects.bulk_create([ProductRecord(name="Handset {}".format(i), price=9999, launched_by="Brand")
+                                       for i in range(size)])
+    user = User.objects.create_superuser("bench", "bench@example.com", "password")
+    factory = APIRequestFactory()
+    view = ProductRecordViewSet.as_view({'get': 'list'})
+
+    def poll(label, count, clear=False, **headers):
+        with measure() as result:
+            for _ in range(count):
+                if clear:
+                    cache.clear()
+                request = factory.get("/api/v1/product/", **headers)
+                force_authenticate(request, user)
+                response = view(request)
+                if hasattr(response, "render"):
+                    response.render()
+        report(out, label, result['seconds'] / count, queries=result['queries'] / count)
+        return response
+
+    location = os.path.join(tempfile.gettempdir(), "phonezilla-benchmark-cache")  # shared between processes
+    with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                                               'LOCATION': location}}):
+        etag = poll("uncached poll, {} products".format(size), 20, clear=True)['ETag']
+        poll("cached poll", 100)
+        poll("304 from cache", 100, HTTP_IF_NONE_MATCH=etag)
+        poll("304 after invalidation", 100, clear=True, HTTP_IF_NONE_MATCH=etag)
+
+
+@register("reorder", size=50000)
+def reorder(out, size):
+    """Low stock list of ``size`` products: ledger rescan vs. the incrementally kept stock cover"""
+    ProductRecord.objects.bulk_create([ProductRecord(name="Handset {}".format(i), price=9999, launched_by="Brand",
+                                                     available_stock=100 - i % 100) for i in range(size)])
+    products = list(ProductRecord.objects.values_list('pk', flat=True))
+    StockMovement.objects.bulk_create([StockMovement(product_id=pk, quantity=100, reason=StockMovement.PURCHASE)
+                                       for pk in products])
+    StockMovement.objects.bulk_create([
+        StockMovement(product_id=pk, quantity=-1, reason=StockMovement.SALE)
+        for i, pk in enumerate(products) for _ in range(i % 100 // 10)])
+
+    with measure() as result:
+        StockCover.objects.rebuild()
+    report(out, "rebuild from ledger, {} products".format(size), result['seconds'], count=size, unit="products")
+
+    since = timezone.now() - timezone.timedelta(days=30)
+    sold = Sum('movements__quantity', filter=Q(movements__reason=StockMovement.SALE,
+                                               movements__date_created__gte=since))
+    with measure() as result:
+        list(ProductRecord.objects.annotate(sold=sold * -1).filter(sold__gt=0).annotate(
+            days=ExpressionWrapper(F('available_stock') * 30.0 / F('sold'), output_field=FloatField())).filter(
+            days__lt=14).order_by('days')[:100])
+    report(out, "ledger rescan, 100 lowest", result['seconds'], queries=result['queries'])
+
+    user = User.objects.create_superuser("bench", "bench@example.com", "password")
+    view = ReorderViewSet.as_view({'get': 'list'})
+    request = APIRequestFactory().get("/api/v1/reorder/", {"days": 14})
+    force_authenticate(request, user)
+    with measure() as result:
+        for _ in range(20):
+            view(request).render()
+    report(out, "stock cover API, 100 lowest", result['seconds'] / 20, queries=result['queries'] / 20)
+
+    with measure() as result:
+        for i in range(100):
+            StockMovement.objects.post([StockMovement(product_id=products[(i * 7 + j) % size], quantity=-1,
+                                                      reason=StockMovement.SALE) for j in range(3)])
+    report(out, "post a 3 line sale", result['seconds'] / 100, queries=result['queries'] / 100)
@@ -0,0 +1,31 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from inventory_management.models import ProductRecord, StockMovement
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Rebuild available stock, sales velocity and days of cover of every product from the stock ledger"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--opening-balance', action='store_true', dest='opening_balance',
+                            help="Record current stock as ledger adjustments instead of overwriting it "
+                                 "(use once when adopting the ledger on an existing database)")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['opening_balance']:
+                ledger = dict((row['product'], row['balance']) for row in StockMovement.objects.balances())
+                movements = [
+                    StockMovement(product_id=pk, quantity=(stock or 0) - ledger.get(pk, 0),
+                                  reason=StockMovement.ADJUSTMENT)
+                    for pk, stock in ProductRecord.objects.values_list('pk', 'available_stock')
+                    if (stock or 0) != ledger.get(pk, 0)
+                ]
+                StockMovement.objects.bulk_create(movements)
+                self.stdout.write("Recorded {} opening balance adjustments".format(len(movements)))
+            updated = StockMovement.objects.rebuild_balances()
+        self.stdout.write(self.style.SUCCESS("Rebuilt stock of {} products".format(updated)))
@@ -0,0 +1,74 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from inventory_management.models import ProductRecord, PurchaseRecord, StockMovement
+from sale_record.models import SaleRecord
+
+__author__ = "Gahan Saraiya"
+
+REPAIR_BATCH_SIZE = 500  # products per ledger posting, each one a single UPDATE
+
+
+def _totals(queryset, product, quantity):
+    """ ``{product id: sum of quantity}`` of ``queryset`` in one grouped query """
+    rows = queryset.order_by().values(product).annotate(total=Sum(quantity)).values_list(product, 'total')
+    return dict((pk, total or 0) for pk, total in rows)
+
+
+def expected_stock():
+    """
+    Stock of every product according to its bills: units of purchase lines
+    less units of the lines of sales not cancelled, plus the adjustments of
+    the ledger such as opening balances
+    """
+    expected = _totals(PurchaseRecord.items.through.objects, 'effectivecost__cost', 'effectivecost__quantity')
+    for pk, units in _totals(SaleRecord.items.through.objects.filter(salerecord__cancelled=False),
+                             'saleeffectivecost__cost', 'saleeffectivecost__quantity').items():
+        expected[pk] = expected.get(pk, 0) - units
+    for pk, units in _totals(StockMovement.objects.filter(reason=StockMovement.ADJUSTMENT), 'product',
+                             'quantity').items():
+        expected[pk] = expected.get(pk, 0) + units
+    return expected
+
+
+class Command(BaseCommand):
+    help = "Compare available stock with purchases less sales not cancelled and list the differences, " \
+           "without changing anything unless --repair is given"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', dest='repair',
+                            help="Post the differences to the stock ledger as reconciliation movements")
+        parser.add_argument('--limit', type=int, default=100, dest='limit',
+                            help="Differences listed, 0 for all of them")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            products = ProductRecord.objects.order_by('pk')
+            if options['repair']:
+                products = products.select_for_update()
+            stocks = list(products.values_list('pk', 'name', 'available_stock'))
+            expected = expected_stock()
+            differences = [(pk, name, stock or 0, expected.get(pk, 0)) for pk, name, stock in stocks
+                           if (stock or 0) != expected.get(pk, 0)]
+            if options['repair']:
+                movements = [StockMovement(product_id=pk, quantity=units - stock, reason=StockMovement.RECONCILIATION)
+                             for pk, name, stock, units in differences]
+                for start in range(0, len(movements), REPAIR_BATCH_SIZE):
+                    StockMovement.objects.post(movements[start:start + REPAIR_BATCH_SIZE])
+
+        listed = differences[:options['limit']] if options['limit'] else differences
+        if listed:
+            self.stdout.write("{:>8}  {:<40} {:>10} {:>10} {:>10}".format("product", "name", "stock", "expected",
+                                                                          "difference"))
+        for pk, name, stock, units in listed:
+            self.stdout.write("{:>8}  {:<40} {:>10} {:>10} {:>+10}".format(pk, name[:40], stock, units, units - stock))
+        if len(listed) < len(differences):
+            self.stdout.write("... {} more".format(len(differences) - len(listed)))
+        if options['repair']:
+            message = "Repaired the stock of {} of {} products".format(len(differences), len(stocks))
+        else:
+            message = "{} of {} products differ, dry run: use --repair to fix them".format(len(differences),
+                                                                                          len(stocks))
+        self.stdout.write(self.style.SUCCESS(message))
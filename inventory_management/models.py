@@ -1,17 +1,30 @@
 # coding=utf-8
-from django.db import models
+import math
+from datetime import datetime
+
+from django.db import models, transaction
+from django.db.models import Case, F, IntegerField, OuterRef, Q, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
 from django.utils.translation import ugettext_lazy as _
-from django.db.models.signals import post_save, pre_save, m2m_changed
+from django.db.models.signals import post_delete, post_save, pre_save, m2m_changed
 from django.dispatch import receiver
+from django.utils import timezone
 
+from main import api_cache, pricing, sync
 from main.models import *
-from core_settings.settings import PRODUCT_TYPE, PRODUCT_MAKER
+from core_settings.settings import PRODUCT_TYPE, PRODUCT_MAKER, REORDER_COVER_DAYS, REORDER_VELOCITY_HALF_LIFE
 
 
 class Distributor(BaseDistributor):
     address2 = models.TextField(_("Postal Address 2"), blank=True, null=True,
                                 help_text=_("Alternate/branch Address of distributor"))
 
+    class Meta(BaseDistributor.Meta):
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+            models.Index(fields=["date_updated", "id"]),  # sync and conditional requests
+        ]
+
 
 class ProductRecord(BaseProductRecord):
     launched_by = models.CharField(max_length=300,
@@ -29,6 +42,41 @@ class ProductRecord(BaseProductRecord):
     product_link = models.URLField(blank=True, null=True,
                                    verbose_name=_("Product Link (if any)"))
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        product = super().from_db(db, field_names, values)
+        product._saved_stock = product.__dict__.get('available_stock')
+        return product
+
+    def save(self, *args, **kwargs):
+        """
+        Save the product without writing ``available_stock``: a change of it
+        is posted to the stock ledger as an adjustment, so stock entered by
+        hand survives ``rebuild_stock`` and stock moved meanwhile is kept
+        """
+        adding = self._state.adding
+        saved = 0 if adding else getattr(self, '_saved_stock', None)
+        change = 0 if saved is None else (self.available_stock or 0) - (saved or 0)
+        with transaction.atomic():
+            if adding:
+                self.available_stock = 0
+            else:
+                fields = kwargs.pop('update_fields', None) or [
+                    field.name for field in self._meta.concrete_fields if not field.primary_key]
+                kwargs['update_fields'] = [name for name in fields if name != 'available_stock']
+            super().save(*args, **kwargs)
+            if change:
+                StockMovement.objects.post([StockMovement(product_id=self.pk, quantity=change,
+                                                          reason=StockMovement.ADJUSTMENT)])
+            self.available_stock = self._saved_stock = type(self)._base_manager.filter(pk=self.pk).values_list(
+                'available_stock', flat=True).get()
+
+    class Meta(BaseProductRecord.Meta):
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+            models.Index(fields=["date_updated", "id"]),  # sync and conditional requests
+        ]
+
 
 class EffectiveCost(BaseEffectiveCost):
     """
@@ -37,28 +85,55 @@ class EffectiveCost(BaseEffectiveCost):
     discount = models.IntegerField(default=15)
     cost = models.ForeignKey(ProductRecord, on_delete=models.CASCADE)
 
+    objects = BaseEffectiveCostQuerySet.as_manager()
+
     @property
     def get_effective_cost(self):
-        return (self.cost.price.amount * (100 - self.discount)) / 100 if self.discount else self.cost.price.amount
+        if hasattr(self, 'unit_total'):
+            return self.unit_total
+        return self.amounts.unit_price
 
     @property
     def get_total_effective_cost(self):
-        return self.get_effective_cost * self.quantity
+        if hasattr(self, 'line_total'):
+            return self.line_total
+        return self.amounts.total
 
     @property
     def get_detail(self):
         return "{} >> [Disc. {}%] [MRP: {}] [Qty. {}] [item cost: {}] [total bill: {}]".format(
-            self.cost.name,  self.discount, self.cost.price, self.quantity,
+            self.cost.name,  self.discount, self.product_amount, self.quantity,
             self.get_effective_cost, self.get_total_effective_cost)
 
-    def clean(self):
-        self.cost.available_stock = self.cost.available_stock + self.quantity
-
     def __str__(self):
-        return "{} >> [Disc. {}%] [MRP: {}] [Qty. {}]".format(self.cost.name, self.discount, self.cost.price, self.quantity)
+        return "{} >> [Disc. {}%] [MRP: {}] [Qty. {}]".format(self.cost.name, self.discount, self.product_amount, self.quantity)
 
     class Meta:
         verbose_name = verbose_name_plural = "Effective cost of " + PRODUCT_TYPE
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+        ]
+
+
+class PurchaseRecordQuerySet(BaseBillQuerySet):
+    def create_bills(self, bills):
+        """ Bulk create purchases and add their lines to stock with one ledger posting """
+        with transaction.atomic(using=self.db):
+            bills = super().create_bills(bills)
+            StockMovement.objects.post([
+                StockMovement(product_id=line.cost_id, quantity=line.quantity or 0, reason=StockMovement.PURCHASE,
+                              bill_type=StockMovement.PURCHASE_BILL, bill_id=bill.pk, line_id=line.pk)
+                for bill, lines in bills for line in lines])
+            api_cache.invalidate(PurchaseRecord)
+        return bills
+
+    def outstanding(self):
+        """ Purchases unpaid: with the payment in transit or on credit """
+        return self.filter(Q(payment_status=True) | Q(payment_mode=BasePurchaseRecord.CREDIT))
+
+    def payables(self, as_of):
+        """ Outstanding amount per distributor in ageing buckets of the purchase date """
+        return self.outstanding().ageing(['purchased_from', 'purchased_from__name'], 'purchase_date', as_of)
 
 
 class PurchaseRecord(BasePurchaseRecord):
@@ -68,9 +143,19 @@ class PurchaseRecord(BasePurchaseRecord):
         verbose_name=_("Supplier Name"),
         help_text=_("Choose Company from where purchase is made"))
 
+    objects = PurchaseRecordQuerySet.as_manager()
+
+    @property
+    def amounts(self):
+        """ :class:`main.pricing.BillAmounts` in rupees from the terms kept on the lines, priced in one pass """
+        lines = self.items.all()
+        return pricing.in_rupees(pricing.bill_amounts(pricing.price_lines([line.pricing_terms for line in lines])))
+
     @property
     def get_total(self):
-        return sum([product.get_total_effective_cost for product in self.items.all()])
+        if hasattr(self, 'bill_total'):
+            return self.bill_total
+        return self.amounts.total
 
     @property
     def get_items(self):
@@ -85,10 +170,301 @@ class PurchaseRecord(BasePurchaseRecord):
     get_bill_items.short_description = "Items"
     get_bill_amount.short_description = "Bill Amount"
 
+    class Meta(BasePurchaseRecord.Meta):
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+        ]
+
+
+class StockMovementQuerySet(models.QuerySet):
+    def post(self, movements):
+        """
+        Append ``movements`` to the ledger and apply their net effect to
+        ``ProductRecord.available_stock`` with a single UPDATE statement
+        """
+        deltas = {}
+        for movement in movements:
+            deltas[movement.product_id] = deltas.get(movement.product_id, 0) + movement.quantity
+        deltas = {product_id: delta for product_id, delta in deltas.items() if delta}
+        with transaction.atomic():
+            self.bulk_create(movements)
+            if deltas:
+                delta = Case(*[When(pk=product_id, then=Value(quantity)) for product_id, quantity in deltas.items()],
+                             default=Value(0), output_field=IntegerField())
+                ProductRecord.objects.filter(pk__in=list(deltas)).update(
+                    available_stock=Coalesce(F('available_stock'), 0) + delta,
+                    date_updated=timezone.now())
+                api_cache.invalidate(ProductRecord)
+            StockCover.objects.apply(movements)
+        return movements
+
+    def post_lines(self, reason, bill_type, pairs, line_model, sign=1):
+        """
+        Record one movement per ``(bill_id, line_id)`` pair, reading the
+        product and quantity of every line in one query
+        """
+        pairs = list(pairs)
+        lines = dict((pk, (cost_id, quantity)) for pk, cost_id, quantity in line_model.objects.filter(
+            pk__in=set(line_id for bill_id, line_id in pairs)).values_list('pk', 'cost_id', 'quantity'))
+        return self.post([
+            self.model(product_id=lines[line_id][0], quantity=sign * (lines[line_id][1] or 0),
+                       reason=reason, bill_type=bill_type, bill_id=bill_id, line_id=line_id)
+            for bill_id, line_id in pairs if line_id in lines])
+
+    def settle(self, bill_type, bill_ids, targets, reasons, lines=None):
+        """
+        Post the movements which bring the ledger of the bills ``bill_ids``,
+        or of their ``lines`` only, to ``targets``: the stock change
+        ``{(bill_id, line_id, product_id): quantity}`` their lines make now.
+        Nothing is posted where the ledger already matches, so settling again
+        is harmless. Lines without movements, billed before the ledger was
+        kept, are left alone. ``reasons`` are those of movements adding and
+        taking away stock.
+        """
+        bill_ids = list(bill_ids)
+        if not bill_ids:
+            return []
+        with transaction.atomic():
+            ledger = self.filter(bill_type=bill_type, bill_id__in=bill_ids)
+            if lines is not None:
+                ledger = ledger.filter(line_id__in=list(lines))
+            current = dict(((bill_id, line_id, product_id), quantity) for bill_id, line_id, product_id, quantity in
+                           ledger.order_by().values_list('bill_id', 'line_id', 'product').annotate(Sum('quantity')))
+            kept = {(bill_id, line_id) for bill_id, line_id, product_id in current}
+            changes = dict((key, -quantity) for key, quantity in current.items())
+            for key, quantity in targets.items():
+                if key[:2] in kept:
+                    changes[key] = changes.get(key, 0) + quantity
+            movements = [
+                self.model(product_id=product_id, quantity=quantity, reason=reasons[0] if quantity > 0 else reasons[1],
+                           bill_type=bill_type, bill_id=bill_id, line_id=line_id)
+                for (bill_id, line_id, product_id), quantity in changes.items() if quantity]
+            return self.post(movements) if movements else movements
+
+    def balances(self):
+        return self.order_by().values('product').annotate(balance=Sum('quantity'))
+
+    def rebuild_balances(self, products=None):
+        """
+        Recompute ``available_stock`` of ``products`` (all by default) as the
+        sum of their ledger movements
+        """
+        balance = self.filter(product=OuterRef('pk')).balances().values('balance')
+        records = ProductRecord.objects.all() if products is None else ProductRecord.objects.filter(pk__in=products)
+        updated = records.update(available_stock=Coalesce(Subquery(balance, output_field=IntegerField()), 0),
+                                 date_updated=timezone.now())
+        api_cache.invalidate(ProductRecord)
+        StockCover.objects.rebuild(products)
+        return updated
+
+
+class StockMovement(models.Model):
+    """
+    Append-only stock ledger, ``ProductRecord.available_stock`` is the
+    materialized sum of these rows
+    """
+    PURCHASE = 1
+    SALE = 2
+    CANCELLATION = 3
+    RETURN = 4
+    ADJUSTMENT = 5
+    RECONCILIATION = 6
+    REASONS = (
+        (PURCHASE, _("Purchase")),
+        (SALE, _("Sale")),
+        (CANCELLATION, _("Cancellation")),
+        (RETURN, _("Return")),
+        (ADJUSTMENT, _("Adjustment")),
+        (RECONCILIATION, _("Reconciliation")),
+    )
+    PURCHASE_BILL = 1
+    SALE_BILL = 2
+    BILL_TYPES = (
+        (PURCHASE_BILL, _("Purchase")),
+        (SALE_BILL, _("Sale")),
+    )
+    product = models.ForeignKey(ProductRecord, on_delete=models.CASCADE, related_name="movements")
+    quantity = models.IntegerField(help_text=_("Signed change in available stock"))
+    reason = models.IntegerField(choices=REASONS)
+    bill_type = models.IntegerField(choices=BILL_TYPES, blank=True, null=True)
+    bill_id = models.IntegerField(blank=True, null=True)
+    line_id = models.IntegerField(blank=True, null=True)
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    objects = StockMovementQuerySet.as_manager()
+
+    def __str__(self):
+        return "{} {:+d} ({})".format(self.product_id, self.quantity, self.get_reason_display())
+
+    class Meta:
+        verbose_name = "Stock movement"
+        verbose_name_plural = "Stock ledger"
+        indexes = [
+            models.Index(fields=["bill_type", "bill_id"]),
+        ]
+
+
+VELOCITY_EPOCH = datetime(2018, 1, 1, tzinfo=timezone.utc)
+DECAY = math.log(2) / REORDER_VELOCITY_HALF_LIFE  # per day
+OUT_OF_STOCK = -1e9  # cover key of products without stock, sorted first
+DEMAND = (StockMovement.SALE, StockMovement.CANCELLATION, StockMovement.RETURN)
+
+
+def epoch_days(when):
+    return (when - VELOCITY_EPOCH).total_seconds() / 86400
+
+
+def add_demand(log_demand, quantity, when):
+    """
+    ``log_demand`` after selling ``quantity`` units at ``when``, negative for
+    cancellations and returns. The demand is the exponentially decayed sum
+    of units sold, scaled to ``VELOCITY_EPOCH`` and kept as a logarithm so
+    it neither overflows nor has to be decayed while nothing is sold.
+    """
+    if not quantity:
+        return log_demand
+    scaled = math.log(abs(quantity)) + DECAY * epoch_days(when)
+    if quantity > 0:
+        if log_demand is None:
+            return scaled
+        high, low = max(log_demand, scaled), min(log_demand, scaled)
+        return high + math.log1p(math.exp(low - high))
+    if log_demand is None or scaled >= log_demand:
+        return None
+    return log_demand + math.log1p(-math.exp(scaled - log_demand))
+
+
+class StockCoverQuerySet(models.QuerySet):
+    def apply(self, movements):
+        """ Update the stock and sales velocity of the products of new ledger ``movements`` """
+        now = timezone.now()
+        demand = {}
+        for movement in movements:
+            demand.setdefault(movement.product_id, 0)
+            if movement.reason in DEMAND:
+                demand[movement.product_id] -= movement.quantity
+        stocks = dict(ProductRecord.objects.filter(pk__in=list(demand)).values_list('pk', 'available_stock'))
+        covers = dict((cover.pk, cover) for cover in self.select_for_update().filter(pk__in=list(stocks)))
+        created = []
+        for pk, stock in stocks.items():
+            cover = covers.get(pk)
+            if cover is None:
+                cover = StockCover(product_id=pk)
+                created.append(cover)
+            cover.stock = stock or 0
+            cover.log_demand = add_demand(cover.log_demand, demand[pk], now)
+            cover.update_key()
+            if pk in covers:
+                cover.save(update_fields=['stock', 'log_demand', 'cover_key', 'date_updated'])
+        self.bulk_create(created)
+
+    def rebuild(self, products=None):
+        """ Recompute the covers of ``products`` (all by default) from the stock ledger """
+        records = ProductRecord.objects.all() if products is None else ProductRecord.objects.filter(pk__in=products)
+        covers = dict((pk, StockCover(product_id=pk, stock=stock or 0))
+                      for pk, stock in records.values_list('pk', 'available_stock'))
+        movements = StockMovement.objects.filter(reason__in=DEMAND).order_by('date_created')
+        if products is not None:
+            movements = movements.filter(product__in=products)
+        for pk, quantity, created in movements.values_list('product', 'quantity', 'date_created').iterator():
+            if pk in covers:
+                covers[pk].log_demand = add_demand(covers[pk].log_demand, -quantity, created)
+        for cover in covers.values():
+            cover.update_key()
+        with transaction.atomic():
+            self.filter(pk__in=list(covers)).delete()
+            self.bulk_create(covers.values())
+        return len(covers)
+
+    def cutoff(self, days=REORDER_COVER_DAYS):
+        """ Cover key of ``days`` of cover at the current velocity """
+        return math.log(days * DECAY) - DECAY * epoch_days(timezone.now())
+
+    def low_stock(self, days=REORDER_COVER_DAYS):
+        """ Products out of stock or with less than ``days`` of cover, fewest days first """
+        return self.filter(cover_key__lt=self.cutoff(days)).order_by('cover_key', 'pk')
+
+
+class StockCover(models.Model):
+    """
+    Stock and sales velocity of a product, kept up to date with every
+    ``StockMovement.objects.post``. ``cover_key`` sorts products by days of
+    cover and does not change while no stock moves.
+    """
+    product = models.OneToOneField(ProductRecord, primary_key=True, on_delete=models.CASCADE,
+                                   related_name="cover")
+    stock = models.IntegerField(default=0)
+    log_demand = models.FloatField(blank=True, null=True,
+                                   help_text=_("Logarithm of the decayed units sold, empty if never sold"))
+    cover_key = models.FloatField(blank=True, null=True, db_index=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    objects = StockCoverQuerySet.as_manager()
+
+    def update_key(self):
+        if self.stock <= 0:
+            self.cover_key = OUT_OF_STOCK
+        elif self.log_demand is None:
+            self.cover_key = None
+        else:
+            self.cover_key = math.log(self.stock) - self.log_demand
+
+    @property
+    def velocity(self):
+        """ Units sold per day """
+        if self.log_demand is None:
+            return 0.0
+        return DECAY * math.exp(self.log_demand - DECAY * epoch_days(timezone.now()))
+
+    @property
+    def days_of_cover(self):
+        if self.stock <= 0:
+            return 0.0
+        if self.cover_key is None:
+            return None
+        return math.exp(self.cover_key + DECAY * epoch_days(timezone.now())) / DECAY
+
+    def __str__(self):
+        return str(self.product)
+
+    class Meta:
+        verbose_name = "Stock cover"
+        verbose_name_plural = "Reorder report"
+
+
+def bill_line_pairs(instance, reverse, pk_set):
+    """``(bill_id, line_id)`` pairs touched by an ``items`` m2m_changed signal"""
+    if reverse:
+        return [(bill_id, instance.pk) for bill_id in pk_set]
+    return [(instance.pk, line_id) for line_id in pk_set]
+
 
 @receiver(m2m_changed, sender=PurchaseRecord.items.through, dispatch_uid="update_stock_count")
-def update_stock(sender, instance, action, **kwargs):
-    if action is "post_add":
-        for item in instance.items.all():
-            item.cost.available_stock += item.quantity
-            item.cost.save()
+def update_stock(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "post_add" and pk_set:
+        StockMovement.objects.post_lines(StockMovement.PURCHASE, StockMovement.PURCHASE_BILL,
+                                         bill_line_pairs(instance, reverse, pk_set), EffectiveCost)
+
+
+@receiver(post_save, sender=ProductRecord, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=ProductRecord, dispatch_uid="invalidate_api_cache")
+@receiver(post_save, sender=Distributor, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=Distributor, dispatch_uid="invalidate_api_cache")
+@receiver(post_save, sender=PurchaseRecord, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=PurchaseRecord, dispatch_uid="invalidate_api_cache")
+@receiver(post_save, sender=EffectiveCost, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=EffectiveCost, dispatch_uid="invalidate_api_cache")
+def invalidate_api_cache(sender, **kwargs):
+    api_cache.invalidate(sender)
+
+
+@receiver(m2m_changed, sender=PurchaseRecord.items.through, dispatch_uid="invalidate_api_cache")
+def invalidate_purchase_api_cache(sender, action, **kwargs):
+    if action.startswith("post_"):
+        api_cache.invalidate(PurchaseRecord)
+
+
+sync.register("distributors", Distributor)
+sync.register("products", ProductRecord)
+sync.register("purchase_items", EffectiveCost)
+sync.register("purchases", PurchaseRecord, many=["items"])
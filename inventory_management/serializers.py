@@ -15,19 +15,47 @@ class PurchaseRecordSerializer(serializers.HyperlinkedModelSerializer):
         # fields = "__all__"
 
 
-class ProductRecordSerializer(serializers.HyperlinkedModelSerializer):
+class ProductRecordSerializer(SparseFieldsMixin, FlatSerializerMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = ProductRecord
         fields = "__all__"
 
 
-class EffectiveCostSerializer(serializers.HyperlinkedModelSerializer):
+class EffectiveCostSerializer(SparseFieldsMixin, FlatSerializerMixin, serializers.HyperlinkedModelSerializer):
     class Meta:
         model = EffectiveCost
         fields = "__all__"
 
 
+class StockCoverSerializer(serializers.ModelSerializer):
+    product = serializers.HyperlinkedRelatedField(view_name="productrecord-detail", read_only=True)
+    product_id = serializers.IntegerField(read_only=True)
+    name = serializers.CharField(source="product.name", read_only=True)
+    velocity = serializers.FloatField(read_only=True)
+    days_of_cover = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = StockCover
+        fields = ["product", "product_id", "name", "stock", "velocity", "days_of_cover"]
+
+
 class DistributorSerializer(BaseDistributorSerializer):
     class Meta:
         model = Distributor
         fields = BaseDistributorSerializer.Meta.fields + ['address2']
+
+
+class BulkEffectiveCostSerializer(BulkLineSerializer):
+    class Meta(BulkLineSerializer.Meta):
+        model = EffectiveCost
+
+
+class BulkPurchaseRecordSerializer(BulkBillSerializer):
+    line_model = EffectiveCost
+    product_model = ProductRecord
+    items = BulkEffectiveCostSerializer(many=True)
+
+    class Meta(BulkBillSerializer.Meta):
+        model = PurchaseRecord
+        fields = ["invoice_id", "purchase_date", "delivery_date", "purchased_from", "payment_mode",
+                  "payment_status", "items"]
@@ -1,14 +1,21 @@
 # coding=utf-8
 __author__ = "Gahan Saraiya"
+import json
 import os
 import time
 
 import sys
+from io import StringIO
+from unittest import mock
 from django.conf import settings
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
-from django.test import TestCase, LiveServerTestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, LiveServerTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse_lazy
 from django.utils import timezone
 from selenium.webdriver.chrome.webdriver import WebDriver
@@ -16,7 +23,12 @@ from selenium import webdriver
 from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support.select import Select
 
+from core_settings.settings import REORDER_VELOCITY_HALF_LIFE
+from inventory_management.models import *
+from inventory_management.serializers import EffectiveCostSerializer, ProductRecordSerializer
 from inventory_management.utils import pickler
+from main.tests import SHARED_CACHES
+from sale_record.models import SaleEffectiveCost, SaleRecord
 
 
 def _sleep(seconds=2, flag=True):
@@ -25,7 +37,98 @@ def _sleep(seconds=2, flag=True):
 
 
 class PurchaseTest(TestCase):
-    pass
+    def setUp(self):
+        self.distributor = Distributor.objects.create(name="Supplier")
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+
+    def purchase(self, *quantities):
+        record = PurchaseRecord.objects.create(invoice_id="P-1", purchased_from=self.distributor, payment_mode=1)
+        record.items.add(*[EffectiveCost.objects.create(cost=self.product, quantity=q) for q in quantities])
+        return record
+
+    def test_purchase_updates_stock_through_ledger(self):
+        record = self.purchase(3, 2)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_stock, 5)
+        self.assertEqual(StockMovement.objects.filter(bill_type=StockMovement.PURCHASE_BILL,
+                                                      bill_id=record.pk).count(), 2)
+
+    def test_adding_lines_later_counts_only_new_lines(self):
+        record = self.purchase(3)
+        record.items.add(EffectiveCost.objects.create(cost=self.product, quantity=4))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_stock, 7)
+
+    def test_stock_update_query_count_is_constant(self):
+        record = PurchaseRecord.objects.create(invoice_id="P-2", purchased_from=self.distributor, payment_mode=1)
+        small = [EffectiveCost.objects.create(cost=self.product, quantity=1) for _ in range(2)]
+        large = [EffectiveCost.objects.create(cost=self.product, quantity=1) for _ in range(20)]
+        with CaptureQueriesContext(connection) as small_queries:
+            record.items.add(*small)
+        with CaptureQueriesContext(connection) as large_queries:
+            record.items.add(*large)
+        self.assertEqual(len(small_queries), len(large_queries))
+
+    def test_annotated_bill_total(self):
+        record = self.purchase(3, 2)
+        record.items.add(EffectiveCost.objects.create(cost=self.product, quantity=1, discount=0))
+        with self.assertNumQueries(1):
+            total = PurchaseRecord.objects.with_totals().get(pk=record.pk).get_total
+        self.assertEqual(total, PurchaseRecord.objects.get(pk=record.pk).get_total)
+
+    def test_rebuild_balances_from_ledger(self):
+        self.purchase(6)
+        ProductRecord.objects.filter(pk=self.product.pk).update(available_stock=0)
+        StockMovement.objects.rebuild_balances()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_stock, 6)
+
+    def test_rebuild_stock_opening_balance_keeps_current_stock(self):
+        ProductRecord.objects.filter(pk=self.product.pk).update(available_stock=4)
+        call_command('rebuild_stock', opening_balance=True, stdout=StringIO())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_stock, 4)
+        self.assertEqual(StockMovement.objects.get().reason, StockMovement.ADJUSTMENT)
+
+    def test_stock_edits_are_ledger_adjustments(self):
+        product = ProductRecord.objects.create(name="Charger", price=100, launched_by="Brand", available_stock=10)
+        self.purchase(3)
+        product = ProductRecord.objects.get(pk=product.pk)
+        product.available_stock = 8
+        product.save()
+        stale = ProductRecord.objects.get(pk=self.product.pk)
+        self.purchase(2)
+        stale.name = "Handset X"
+        stale.save()
+        self.assertEqual(list(StockMovement.objects.filter(product=product).values_list('quantity', flat=True)
+                              .order_by('pk')), [10, -2])
+        StockMovement.objects.rebuild_balances()
+        self.assertEqual(dict(ProductRecord.objects.values_list('name', 'available_stock')),
+                         {"Charger": 8, "Handset X": 5})
+
+
+class PurchaseAdminTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+
+    def add_purchases(self, count):
+        for _ in range(count):
+            record = PurchaseRecord.objects.create(invoice_id="P", payment_mode=1,
+                                                   purchased_from=Distributor.objects.create(name="Supplier"))
+            record.items.add(*[EffectiveCost.objects.create(cost=self.product) for _ in range(3)])
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse_lazy('admin:inventory_management_purchaserecord_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_query_count_does_not_grow_with_rows(self):
+        self.add_purchases(2)
+        few = self.changelist_queries()
+        self.add_purchases(20)
+        self.assertEqual(self.changelist_queries(), few)
 
 
 class LoginTestSelenium(StaticLiveServerTestCase):
@@ -58,3 +161,243 @@ class LoginTestSelenium(StaticLiveServerTestCase):
         password_input.send_keys(self.credentials['password'])
         self.selenium.find_element_by_id('login').click()
         time.sleep(5)
+
+
+class BulkPurchaseTest(TestCase):
+    def test_supplier_invoice_posts_stock_once(self):
+        distributor = Distributor.objects.create(name="Supplier")
+        product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+        bill = PurchaseRecord(invoice_id="P-1", purchased_from=distributor, payment_mode=1)
+        lines = [EffectiveCost(cost=product, quantity=2) for _ in range(1200)]
+        with CaptureQueriesContext(connection) as queries:
+            PurchaseRecord.objects.create_bills([(bill, lines)])
+        self.assertLess(len(queries), 50)
+        self.assertEqual(bill.items.count(), 1200)
+        self.assertEqual(sorted(bill.items.values_list('pk', flat=True)), sorted(line.pk for line in lines))
+        product.refresh_from_db()
+        self.assertEqual(product.available_stock, 2400)
+
+
+class CursorPaginationTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        ProductRecord.objects.bulk_create([ProductRecord(name="Handset {}".format(i), price=1000, launched_by="Brand")
+                                           for i in range(25)])
+        # products created in the same instant are ordered by id
+        ProductRecord.objects.filter(pk__gt=ProductRecord.objects.order_by('pk')[10].pk).update(
+            date_created=timezone.now() - timezone.timedelta(days=1))
+
+    def test_pages_follow_cursor_without_count(self):
+        url, seen, pages = "{}?page_size=4".format(reverse_lazy('productrecord-list')), [], []
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                page = self.client.get(url).json()
+            self.assertFalse([q for q in queries if "COUNT(*)" in q['sql'] or "OFFSET" in q['sql']])
+            self.assertNotIn("count", page)
+            seen += [product['name'] for product in page['results']]
+            pages.append(page)
+            url = page['next']
+        expected = list(ProductRecord.objects.order_by('-date_created', '-id').values_list('name', flat=True))
+        self.assertEqual(seen, expected)
+        previous = self.client.get(pages[-1]['previous']).json()
+        self.assertEqual(previous['results'], pages[-2]['results'])
+
+
+class ProductApiTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.products = [ProductRecord.objects.create(name="Handset {}".format(i), price=1000 + i, launched_by="Brand",
+                                                      specs="Long specs " * 50, product_image="uploads/{}.png".format(i))
+                         for i in range(3)]
+        EffectiveCost.objects.create(cost=self.products[0], quantity=2)
+
+    def test_flat_list_matches_serializer(self):
+        for name, serializer_class, queryset in [
+                ("productrecord", ProductRecordSerializer, ProductRecord.objects.all()),
+                ("effectivecost", EffectiveCostSerializer, EffectiveCost.objects.all())]:
+            response = self.client.get(reverse_lazy(name + '-list'))
+            request = response.wsgi_request
+            request.query_params = request.GET
+            expected = serializer_class(queryset.order_by('-date_created', '-id'), many=True,
+                                        context={"request": request}).data
+            self.assertEqual(response.json()['results'], json.loads(json.dumps(expected)))
+            self.assertIsNotNone(serializer_class(context={"request": request}).flat_columns())
+
+    def test_sparse_fieldsets(self):
+        url = reverse_lazy('productrecord-list')
+        with CaptureQueriesContext(connection) as queries:
+            results = self.client.get(url, {"fields": "url,name,price"}).json()['results']
+        self.assertEqual([list(result) for result in results], [["url", "name", "price"]] * 3)
+        self.assertNotIn("specs", queries[-1]['sql'])
+        results = self.client.get(url, {"exclude": "specs,product_image"}).json()['results']
+        self.assertNotIn("specs", results[0])
+        self.assertIn("launched_by", results[0])
+        detail = self.client.get(results[0]['url'], {"fields": "name"}).json()
+        self.assertEqual(detail, {"name": "Handset 2"})
+        self.assertEqual(self.client.get(url, {"fields": "name,bogus"}).status_code, 400)
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class ConditionalListTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.products = [ProductRecord.objects.create(name="Handset {}".format(i), price=1000, launched_by="Brand")
+                         for i in range(3)]
+        self.url = reverse_lazy('productrecord-list')
+
+    def get(self, **headers):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, **headers)
+        return response, [query['sql'] for query in queries if "productrecord" in query['sql']]
+
+    def test_not_modified_and_cached(self):
+        response, queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        response, queries = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, [])  # served from the response cache
+        response, queries = self.get()
+        self.assertEqual((response.status_code, queries), (200, []))
+
+        cache.clear()
+        response, queries = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(queries), 1)  # only the validators, nothing serialized
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+    def test_process_local_cache_is_not_used(self):
+        self.get()
+        response, queries = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(queries, [])
+
+    def test_changes_invalidate(self):
+        etag = self.get()[0]['ETag']
+        product = self.products[0]
+        product.name = "Renamed"
+        product.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("Renamed", [row['name'] for row in response.json()['results']])
+
+        etag = response['ETag']
+        self.products[1].delete()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)[0]
+        self.assertEqual(len(response.json()['results']), 2)
+
+        etag = response['ETag']
+        bill = PurchaseRecord.objects.create(invoice_id="P-1", purchased_from=Distributor.objects.create(name="S"),
+                                             payment_mode=1)
+        bill.items.add(EffectiveCost.objects.create(cost=self.products[2], quantity=4))
+        response = self.get(HTTP_IF_NONE_MATCH=etag)[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['results'][0]['available_stock'], 4)
+
+
+class ReorderTest(TestCase):
+    def setUp(self):
+        self.products = [ProductRecord.objects.create(name=name, price=1000, launched_by="Brand")
+                         for name in ("Fast", "Slow", "Unsold", "Sold out")]
+        self.move(StockMovement.PURCHASE, [100, 100, 100, 10])
+        self.move(StockMovement.SALE, [-50, -5, 0, -10])
+
+    def move(self, reason, quantities):
+        StockMovement.objects.post([StockMovement(product=product, quantity=quantity, reason=reason)
+                                    for product, quantity in zip(self.products, quantities) if quantity])
+
+    def names(self, days):
+        return [cover.product.name for cover in StockCover.objects.low_stock(days).select_related('product')]
+
+    def test_low_stock_sorted_by_days_of_cover(self):
+        self.assertEqual(self.names(10 ** 6), ["Sold out", "Fast", "Slow"])
+        fast, slow = StockCover.objects.get(pk=self.products[0].pk), StockCover.objects.get(pk=self.products[1].pk)
+        self.assertAlmostEqual(fast.velocity, 10 * slow.velocity)
+        self.assertAlmostEqual(fast.days_of_cover, 50 / fast.velocity)
+        self.assertEqual(StockCover.objects.get(pk=self.products[2].pk).days_of_cover, None)
+        self.assertEqual(self.names(fast.days_of_cover * 1.01), ["Sold out", "Fast"])
+
+        days, later = fast.days_of_cover, timezone.now() + timezone.timedelta(days=REORDER_VELOCITY_HALF_LIFE)
+        with mock.patch('django.utils.timezone.now', return_value=later):  # no sales for a half life
+            self.assertAlmostEqual(fast.days_of_cover, 2 * days, places=3)
+            self.assertEqual(self.names(days * 1.01), ["Sold out"])
+
+        self.move(StockMovement.CANCELLATION, [45, 0, 0, 0])
+        self.assertEqual(self.names(10 ** 6), ["Sold out", "Slow", "Fast"])
+
+    def test_rebuild_matches_incremental(self):
+        self.move(StockMovement.SALE, [-1, -2, -3, 0])
+        expected = dict(StockCover.objects.values_list('pk', 'cover_key'))
+        StockCover.objects.all().delete()
+        StockMovement.objects.rebuild_balances()
+        for pk, key in StockCover.objects.values_list('pk', 'cover_key'):
+            self.assertAlmostEqual(key, expected[pk], places=3)
+
+    def test_api_and_admin(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        rows = self.client.get(reverse_lazy('reorder-list'), {"days": 10 ** 6}).json()
+        self.assertEqual([row['name'] for row in rows], ["Sold out", "Fast", "Slow"])
+        self.assertEqual(rows[0]['days_of_cover'], 0)
+        url = reverse_lazy('admin:inventory_management_stockcover_changelist')
+        self.assertContains(self.client.get(url, {"reorder": "yes"}), "Sold out")
+
+
+class PayablesTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+        self.distributor = Distributor.objects.create(name="Supplier")
+        today = timezone.now().date()
+        for days, mode, in_transit in ((5, PurchaseRecord.CREDIT, False), (75, 1, True), (20, 1, False)):
+            record = PurchaseRecord.objects.create(purchased_from=self.distributor, payment_mode=mode,
+                                                   payment_status=in_transit,
+                                                   purchase_date=today - timezone.timedelta(days=days))
+            record.items.add(EffectiveCost.objects.create(cost=self.product, quantity=2, discount=0))
+
+    def test_payables_by_distributor(self):
+        rows = self.client.get(reverse_lazy('payables-list')).json()
+        self.assertEqual([(row['name'], row['bills'], row['days_0_30'], row['days_61_90'], row['total'])
+                          for row in rows], [("Supplier", 2, 2000, 2000, 4000)])
+
+
+class ReconcileStockTest(TestCase):
+    def setUp(self):
+        self.handset, self.charger = [ProductRecord.objects.create(name=name, price=1000, launched_by="Brand")
+                                      for name in ("Handset", "Charger")]
+        PurchaseRecord.objects.create(purchased_from=Distributor.objects.create(name="Supplier"),
+                                      payment_mode=1).items.add(EffectiveCost.objects.create(cost=self.handset,
+                                                                                             quantity=5))
+        for cancelled in (False, True):
+            sale = SaleRecord.objects.create(payment_mode=1)
+            sale.items.add(SaleEffectiveCost.objects.create(cost=self.handset, quantity=2))
+            sale.cancelled = cancelled
+            sale.save()
+        StockMovement.objects.post([StockMovement(product=self.charger, quantity=4,
+                                                  reason=StockMovement.ADJUSTMENT)])  # opening balance
+        ProductRecord.objects.filter(pk=self.handset.pk).update(available_stock=7)
+
+    def reconcile(self, *args):
+        out = StringIO()
+        call_command("reconcile_stock", *args, stdout=out)
+        return out.getvalue().splitlines()
+
+    def test_dry_run_lists_differences(self):
+        lines = self.reconcile()
+        self.assertEqual(lines[1].split(), [str(self.handset.pk), "Handset", "7", "3", "-4"])
+        self.assertEqual(lines[-1], "1 of 2 products differ, dry run: use --repair to fix them")
+        self.assertEqual(ProductRecord.objects.get(pk=self.handset.pk).available_stock, 7)
+
+    def test_repair(self):
+        self.assertEqual(self.reconcile("--repair")[-1], "Repaired the stock of 1 of 2 products")
+        self.assertEqual(dict(ProductRecord.objects.values_list('name', 'available_stock')),
+                         {"Handset": 3, "Charger": 4})
+        self.assertEqual(StockMovement.objects.get(reason=StockMovement.RECONCILIATION).quantity, -4)
+        self.assertEqual(self.reconcile()[-1], "0 of 2 products differ, dry run: use --repair to fix them")
+
+    def test_stock_entered_by_hand_is_not_drift(self):
+        ProductRecord.objects.create(name="Cover", price=100, launched_by="Brand", available_stock=10)
+        self.assertEqual(self.reconcile("--repair")[-1], "Repaired the stock of 1 of 3 products")
+        self.assertEqual(ProductRecord.objects.get(name="Cover").available_stock, 10)
@@ -8,6 +8,9 @@ from rest_framework.documentation import include_docs_urls
 from rest_framework.authtoken import views as auth_token_views
 
 from inventory_management.views import *
+from main.views import SyncViewSet
+from sale_record.views import CustomerDetailViewSet, CustomerSearchViewSet, GstReturnViewSet, ImeiLookupViewSet, \
+    SaleEffectiveCostViewSet, ReceivablesViewSet, SaleRecordViewSet, SalesReportViewSet
 from core_settings import settings
 
 # register api with default router
@@ -15,7 +18,18 @@ router = routers.DefaultRouter()
 router.register(r'effective_cost', EffectiveCostViewSet, base_name="effectivecost")
 router.register(r'purchase', PurchaseRecordViewSet, base_name="purchaserecord")
 router.register(r'distributor', DistributorViewSet, base_name="distributor")
-# router.register(r'sales')
+router.register(r'product', ProductRecordViewSet, base_name="productrecord")
+router.register(r'reorder', ReorderViewSet, base_name="reorder")
+router.register(r'sales', SaleRecordViewSet, base_name="salerecord")
+router.register(r'sale_effective_cost', SaleEffectiveCostViewSet, base_name="saleeffectivecost")
+router.register(r'customer', CustomerDetailViewSet, base_name="customerdetail")
+router.register(r'imei', ImeiLookupViewSet, base_name="imei")
+router.register(r'customer_search', CustomerSearchViewSet, base_name="customer_search")
+router.register(r'sales_report', SalesReportViewSet, base_name="sales_report")
+router.register(r'gst_return', GstReturnViewSet, base_name="gst_return")
+router.register(r'receivables', ReceivablesViewSet, base_name="receivables")
+router.register(r'payables', PayablesViewSet, base_name="payables")
+router.register(r'sync', SyncViewSet, base_name="sync")
 
 urlpatterns = [
     # Home
@@ -4,32 +4,69 @@ from django.urls import reverse_lazy
 from django.views.generic import TemplateView
 
 from rest_framework import viewsets
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
 
+from core_settings.settings import REORDER_COVER_DAYS
 from inventory_management.serializers import *
+from main.views import AgeingReportMixin, BulkCreateMixin, CachedListMixin, FlatListMixin
 
 __author__ = "Gahan Saraiya"
 
 
-class ProductRecordViewSet(viewsets.ModelViewSet):
+class ProductRecordViewSet(CachedListMixin, FlatListMixin, viewsets.ModelViewSet):
     serializer_class = ProductRecordSerializer
     queryset = ProductRecord.objects.all()
 
 
-class EffectiveCostViewSet(viewsets.ModelViewSet):
+class EffectiveCostViewSet(FlatListMixin, viewsets.ModelViewSet):
     serializer_class = EffectiveCostSerializer
     queryset = EffectiveCost.objects.all()
 
 
-class PurchaseRecordViewSet(viewsets.ModelViewSet):
+class PurchaseRecordViewSet(BulkCreateMixin, viewsets.ModelViewSet):
     serializer_class = PurchaseRecordSerializer
+    bulk_serializer_class = BulkPurchaseRecordSerializer
     queryset = PurchaseRecord.objects.all()
 
 
-class DistributorViewSet(viewsets.ModelViewSet):
+class DistributorViewSet(CachedListMixin, viewsets.ModelViewSet):
     serializer_class = DistributorSerializer
     queryset = Distributor.objects.all()
 
 
+class ReorderViewSet(viewsets.ViewSet):
+    """
+    list:
+    Products out of stock or with fewer than `days` (default REORDER_COVER_DAYS) days of cover at their
+    current sales velocity, fewest days first, at most `limit` of them.
+    """
+    def list(self, request):
+        try:
+            days = float(request.query_params.get("days", REORDER_COVER_DAYS))
+            limit = int(request.query_params.get("limit", 100))
+        except ValueError:
+            raise ValidationError({"days": "Expected numbers for days and limit"})
+        if days <= 0 or not 0 < limit <= 1000:
+            raise ValidationError({"days": "Expected positive days and a limit of at most 1000"})
+        covers = StockCover.objects.low_stock(days).select_related('product')[:limit]
+        return Response(StockCoverSerializer(covers, many=True, context={"request": request}).data)
+
+
+class PayablesViewSet(AgeingReportMixin, viewsets.ViewSet):
+    """
+    list:
+    Amount owed per distributor for purchases in transit or on credit, in buckets of days since the purchase
+    date at `as_of` (default today). Export with `format=csv`.
+    """
+    report_name = "payables"
+    party = "purchased_from"
+    cache_models = (PurchaseRecord, EffectiveCost, ProductRecord, Distributor)
+
+    def balances(self, as_of):
+        return PurchaseRecord.objects.payables(as_of)
+
+
 class HomePageView(LoginRequiredMixin, TemplateView):
     """
     Home page view
@@ -0,0 +1,62 @@
+# coding=utf-8
+"""
+Server side cache of API list responses.
+
+Entries are keyed on a generation token per model which is replaced when a
+row of the model is saved or deleted, so stale entries are never read again
+and expire on their own after ``API_CACHE_TIMEOUT``.
+
+Generations must be seen by every worker, so responses are only cached
+with a ``CACHES`` backend shared between processes: the settings use files
+under ``API_CACHE_ROOT``, memcached or the database serve several hosts.
+With a per process memory cache every request is answered from the
+database.
+"""
+import hashlib
+import uuid
+
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+from core_settings.settings import API_CACHE_TIMEOUT
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['invalidate', 'key', 'lookup', 'shared', 'store']
+
+
+def _generation_key(model):
+    return "api:generation:{}".format(model._meta.label_lower)
+
+
+def generation(model):
+    return cache.get_or_set(_generation_key(model), lambda: uuid.uuid4().hex, None)
+
+
+def key(model, url, *related):
+    """ Cache key of the response to ``url`` listing ``model``, also invalidated with the ``related`` models """
+    generations = ":".join(generation(other) for other in (model,) + related)
+    return "api:{}:{}:{}".format(model._meta.label_lower, generations, hashlib.md5(url.encode()).hexdigest())
+
+
+def shared():
+    """ Whether the cache backend is seen by every process, or local to this one """
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], LocMemCache)
+
+
+def lookup(key):
+    return cache.get(key) if shared() else None
+
+
+def store(key, value):
+    if shared():
+        cache.set(key, value, API_CACHE_TIMEOUT)
+
+
+def invalidate(*models):
+    """ Drop cached responses of ``models``, again once the current transaction commits """
+    def bump():
+        cache.set_many(dict((_generation_key(model), uuid.uuid4().hex) for model in models), None)
+    bump()
+    transaction.on_commit(bump)
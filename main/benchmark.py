@@ -0,0 +1,53 @@
+# coding=utf-8
+"""
+Registry used by ``manage.py benchmark``.
+
+Apps ship their suites in a ``benchmarks`` module and register them with
+:func:`register`. A suite is called with ``(out, size)`` where ``out`` is the
+command's stdout and ``size`` the requested data volume; it always runs
+against a throw-away test database.
+"""
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.db import connection, reset_queries
+from django.test.utils import CaptureQueriesContext
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['registry', 'register', 'measure', 'report']
+
+registry = OrderedDict()
+
+
+def register(name, size=1000):
+    """Register the decorated function as suite ``name`` with a default ``size``"""
+    def decorator(func):
+        registry[name] = (func, size)
+        return func
+    return decorator
+
+
+@contextmanager
+def measure(count_queries=True):
+    """Yield a dict which holds ``seconds`` (and ``queries``) once the block exits"""
+    result = {}
+    start = time.perf_counter()
+    if count_queries:
+        reset_queries()  # the query log is bounded, a full one would count nothing
+        with CaptureQueriesContext(connection) as queries:
+            yield result
+        result['queries'] = len(queries)
+    else:
+        yield result
+    result['seconds'] = time.perf_counter() - start
+
+
+def report(out, label, seconds, count=None, unit="ops", queries=None):
+    line = "  {:<45} {:>10.2f} ms".format(label, seconds * 1000)
+    if count:
+        line += "  {:>12.1f} {}/s".format(count / seconds if seconds else float('inf'), unit)
+    if queries is not None:
+        line += "  {:>6} queries".format(queries)
+    out.write(line)
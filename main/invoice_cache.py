@@ -0,0 +1,103 @@
+# coding=utf-8
+"""
+Content addressed storage for rendered invoices.
+
+Entries are stored as ``<sale pk>/<fingerprint>.pdf`` where the fingerprint
+hashes everything printed on the invoice, so an edited sale never serves a
+stale file; the per sale directory only allows dropping old entries eagerly.
+"""
+import os
+import tempfile
+import time
+
+from core_settings import settings
+from main.utils import draw_pdf, invoice_fingerprint
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['InvoiceCache', 'invoice_cache']
+
+
+class InvoiceCache(object):
+    def __init__(self, root=settings.INV_CACHE_ROOT, max_size=settings.INV_CACHE_MAX_SIZE,
+                 max_age=settings.INV_CACHE_MAX_AGE, prune_every=50):
+        self.root = root
+        self.max_size = max_size
+        self.max_age = max_age
+        self.prune_every = prune_every
+        self._writes = 0
+
+    def path(self, sale_pk, fingerprint):
+        return os.path.join(self.root, str(sale_pk), fingerprint + ".pdf")
+
+    def get_or_render(self, sale_pk, data):
+        """ Return ``(path, fingerprint)`` of the rendered invoice ``data``, rendering it on a miss """
+        fingerprint = invoice_fingerprint(data)
+        path = self.path(sale_pk, fingerprint)
+        if not os.path.exists(path):
+            self.invalidate(sale_pk)
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            # render next to the target and rename so readers never see a partial file
+            fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=directory)
+            try:
+                with os.fdopen(fd, "wb") as tmp:
+                    draw_pdf(tmp, data)
+                os.replace(tmp_path, path)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+            self._writes += 1
+            if self._writes % self.prune_every == 0:
+                self.prune()
+        return path, fingerprint
+
+    def invalidate(self, sale_pk):
+        """ Drop every cached rendition of the sale ``sale_pk`` """
+        for entry in self._entries(os.path.join(self.root, str(sale_pk))):
+            self._remove(entry.path)
+
+    def prune(self):
+        """ Evict entries older than ``max_age``, then the oldest ones until under ``max_size`` """
+        now = time.time()
+        entries = []
+        for directory in self._entries(self.root, directories=True):
+            kept = 0
+            for entry in self._entries(directory.path):
+                stat = entry.stat()
+                if now - stat.st_mtime > self.max_age:
+                    self._remove(entry.path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    kept += 1
+            if not kept:
+                try:
+                    os.rmdir(directory.path)
+                except OSError:  # rendering into it concurrently
+                    pass
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _entries(directory, directories=False):
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return []
+        if directories:
+            return [entry for entry in entries if entry.is_dir()]
+        return [entry for entry in entries if entry.name.endswith(".pdf") and entry.is_file()]
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:  # removed concurrently
+            pass
+
+
+invoice_cache = InvoiceCache()
@@ -0,0 +1,22 @@
+# coding=utf-8
+from django.apps import apps
+from django.core.management.base import BaseCommand
+
+from core_settings.settings import LINE_TERMS_BATCH_SIZE
+from main.models import BaseEffectiveCost
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Copy the price and tax of their products onto purchase and sale lines saved before lines kept them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=LINE_TERMS_BATCH_SIZE, dest='batch_size',
+                            help="Lines updated per statement")
+
+    def handle(self, *args, **options):
+        for model in apps.get_models():
+            if issubclass(model, BaseEffectiveCost):
+                lines = model.objects.backfill_terms(options['batch_size'])
+                self.stdout.write(self.style.SUCCESS("Backfilled {} {} lines".format(lines, model.__name__)))
@@ -0,0 +1,44 @@
+# coding=utf-8
+import os
+import tempfile
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils.module_loading import autodiscover_modules
+
+from main.benchmark import registry
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Run performance benchmarks against a throw-away test database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('suites', nargs='*', help="Suites to run (all by default)")
+        parser.add_argument('--size', type=int, help="Override the default data volume of each suite")
+        parser.add_argument('--list', action='store_true', dest='list', help="List available suites")
+
+    def handle(self, *args, **options):
+        autodiscover_modules('benchmarks')
+        if options['list']:
+            for name, (func, size) in registry.items():
+                self.stdout.write("{:<20} size={:<8} {}".format(name, size, (func.__doc__ or "").strip()))
+            return
+        suites = options['suites'] or list(registry)
+        unknown = [name for name in suites if name not in registry]
+        if unknown:
+            raise CommandError("Unknown benchmark(s): {}".format(", ".join(unknown)))
+
+        if connection.vendor == 'sqlite':
+            # file backed so that threaded suites share one database
+            connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.gettempdir(), "benchmark.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            for name in suites:
+                func, size = registry[name]
+                size = options['size'] or size
+                self.stdout.write(self.style.MIGRATE_HEADING("{} (size={})".format(name, size)))
+                func(self.stdout, size)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,14 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+
+from main.invoice_cache import invoice_cache
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Evict old rendered invoices until the cache is within INV_CACHE_MAX_AGE and INV_CACHE_MAX_SIZE"
+
+    def handle(self, *args, **options):
+        invoice_cache.prune()
+        self.stdout.write(self.style.SUCCESS("Pruned invoice cache at {}".format(invoice_cache.root)))
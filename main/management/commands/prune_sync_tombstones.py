@@ -0,0 +1,19 @@
+# coding=utf-8
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from core_settings.settings import SYNC_TOMBSTONE_MAX_AGE
+from main.models import SyncTombstone
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Delete sync tombstones older than SYNC_TOMBSTONE_MAX_AGE days"
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=SYNC_TOMBSTONE_MAX_AGE)
+        deleted, _ = SyncTombstone.objects.filter(date_deleted__lt=cutoff).delete()
+        self.stdout.write(self.style.SUCCESS("Deleted {} sync tombstones".format(deleted)))
@@ -1,17 +1,203 @@
 # coding=utf-8
+from datetime import timedelta
+from decimal import Decimal
+
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import (Case, Count, DecimalField, ExpressionWrapper, F, Func, OuterRef, Q, Subquery, Sum,
+                              Value, When)
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from phonenumber_field.modelfields import PhoneNumberField
 from djmoney.models.fields import MoneyField
 
-from core_settings.settings import PRODUCT_TYPE
+from core_settings.settings import AGEING_BUCKETS, LINE_TERMS_BATCH_SIZE, PRODUCT_TYPE
+from main import pricing
 
 __author__ = "Gahan Saraiya"
 
 __all__ = ['BaseDistributor', 'BaseEffectiveCost', 'BaseProductRecord', 'BasePurchaseRecord', 'BaseCustomer', 'BaseSaleRecord',
-           'BaseAddress', 'BaseCity', 'BaseState', 'BaseCountry']
+           'BaseAddress', 'BaseCity', 'BaseState', 'BaseCountry', 'BaseEffectiveCostQuerySet', 'BaseBillQuerySet',
+           'bulk_insert', 'ageing_buckets', 'SyncTombstone']
+
+
+def _amount(expression):
+    return ExpressionWrapper(expression, output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def _round(expression):
+    """ ``expression`` rounded half away from zero to the paisa by the database """
+    return Func(expression, Value(2), function='ROUND', output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def line_terms(prefix=""):
+    """
+    SQL expressions for the price, tax rate and tax type of an effective cost
+    line, those of its product for lines saved before terms were kept on
+    lines, like :attr:`BaseEffectiveCost.pricing_terms`
+    """
+    unkept = Q(**{prefix + 'mrp__isnull': True})
+
+    def term(field, fallback, output_field):
+        return Case(When(unkept, then=F(prefix + 'cost__' + fallback)), default=F(prefix + field),
+                    output_field=output_field)
+
+    return {
+        'price': term('mrp', 'price', DecimalField(max_digits=11, decimal_places=2)),
+        'rate': term('tax_rate', 'tax', models.IntegerField()),
+        'tax_type': term('tax_type', 'tax_type', models.IntegerField()),
+    }
+
+
+def line_amounts(prefix=""):
+    """
+    SQL expressions for the per unit amounts of an effective cost line, rounded
+    like :func:`main.pricing.price_lines` from the terms of :func:`line_terms`;
+    ``prefix`` is the path to the line i.e. ``items__`` when aggregating over
+    a bill
+    """
+    terms = line_terms(prefix)
+    price = terms['price']
+    discount = _round(price * F(prefix + 'discount') / Value(Decimal('100.0')))
+    total = price - discount
+    rate = Coalesce(terms['rate'], 0)
+    taxable = _round(total * Value(Decimal('100.0')) / (Value(Decimal('100.0')) + rate))
+    return {
+        'gross': price,
+        'discount': discount,
+        'tax': total - taxable,
+        'total': total,
+    }
+
+
+def _consecutive_ids(connection):
+    """ Whether a multi row INSERT gets consecutive ids from the last insert id onwards """
+    if connection.vendor != 'mysql':
+        return True
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+        lock_mode, increment = cursor.fetchone()
+    return lock_mode in (0, 1) and increment == 1
+
+
+def bulk_insert(objs, using="default"):
+    """
+    ``bulk_create`` which sets the primary key of every object on all
+    backends. Where INSERT can not return ids they are derived from the
+    last insert id of each single statement batch: SQLite holds the write
+    lock for the statement and MySQL hands out consecutive ids to a multi
+    row INSERT (``innodb_autoinc_lock_mode`` 0 or 1). With interleaved
+    ids (lock mode 2) or an increment other than 1 MySQL inserts one row
+    per statement instead.
+    """
+    if not objs:
+        return objs
+    connection = connections[using]
+    model = type(objs[0])
+    manager = model._base_manager.using(using)
+    if connection.features.can_return_ids_from_bulk_insert:
+        return manager.bulk_create(objs)
+    fields = [field for field in model._meta.concrete_fields if not isinstance(field, models.AutoField)]
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1) if _consecutive_ids(connection) else 1
+    with transaction.atomic(using=using, savepoint=False):
+        for start in range(0, len(objs), batch_size):
+            batch = objs[start:start + batch_size]
+            manager.bulk_create(batch, batch_size=len(batch))
+            with connection.cursor() as cursor:
+                if connection.vendor == 'mysql':
+                    cursor.execute("SELECT LAST_INSERT_ID()")
+                    first = cursor.fetchone()[0]
+                else:
+                    cursor.execute("SELECT last_insert_rowid()")
+                    first = cursor.fetchone()[0] - len(batch) + 1
+            for offset, obj in enumerate(batch):
+                obj.pk = first + offset
+    return objs
+
+
+class BaseEffectiveCostQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate unit and line amounts (``unit_*`` / ``line_*``) computed by the database"""
+        quantity = Coalesce(F('quantity'), 0)
+        amounts = line_amounts()
+        annotations = dict(('unit_' + name, _amount(amount)) for name, amount in amounts.items())
+        annotations.update(('line_' + name, _amount(amount * quantity)) for name, amount in amounts.items())
+        return self.annotate(**annotations)
+
+    def backfill_terms(self, batch_size=LINE_TERMS_BATCH_SIZE):
+        """
+        Copy the price and tax of their products onto the lines saved without
+        them, ``batch_size`` lines per UPDATE in order of primary key, and
+        return how many were updated
+        """
+        products = self.model._meta.get_field('cost').related_model._base_manager.filter(pk=OuterRef('cost_id'))
+        terms = dict((name, Subquery(products.values(field)[:1]))
+                     for name, field in (('mrp', 'price'), ('tax_rate', 'tax'), ('tax_type', 'tax_type')))
+        missing = self.filter(mrp__isnull=True).order_by('pk').values_list('pk', flat=True)
+        last, updated = 0, 0
+        while True:
+            batch = list(missing.filter(pk__gt=last)[:batch_size])
+            if not batch:
+                return updated
+            updated += self.model._base_manager.using(self.db).filter(pk__in=batch).update(**terms)
+            last = batch[-1]
+
+
+def ageing_buckets():
+    """ ``(name, first day, last day)`` of the ageing buckets, the last one open ended """
+    bounds = [0] + [days + 1 for days in AGEING_BUCKETS]
+    buckets = [("days_{}_{}".format(first, following - 1), first, following - 1)
+               for first, following in zip(bounds, bounds[1:])]
+    return buckets + [("days_over_{}".format(AGEING_BUCKETS[-1]), bounds[-1], None)]
+
+
+class BaseBillQuerySet(models.QuerySet):
+    def with_totals(self):
+        """Annotate ``bill_gross``, ``bill_discount``, ``bill_tax`` and ``bill_total`` in a single query"""
+        quantity = Coalesce(F('items__quantity'), 0)
+        return self.annotate(**dict(
+            ('bill_' + name, Coalesce(Sum(_amount(amount * quantity)), Value(0)))
+            for name, amount in line_amounts('items__').items()))
+
+    def ageing(self, party, date_field, as_of):
+        """
+        Number of bills, amount per ageing bucket of days since ``date_field``
+        at ``as_of`` and total amount per value of the ``party`` field paths,
+        in a single grouped query. Bills without a date are the oldest.
+        """
+        amount = _amount(line_amounts('items__')['total'] * Coalesce(F('items__quantity'), 0))
+        buckets = {}
+        for name, first, last in ageing_buckets():
+            dated = Q(**{date_field + "__lte": as_of - timedelta(days=first)})
+            if last is None:
+                dated |= Q(**{date_field + "__isnull": True})
+            else:
+                dated &= Q(**{date_field + "__gte": as_of - timedelta(days=last)})
+            buckets[name] = Coalesce(Sum(Case(When(dated, then=amount), output_field=amount.output_field)),
+                                     Value(0))
+        bills = self.filter(Q(**{date_field + "__lte": as_of}) | Q(**{date_field + "__isnull": True}))
+        return bills.values(*party).annotate(
+            bills=Count('pk', distinct=True), total=Coalesce(Sum(amount), Value(0)), **buckets).order_by(*party)
+
+    def create_bills(self, bills):
+        """
+        Insert ``bills``, a list of ``(bill, lines)``, with their lines and
+        ``items`` rows in a few bulk statements. No ``items`` m2m_changed
+        signal is sent; subclasses apply its side effects to all bills at once.
+        """
+        bills = list(bills)
+        through = self.model.items.through
+        bill_field = self.model.items.field.m2m_field_name() + "_id"
+        line_field = self.model.items.field.m2m_reverse_field_name() + "_id"
+        line_model = self.model.items.field.related_model
+        line_model.take_terms_of_products([line for bill, lines in bills for line in lines], self.db)
+        with transaction.atomic(using=self.db):
+            bulk_insert([bill for bill, lines in bills], self.db)
+            bulk_insert([line for bill, lines in bills for line in lines], self.db)
+            through.objects.using(self.db).bulk_create([
+                through(**{bill_field: bill.pk, line_field: line.pk}) for bill, lines in bills for line in lines])
+        return bills
 
 
 class BaseState(models.Model):
@@ -169,11 +355,69 @@ class BaseEffectiveCost(models.Model):
                                    default=1,
                                    validators=[MinValueValidator(1)],
                                    verbose_name=_("Qty."))
+    # terms of the product when the line was made, lines keep them when the product is edited
+    mrp = models.DecimalField(max_digits=11, decimal_places=2, blank=True, null=True, editable=False,
+                              verbose_name=_("MRP"))
+    tax_rate = models.IntegerField(blank=True, null=True, editable=False, verbose_name=_("Tax"))
+    tax_type = models.IntegerField(blank=True, null=True, editable=False, choices=BaseProductRecord.COLLECTION,
+                                   verbose_name=_("Tax Type"))
+
+    TERMS = ('mrp', 'tax_rate', 'tax_type')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        line = super().from_db(db, field_names, values)
+        line._terms_of = line.__dict__.get('cost_id')
+        return line
 
     @property
     def details(self):
         return self.__dict__
 
+    @property
+    def product_amount(self):
+        return self.cost.price.amount if self.mrp is None else self.mrp
+
+    def take_terms(self, product=None):
+        """ Copy the price and tax of ``product``, by default of ``cost``, onto the line """
+        product = product or self.cost
+        self.mrp, self.tax_rate, self.tax_type = product.price.amount, product.tax, product.tax_type
+        self._terms_of = product.pk
+
+    @classmethod
+    def take_terms_of_products(cls, lines, using="default"):
+        """ :meth:`take_terms` for those of ``lines`` without terms yet with one query of their products """
+        lines = list(lines)
+        missing = [line for line in lines if line.mrp is None]
+        product_model = cls._meta.get_field('cost').related_model
+        products = product_model._base_manager.using(using).in_bulk({line.cost_id for line in missing})
+        for line in missing:
+            line.take_terms(products[line.cost_id])
+        return lines
+
+    def save(self, *args, **kwargs):
+        if self.mrp is None or self.cost_id != getattr(self, '_terms_of', self.cost_id):
+            self.take_terms()
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | set(self.TERMS)
+        super().save(*args, **kwargs)
+
+    @property
+    def pricing_terms(self):
+        """ ``(price in paise, discount, quantity, tax rate, tax type)`` of the line for :mod:`main.pricing` """
+        if self.mrp is None:  # not saved yet, or saved before terms were kept on lines
+            cost = self.cost
+            return pricing.paise(cost.price.amount), self.discount, self.quantity, cost.tax, cost.tax_type
+        return pricing.paise(self.mrp), self.discount, self.quantity, self.tax_rate, self.tax_type
+
+    @property
+    def amounts(self):
+        """ :class:`main.pricing.LineAmounts` of the line in rupees, priced again only when its terms change """
+        terms = self.pricing_terms
+        if getattr(self, '_amounts', (None,))[0] != terms:
+            self._amounts = terms, pricing.in_rupees(pricing.price_lines([terms])[0])
+        return self._amounts[1]
+
     class Meta:
         abstract = True
         verbose_name = verbose_name_plural = "Effective cost of " + PRODUCT_TYPE
@@ -187,6 +431,7 @@ class BasePurchaseRecord(models.Model):
         (4, _("Online Transfer NEFT/RTGS")),
         (5, _("Credit/EMI/Loan")),
     )
+    CREDIT = 5
     invoice_id = models.CharField(max_length=80, blank=True, null=True,
                                   verbose_name=_("Enter Invoice Number"),
                                   help_text=_("Enter Order/Invoice Number"))
@@ -261,6 +506,7 @@ class BaseSaleRecord(models.Model):
         (4, _("Online Transfer NEFT/RTGS")),
         (5, _("Credit/EMI/Loan")),
     )
+    CREDIT = 5
     invoice_id = models.CharField(max_length=80, blank=True, null=True,
                                   verbose_name=_("Enter Invoice Number"),
                                   help_text=_("Enter Order/Invoice Number"))
@@ -298,3 +544,13 @@ class BaseSaleRecord(models.Model):
         abstract = True
         verbose_name = "Sale record"
         verbose_name_plural = "Sale Records"
+
+
+class SyncTombstone(models.Model):
+    """ Record of a deleted row, served by the delta sync endpoint """
+    name = models.CharField(max_length=40, help_text=_("Sync collection of the deleted row"))
+    object_id = models.IntegerField()
+    date_deleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return "{} #{}".format(self.name, self.object_id)
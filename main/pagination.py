@@ -0,0 +1,73 @@
+# coding=utf-8
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ["DateCreatedCursorPagination"]
+
+
+class DateCreatedCursorPagination(CursorPagination):
+    """
+    Keyset pagination, newest first, on the ``(date_created, id)`` index of
+    each model: no COUNT(*) and no OFFSET, so a deep page costs as much as
+    the first one.
+
+    The cursor position is the ``date_created|id`` pair of the boundary row,
+    which is unique, so the offset of DRF cursors is never needed.
+    """
+    ordering = ("-date_created", "-id")
+    page_size_query_param = "page_size"
+    max_page_size = 1000
+
+    def _get_position_from_instance(self, instance, ordering):
+        if isinstance(instance, dict):
+            return "{}|{}".format(instance["date_created"], instance["id"])
+        return "{}|{}".format(instance.date_created, instance.id)
+
+    def decode_position(self, position):
+        created, _, pk = position.rpartition("|")
+        created = parse_datetime(created)
+        if created is None or not pk.isdigit():
+            raise NotFound(self.invalid_cursor_message)
+        return created, int(pk)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        reverse, position = (self.cursor.reverse, self.cursor.position) if self.cursor else (False, None)
+
+        if reverse:
+            queryset = queryset.order_by("date_created", "id")
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            created, pk = self.decode_position(position)
+            if reverse:  # rows after the boundary, ascending
+                queryset = queryset.filter(Q(date_created__gte=created),
+                                           Q(date_created__gt=created) | Q(id__gt=pk))
+            else:
+                queryset = queryset.filter(Q(date_created__lte=created),
+                                           Q(date_created__lt=created) | Q(id__lt=pk))
+
+        results = list(queryset[:self.page_size + 1])
+        self.page = results[:self.page_size]
+        following = self._get_position_from_instance(results[-1], self.ordering) \
+            if len(results) > len(self.page) else None
+        if reverse:
+            self.page.reverse()
+            self.has_next, self.next_position = position is not None, position
+            self.has_previous, self.previous_position = following is not None, following
+        else:
+            self.has_next, self.next_position = following is not None, following
+            self.has_previous, self.previous_position = position is not None, position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
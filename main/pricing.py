@@ -0,0 +1,88 @@
+# coding=utf-8
+"""
+Pricing engine of bill lines: discount, taxable value and GST.
+
+Prices (MRP) include GST and every amount is an integer number of paise.
+Per unit of a line
+
+* the discount is ``discount`` percent of the price,
+* the unit price is the price less the discount,
+* the taxable value is ``unit price * 100 / (100 + rate)`` and the rest of
+  the unit price is tax,
+* the tax is IGST on inter-state supplies, otherwise CGST, half of it, and
+  SGST, the rest;
+
+each division rounds half up to the paisa. Line amounts are the unit
+amounts times the quantity and bill amounts the sums of their lines, so
+lines always add up to their bill. :func:`main.models.line_amounts` computes
+the same amounts in SQL for aggregates.
+"""
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['IGST', 'BillAmounts', 'LineAmounts', 'bill_amounts', 'in_rupees', 'paise', 'price_lines', 'taxable']
+
+IGST = 2  # tax type of inter-state supplies, see BaseProductRecord.COLLECTION
+
+BILL_FIELDS = ("gross", "discount", "total", "taxable", "tax", "igst", "cgst", "sgst")
+BillAmounts = namedtuple("BillAmounts", BILL_FIELDS)
+LineAmounts = namedtuple("LineAmounts", ("unit_discount", "unit_price", "unit_taxable", "unit_tax") + BILL_FIELDS)
+
+
+def _divide(numerator, denominator):
+    """ ``numerator / denominator`` rounded half away from zero, ``denominator`` is positive """
+    quotient, remainder = divmod(abs(numerator), denominator)
+    quotient += 2 * remainder >= denominator
+    return quotient if numerator >= 0 else -quotient
+
+
+def paise(amount):
+    """ Integer paise of the rupee ``amount`` """
+    return int((Decimal(amount or 0) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+
+def in_rupees(amounts):
+    """ Paise ``amounts``, a number or named tuple of them, in Decimal rupees """
+    if isinstance(amounts, tuple):
+        return amounts._make([Decimal(amount).scaleb(-2) for amount in amounts])
+    return Decimal(amounts).scaleb(-2)
+
+
+def taxable(amount, rate):
+    """ Taxable value in paise of the tax inclusive ``amount`` in paise at ``rate`` percent """
+    return _divide(amount * 100, 100 + (rate or 0))
+
+
+def price_lines(lines):
+    """
+    :class:`LineAmounts` in paise of ``lines``, a sequence of ``(price in
+    paise, discount percent, quantity, tax rate percent, tax type)``
+    """
+    priced = []
+    for price, discount, quantity, rate, tax_type in lines:
+        quantity = quantity or 0
+        unit_discount = _divide(price * (discount or 0), 100)
+        unit_price = price - unit_discount
+        unit_taxable = _divide(unit_price * 100, 100 + (rate or 0))
+        unit_tax = unit_price - unit_taxable
+        if tax_type == IGST:
+            igst, cgst, sgst = unit_tax, 0, 0
+        else:
+            cgst = _divide(unit_tax, 2)
+            igst, sgst = 0, unit_tax - cgst
+        priced.append(LineAmounts(
+            unit_discount, unit_price, unit_taxable, unit_tax, price * quantity, unit_discount * quantity,
+            unit_price * quantity, unit_taxable * quantity, unit_tax * quantity, igst * quantity, cgst * quantity,
+            sgst * quantity))
+    return priced
+
+
+def bill_amounts(lines):
+    """ :class:`BillAmounts` of the priced ``lines`` of a bill """
+    totals = [0] * len(BILL_FIELDS)
+    for line in lines:
+        for index, amount in enumerate(line[4:]):
+            totals[index] += amount
+    return BillAmounts(*totals)
@@ -0,0 +1,29 @@
+# coding=utf-8
+import csv
+import io
+
+from rest_framework.renderers import BaseRenderer
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ["CSVRenderer"]
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Renders a list of flat rows as CSV with a header of the keys of the
+    first row, for ``?format=csv`` exports of report endpoints
+    """
+    media_type = "text/csv"
+    format = "csv"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, list):  # errors
+            data = [data]
+        output = io.StringIO()
+        if data:
+            writer = csv.DictWriter(output, fieldnames=list(data[0]))
+            writer.writeheader()
+            writer.writerows(data)
+        return output.getvalue().encode(self.charset)
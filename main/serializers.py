@@ -1,11 +1,18 @@
 # coding=utf-8
+from collections import OrderedDict
+
+from django.core.exceptions import FieldDoesNotExist
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
 from .models import *
 
 __author__ = "Gahan Saraiya"
 
-__all__ = ["BaseDistributorSerializer", "BaseEffectiveCostSerializer", "BasePurchaseRecordSerializer", "BaseProductRecordSerializer"]
+__all__ = ["BaseDistributorSerializer", "BaseEffectiveCostSerializer", "BasePurchaseRecordSerializer", "BaseProductRecordSerializer",
+           "BulkLineSerializer", "BulkBillSerializer", "SparseFieldsMixin", "FlatSerializerMixin"]
+
+URL_PLACEHOLDER = "FLATPKPLACEHOLDER"
 
 
 class BasePurchaseRecordSerializer(serializers.HyperlinkedModelSerializer):
@@ -37,3 +44,147 @@ class BaseDistributorSerializer(serializers.HyperlinkedModelSerializer):
         model = BaseDistributor
         fields = ["id", "url", "name", "contact_number", "alternate_contact_number",
                   "fax_number", "address", "email_address", "date_created"]
+
+
+class BulkLineSerializer(serializers.ModelSerializer):
+    """ Bill line of a bulk import, ``cost`` is a product id checked per bill instead of per line """
+    cost = serializers.IntegerField(source="cost_id")
+
+    class Meta:
+        fields = ["cost", "quantity", "discount"]
+
+
+class BulkBillListSerializer(serializers.ListSerializer):
+    def create(self, validated_data):
+        return self.child.create_bills(validated_data)
+
+
+class BulkBillSerializer(serializers.ModelSerializer):
+    """
+    A bill with nested ``items``. A list of them is created with one
+    ``create_bills`` call of the bill model's manager.
+    """
+    line_model = None
+    product_model = None
+
+    class Meta:
+        list_serializer_class = BulkBillListSerializer
+
+    def validate_items(self, items):
+        if not items:
+            raise serializers.ValidationError("A bill needs at least one item")
+        products = {item["cost_id"] for item in items}
+        missing = products - set(self.product_model.objects.filter(pk__in=products).values_list("pk", flat=True))
+        if missing:
+            raise serializers.ValidationError("Unknown products: {}".format(", ".join(map(str, sorted(missing)))))
+        return items
+
+    def create(self, validated_data):
+        return self.create_bills([validated_data])[0]
+
+    def create_bills(self, validated_data):
+        bills = []
+        for data in validated_data:
+            data = dict(data)
+            lines = [self.line_model(**item) for item in data.pop("items")]
+            bills.append((self.Meta.model(**data), lines))
+        return [bill for bill, lines in self.Meta.model.objects.create_bills(bills)]
+
+    def to_representation(self, instance):
+        return {"id": instance.pk, "invoice_id": instance.invoice_id}
+
+
+class SparseFieldsMixin(object):
+    """
+    Serializer limited to the comma separated fields of ``?fields=``, less
+    those of ``?exclude=``, when it is the top level serializer of a read
+    request
+    """
+    def get_fields(self):
+        fields = super().get_fields()
+        request = self.context.get("request")
+        top_level = self.parent is None or (isinstance(self.parent, serializers.ListSerializer) and
+                                            self.parent.parent is None)
+        if request is None or request.method not in ("GET", "HEAD") or not top_level:
+            return fields
+        params = getattr(request, "query_params", request.GET)
+        only = [name for name in params.get("fields", "").split(",") if name]
+        exclude = [name for name in params.get("exclude", "").split(",") if name]
+        unknown = set(only + exclude) - set(fields)
+        if unknown:
+            raise serializers.ValidationError({"fields": "Unknown fields: {}".format(", ".join(sorted(unknown)))})
+        return OrderedDict((name, field) for name, field in fields.items()
+                           if (not only or name in only) and name not in exclude)
+
+
+class FlatSerializerMixin(object):
+    """
+    Serializes rows of ``QuerySet.values()`` to the same output as model
+    instances, skipping instance creation, attribute lookups and a URL
+    reverse per row. Only plain model fields and hyperlinks on ``pk`` are
+    supported; ``flat_columns()`` is None for other serializers.
+    """
+    def _url_template(self, field):
+        if field.lookup_field != "pk" or self.context.get("format"):
+            return None
+        url = field.reverse(field.view_name, kwargs={field.lookup_url_kwarg: URL_PLACEHOLDER},
+                            request=self.context.get("request"))
+        return lambda pk: None if pk is None else url.replace(URL_PLACEHOLDER, str(pk))
+
+    def _file_url(self, field, model_field):
+        request = self.context.get("request")
+        use_url = getattr(field, "use_url", api_settings.UPLOADED_FILES_USE_URL)
+
+        def url(name):
+            if not name:
+                return None
+            if not use_url:
+                return name
+            url = model_field.storage.url(name)
+            return request.build_absolute_uri(url) if request is not None else url
+        return url
+
+    def flat_plan(self):
+        """ ``(name, column, to_representation)`` of every field, None when a field needs an instance """
+        if not hasattr(self, "_flat_plan"):
+            self._flat_plan = self._build_flat_plan()
+        return self._flat_plan
+
+    def _build_flat_plan(self):
+        opts = self.Meta.model._meta
+        plan = []
+        for name, field in self.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.HyperlinkedIdentityField):
+                column, convert = opts.pk.attname, self._url_template(field)
+            else:
+                if isinstance(field, (serializers.BaseSerializer, serializers.ManyRelatedField,
+                                      serializers.SerializerMethodField)) or field.source_attrs != [field.source]:
+                    return None
+                try:
+                    model_field = opts.get_field(field.source)
+                except FieldDoesNotExist:
+                    return None
+                column = model_field.attname
+                if isinstance(field, serializers.HyperlinkedRelatedField):
+                    convert = self._url_template(field)
+                elif isinstance(field, serializers.RelatedField):
+                    return None
+                elif isinstance(field, serializers.FileField):
+                    convert = self._file_url(field, model_field)
+                else:
+                    convert = field.to_representation
+            if convert is None:
+                return None
+            plan.append((name, column, convert))
+        return plan
+
+    def flat_columns(self):
+        plan = self.flat_plan()
+        return None if plan is None else [column for name, column, convert in plan]
+
+    def flat_data(self, rows):
+        plan = self.flat_plan()
+        return [OrderedDict((name, None if row[column] is None else convert(row[column]))
+                            for name, column, convert in plan) for row in rows]
@@ -0,0 +1,169 @@
+# coding=utf-8
+"""
+Delta sync of registered models for offline clients.
+
+A client sends back the opaque token of its previous response and receives
+the rows of every collection changed since, ordered on ``(date_updated, id)``
+and at most ``SYNC_BATCH_SIZE`` per collection, plus the ids of deleted rows
+(:class:`main.models.SyncTombstone`). Rows are sent as lists in the order of
+the collection's ``fields`` to keep payloads small. Without a token, or with
+one older than the kept tombstones, everything is sent again with ``reset``.
+
+``date_updated`` and ``date_deleted`` are set when a row is saved or
+deleted, not when its transaction commits, so a row or tombstone may show
+up after later ones were already sent. Rows and tombstones are both sent in
+order of ``(timestamp, id)``; once a collection or the tombstones are sent
+in full their position is held back ``SYNC_SAFETY_LAG`` seconds and what
+changed since is sent again by the next sync. Clients replace rows and
+delete them by id, so the overlap is harmless.
+
+Changes made with ``QuerySet.update()`` do not touch ``date_updated`` and
+are not picked up.
+"""
+import base64
+import json
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core_settings.settings import SYNC_BATCH_SIZE, SYNC_SAFETY_LAG, SYNC_TOMBSTONE_MAX_AGE
+from main.models import SyncTombstone
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['InvalidToken', 'changes', 'collections', 'register']
+
+collections = OrderedDict()
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def _record_deletion(name):
+    def receiver(sender, instance, **kwargs):
+        SyncTombstone.objects.create(name=name, object_id=instance.pk)
+    return receiver
+
+
+def _touch_bills(model):
+    def receiver(sender, instance, action, reverse, pk_set, **kwargs):
+        if action not in ("post_add", "post_remove", "post_clear"):
+            return
+        bills = pk_set if reverse else [instance.pk]
+        model._base_manager.filter(pk__in=bills or []).update(date_updated=timezone.now())
+    return receiver
+
+
+def register(name, model, fields=None, many=()):
+    """
+    Serve ``model`` as collection ``name`` with the columns ``fields``, by
+    default every column, and the ids of the many to many fields ``many``;
+    changing those relations marks the row as updated
+    """
+    if fields is None:
+        fields = [field.attname for field in model._meta.concrete_fields if field.attname not in ("id", "date_updated")]
+    collections[name] = (model, list(fields), list(many))
+    post_delete.connect(_record_deletion(name), sender=model, weak=False, dispatch_uid="sync_" + name)
+    for field in many:
+        m2m_changed.connect(_touch_bills(model), sender=getattr(model, field).through, weak=False,
+                            dispatch_uid="sync_{}_{}".format(name, field))
+
+
+def encode_token(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_token(token):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode())
+        issued = parse_datetime(state["at"])
+        positions = dict((name, (parse_datetime(updated), int(pk)))
+                         for name, (updated, pk) in state.get("rows", {}).items())
+        deleted_at, deleted_pk = state["deleted"]
+        deleted = parse_datetime(deleted_at), int(deleted_pk)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        raise InvalidToken(token)
+    if issued is None or None in [updated for updated, pk in list(positions.values()) + [deleted]]:
+        raise InvalidToken(token)
+    return issued, positions, deleted
+
+
+def _plain(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)  # decimals, phone numbers, files
+
+
+def _page(queryset, stamp, position, limit, horizon, *fields):
+    """
+    Up to ``limit`` rows of ``queryset`` after ``position`` in order of
+    ``(stamp, id)`` as ``(id, stamp, *fields)``, the position to continue
+    from and whether more rows follow
+    """
+    queryset = queryset.order_by(stamp, "id")
+    if position is not None:
+        updated, pk = position
+        queryset = queryset.filter(Q(**{stamp + "__gte": updated}), Q(**{stamp + "__gt": updated}) | Q(id__gt=pk))
+    rows = list(queryset.values_list("id", stamp, *fields)[:limit + 1])
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if rows:
+        position = (rows[-1][1], rows[-1][0])
+    if position is not None and not more:  # rows saved before ``horizon`` may still be committing
+        position = min(position, (horizon, 0))
+    return rows, position, more
+
+
+def _batch(model, fields, many, position, limit, horizon):
+    rows, position, more = _page(model._base_manager.all(), "date_updated", position, limit, horizon, *fields)
+    ids = [row[0] for row in rows]
+    related = {}
+    for field in many:
+        relation = getattr(model, field)
+        through = relation.through
+        source, target = relation.field.m2m_field_name(), relation.field.m2m_reverse_field_name()
+        members = dict((pk, []) for pk in ids)
+        for bill, item in through.objects.filter(**{source + "_id__in": ids}).order_by(target + "_id").values_list(
+                source + "_id", target + "_id"):
+            members[bill].append(item)
+        related[field] = members
+    payload = [[row[0]] + [_plain(value) for value in row[2:]] + [related[field][row[0]] for field in many]
+               for row in rows]
+    return payload, position, more
+
+
+def changes(token=None, limit=SYNC_BATCH_SIZE):
+    """ Payload of the rows changed and deleted since ``token`` with the token to continue from """
+    now = timezone.now()
+    horizon = now - timedelta(seconds=SYNC_SAFETY_LAG)
+    issued, positions, deleted = decode_token(token) if token else (None, {}, None)
+    reset = issued is None or issued < now - timedelta(days=SYNC_TOMBSTONE_MAX_AGE)
+    if reset:  # rows are all sent again, only deletions which may still be committing matter
+        positions, deleted = {}, (horizon, 0)
+
+    more, data = False, OrderedDict()
+    for name, (model, fields, many) in collections.items():
+        rows, position, truncated = _batch(model, fields, many, positions.get(name), limit, horizon)
+        if position is not None:
+            positions[name] = position
+        more = more or truncated
+        data[name] = OrderedDict([("fields", ["id"] + fields + many), ("rows", rows)])
+
+    removed = OrderedDict()
+    tombstones, deleted, truncated = _page(SyncTombstone.objects.all(), "date_deleted", deleted, limit, horizon,
+                                           "name", "object_id")
+    more = more or truncated
+    for pk, date_deleted, name, object_id in tombstones:
+        removed.setdefault(name, []).append(object_id)
+
+    state = {"at": now.isoformat(), "deleted": [deleted[0].isoformat(), deleted[1]],
+             "rows": dict((name, [updated.isoformat(), pk]) for name, (updated, pk) in positions.items())}
+    return OrderedDict([("token", encode_token(state)), ("reset", reset), ("more", more),
+                        ("changes", data), ("deleted", removed)])
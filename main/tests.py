@@ -1,5 +1,169 @@
 # coding=utf-8
 __author__ = "Gahan Saraiya"
-from django.test import TestCase
+import os
+import random
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from fractions import Fraction
+from io import BytesIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from inventory_management.models import Distributor, EffectiveCost, ProductRecord, PurchaseRecord
+from main import pricing
+from main.models import SyncTombstone
+from main.utils import draw_invoices, letterhead
+
+
+# a cache shared between processes, the API response cache is not used with the per process one of the tests
+SHARED_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                             'LOCATION': os.path.join(tempfile.gettempdir(), "phonezilla-test-cache")}}
+
+
+class LetterheadTest(SimpleTestCase):
+    invoice = {'invoice_id': "1000", 'sale_date': "01-04-2018", 'customer_name': "Customer",
+               'customer_lines': ["Customer"], 'items': [], 'total': "0.00"}
+
+    def test_letterhead_is_drawn_once_per_document(self):
+        buffer = BytesIO()
+        draw_invoices(buffer, [self.invoice] * 3)
+        self.assertEqual(buffer.getvalue().count(b"/Subtype /Form"), 1)
+
+    def test_letterhead_follows_company_settings(self):
+        name, logo = letterhead.prepare()
+        self.assertEqual(letterhead.prepare(), (name, logo))
+        with mock.patch('core_settings.settings.COMPANY_TITLE', "Renamed"):
+            self.assertNotEqual(letterhead.prepare()[0], name)
+
+
+class PricingTest(SimpleTestCase):
+    def random_lines(self, rng, count):
+        return [(rng.randint(0, 20000000), rng.choice([0, 0, 5, 10, 15, 33]), rng.randint(0, 50),
+                 rng.choice([None, 0, 5, 12, 18, 28]), rng.choice([None, 1, pricing.IGST])) for _ in range(count)]
+
+    def test_known_amounts(self):
+        line = pricing.in_rupees(pricing.price_lines([(pricing.paise("1120"), 0, 2, 12, 1)])[0])
+        self.assertEqual((line.unit_taxable, line.taxable, line.cgst, line.sgst, line.igst),
+                         (Decimal("1000.00"), Decimal("2000.00"), Decimal("120.00"), Decimal("120.00"), 0))
+        line, = pricing.price_lines([(1019, 0, 1, 5, 1)])  # tax of 49 paise, CGST rounds half up
+        self.assertEqual((line.taxable, line.cgst, line.sgst), (970, 25, 24))
+        self.assertEqual(pricing.taxable(pricing.paise("100.01"), 18), 8475)
+        self.assertEqual(pricing.paise(Decimal("10.465")), 1047)
+
+    def test_amounts_add_up(self):
+        rng = random.Random(2018)
+        for _ in range(200):
+            lines = self.random_lines(rng, rng.randint(0, 8))
+            priced = pricing.price_lines(lines)
+            for (price, discount, quantity, rate, tax_type), line in zip(lines, priced):
+                exact = Fraction(line.unit_price) * 100 / (100 + (rate or 0))
+                self.assertLessEqual(abs(line.unit_taxable - exact), Fraction(1, 2))
+                self.assertLessEqual(abs(line.unit_discount - Fraction(price) * Fraction(discount) / 100),
+                                     Fraction(1, 2))
+                self.assertEqual(line.gross, line.discount + line.total)
+                self.assertEqual(line.total, line.taxable + line.tax)
+                self.assertEqual(line.tax, line.igst + line.cgst + line.sgst)
+                self.assertEqual(line.total, line.unit_price * quantity)
+                self.assertTrue(line.igst == 0 if tax_type != pricing.IGST else line.cgst == line.sgst == 0)
+                self.assertIn(line.cgst - line.sgst, (0, quantity))
+            bill = pricing.bill_amounts(priced)
+            self.assertEqual(list(bill), [sum(line[4 + index] for line in priced)
+                                          for index in range(len(pricing.BILL_FIELDS))])
+            self.assertEqual(bill.total, bill.taxable + bill.igst + bill.cgst + bill.sgst)
+
+
+@mock.patch("main.sync.SYNC_SAFETY_LAG", 0)
+class SyncTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.distributor = Distributor.objects.create(name="Supplier")
+        self.products = [ProductRecord.objects.create(name="Handset {}".format(i), price=1000, launched_by="Brand")
+                         for i in range(5)]
+
+    def sync(self, token=None, **params):
+        if token:
+            params["token"] = token
+        response = self.client.get(reverse("sync-list"), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def rows(self, payload, name):
+        fields = payload["changes"][name]["fields"]
+        return [dict(zip(fields, row)) for row in payload["changes"][name]["rows"]]
+
+    def test_only_changes_since_token(self):
+        first = self.sync()
+        self.assertTrue(first["reset"])
+        self.assertFalse(first["more"])
+        self.assertEqual(len(self.rows(first, "products")), 5)
+        self.assertEqual(self.sync(first["token"])["changes"]["products"]["rows"], [])
+
+        product = self.products[2]
+        product.name = "Renamed"
+        product.save()
+        bill = PurchaseRecord.objects.create(invoice_id="P-1", purchased_from=self.distributor, payment_mode=1)
+        line = EffectiveCost.objects.create(cost=product, quantity=1)
+        bill.items.add(line)
+        deleted = self.products[4].pk
+        self.products[4].delete()
+
+        delta = self.sync(first["token"])
+        self.assertFalse(delta["reset"])
+        self.assertEqual([row["name"] for row in self.rows(delta, "products")], ["Renamed"])
+        self.assertEqual([row["items"] for row in self.rows(delta, "purchases")], [[line.pk]])
+        self.assertEqual(delta["deleted"], {"products": [deleted]})
+        self.assertEqual(self.sync(delta["token"])["deleted"], {})
+
+    def test_batches_follow_token(self):
+        ProductRecord.objects.update(date_updated=self.products[0].date_updated)  # identical timestamps
+        token, seen, more = None, [], True
+        while more:
+            payload = self.sync(token, limit=2)
+            seen += [row["id"] for row in self.rows(payload, "products")]
+            token, more = payload["token"], payload["more"]
+        self.assertEqual(seen, [product.pk for product in self.products])
+
+    def test_invalid_token(self):
+        response = self.client.get(reverse("sync-list"), {"token": "garbage"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_rows_committed_late_are_sent_again(self):
+        ProductRecord.objects.update(date_updated=timezone.now() - timedelta(minutes=5))
+        self.products[0].save()
+        first = self.sync()
+        ProductRecord.objects.filter(pk=self.products[1].pk).update(  # saved before the sync, committed after it
+            name="Late", date_updated=timezone.now() - timedelta(seconds=30))
+        self.assertEqual([row["name"] for row in self.rows(self.sync(first["token"]), "products")], [])
+        with mock.patch("main.sync.SYNC_SAFETY_LAG", 60):
+            first = self.sync()
+            ProductRecord.objects.filter(pk=self.products[2].pk).update(
+                name="Later", date_updated=timezone.now() - timedelta(seconds=20))
+            names = [row["name"] for row in self.rows(self.sync(first["token"]), "products")]
+        self.assertEqual(names, ["Late", "Later", "Handset 0"])
+
+    def test_deletions_committed_late_are_sent_again(self):
+        pks = [product.pk for product in self.products[3:]]
+        for product in self.products[3:]:
+            product.delete()
+        late = SyncTombstone.objects.filter(object_id=pks[0])
+        tombstone = late.values("id", "name", "object_id").get()
+
+        def commit(seconds_ago):  # the tombstone of the first deletion, saved before the sync
+            SyncTombstone.objects.create(**tombstone)
+            late.update(date_deleted=timezone.now() - timedelta(seconds=seconds_ago))
+
+        late.delete()
+        first = self.sync()
+        commit(30)
+        self.assertEqual(self.sync(first["token"])["deleted"], {})
+        with mock.patch("main.sync.SYNC_SAFETY_LAG", 60):
+            late.delete()
+            first = self.sync()
+            commit(20)
+            deleted = self.sync(first["token"])["deleted"]
+        self.assertEqual(deleted, {"products": pks})
@@ -1,8 +1,12 @@
 # coding=utf-8
+import hashlib
+import json
 from decimal import Decimal
+from io import BytesIO
 
+from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen.canvas import Canvas
-from reportlab.platypus import Table
+from reportlab.platypus import Table, TableStyle
 from reportlab.lib.pagesizes import A4, A5
 from reportlab.lib.units import cm
 from django.http import HttpResponse
@@ -11,6 +15,7 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
 from core_settings import settings
+from main import pricing
 
 # setup unicode fonts
 pdfmetrics.registerFont(TTFont('Vera', 'Vera.ttf'))
@@ -20,27 +25,28 @@ pdfmetrics.registerFont(TTFont('VeraBI', 'VeraBI.ttf'))
 
 
 def format_currency(amount, tax=None):
-    if tax:
-        amount -= amount * Decimal(tax/100)
+    if tax:  # the taxable value of the tax inclusive amount
+        amount = pricing.in_rupees(pricing.taxable(pricing.paise(amount), tax))
     return "{} {:.2f} {}".format(
         settings.INV_CURRENCY_SYMBOL, amount, ""
     )
 
 
-def pdf_response(draw_funk, file_name, *args, **kwargs):
+def pdf_response(draw_funk, file_name, *args, disposition="attachment", **kwargs):
+    """ Render straight into the response body, without a file on disk """
     response = HttpResponse(content_type="application/pdf")
-    response["Content-Disposition"] = "attachment; filename=\"%s\"" % file_name
+    response["Content-Disposition"] = "%s; filename=\"%s\"" % (disposition, file_name)
     draw_funk(response, *args, **kwargs)
     return response
 
 
-def draw_header(canvas):
-    """ Draws the invoice header """
+def draw_header(canvas, logo=None):
+    """ Draws the invoice header, ``logo`` defaults to reading ``INV_LOGO`` """
     canvas.setStrokeColorRGB(0.9, 0.5, 0.2)
     canvas.setFillColorRGB(0.2, 0.2, 0.2)
     canvas.setFont('Helvetica', 16)
     canvas.drawString(18 * cm, -1 * cm, 'Invoice')
-    canvas.drawInlineImage(settings.INV_LOGO, 1 * cm, -1 * cm, 25, 25)  # LOGO SIZE : 25x25
+    canvas.drawImage(logo or settings.INV_LOGO, 1 * cm, -1 * cm, 25, 25, mask='auto')  # LOGO SIZE : 25x25
     canvas.setLineWidth(4)
     canvas.line(0, -1.25 * cm, 21.7 * cm, -1.25 * cm)
 
@@ -91,89 +97,238 @@ def draw_footer(canvas):
     canvas.drawText(textobject)
 
 
+def company_details():
+    """ Company settings printed on every invoice """
+    return [
+        settings.COMPANY_TITLE, settings.COMPANY_ADDRESS_LINE_ONE, settings.COMPANY_ADDRESS_LINE_TWO,
+        settings.COMPANY_COUNTRY, settings.COMPANY_CONTACT_NUMBER, settings.COMPANY_EMAIL, settings.COMPANY_WEBSITE,
+        settings.GST_NUMBER, settings.INV_CURRENCY, settings.INV_CURRENCY_SYMBOL, settings.INV_LOGO,
+        os.path.getmtime(settings.INV_LOGO) if os.path.exists(settings.INV_LOGO) else None,
+    ]
+
+
+class Letterhead(object):
+    """
+    Static part of every invoice page: header with logo, business address
+    and footer. The logo is decoded once per process and the letterhead is
+    drawn once per document as a form the pages reuse; both are rebuilt
+    when :func:`company_details` change.
+    """
+    def __init__(self):
+        self._state = (None, None, None)
+
+    def prepare(self):
+        """ ``(form name, logo)`` of the current company settings """
+        details, name, logo = self._state
+        current = company_details()
+        if current != details:
+            digest = hashlib.sha1(json.dumps(current, default=str).encode("utf-8")).hexdigest()
+            name, logo = "Letterhead{}".format(digest[:12]), ImageReader(settings.INV_LOGO)
+            self._state = (current, name, logo)
+        return name, logo
+
+    def draw(self, canvas):
+        """ Draws the letterhead on the current page of ``canvas``, translated to the page top """
+        name, logo = self.prepare()
+        if not canvas.hasForm(name):
+            canvas.beginForm(name, lowery=-29.7 * cm, upperx=21 * cm, uppery=0)
+            for draw in (lambda c: draw_header(c, logo), draw_footer, draw_address):
+                canvas.saveState()
+                draw(canvas)
+                canvas.restoreState()
+            canvas.endForm()
+        canvas.doForm(name)
+
+
+letterhead = Letterhead()
+
+ITEM_HEADER = ['Qty.', 'Item', "Unit\nPrice", "Discount", "Tax\nRate", "Tax\nType", "Tax\nAmount", "Net\nAmount",
+               'Total\nAmount']
+ITEM_COLUMNS = [1 * cm, 6.000 * cm, 2.00 * cm, 2.000 * cm, 1.000 * cm, 1.500 * cm, 2.00 * cm, 2.00 * cm, 2.00 * cm]
+ITEM_TABLE_TOP = -8 * cm
+ITEM_TABLE_HEIGHT = 18 * cm  # down to the footer
+
+ITEM_TABLE_STYLE = TableStyle([
+    # table header style
+    ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    ('BACKGROUND', (0, 0), (-1, 0), (0.8, 0.8, 0.8)),
+    # table content style
+    ('FONT', (0, 1), (-1, -1), 'Vera'),
+    ('FONTSIZE', (0, 1), (-1, -1), 8),
+    ('TEXTCOLOR', (0, 0), (-1, -1), (0.2, 0.2, 0.2)),
+    ('GRID', (0, 0), (-1, -2), 1, (0.7, 0.7, 0.7)),
+    ('GRID', (-2, -1), (-1, -1), 1, (0.7, 0.7, 0.7)),
+    ('ALIGN', (-2, 0), (-1, -1), 'LEFT'),
+])
+
+
+def invoice_data(invoice):
+    """ Plain snapshot of everything printed for the sale ``invoice`` """
+    customer = invoice.customer
+    address = customer.address if customer else None
+    customer_lines = [customer.name] if customer and customer.name else []
+    if address:
+        customer_lines += [line for line in (
+            address.address_one,
+            address.address_two,
+            address.city.name if address.city else None,
+            address.zip_code,
+            address.country.name if address.country else None,
+        ) if line]
+    if customer and customer.contact_number:
+        customer_lines.append(customer.contact_number.as_international)
+
+    if 'items' in getattr(invoice, '_prefetched_objects_cache', {}):
+        lines = list(invoice.items.all())
+    else:
+        lines = list(invoice.items.select_related('cost'))
+    for item in lines:
+        if item.mrp is None:  # saved before terms were kept on lines
+            item.take_terms()
+    amounts = pricing.price_lines([item.pricing_terms for item in lines])  # the whole bill in one pass
+    items, line_totals = [], []
+    for item, amount in zip(lines, map(pricing.in_rupees, amounts)):
+        line_totals.append(amount.total)
+        items.append([
+            item.quantity,
+            item.cost.split_name(6 * 5),
+            format_currency(amount.unit_taxable),
+            "-₹{}".format(amount.unit_discount),
+            "{} %".format(item.tax_rate),
+            '\n'.join(item.get_tax_type_display().split("/")),
+            format_currency(amount.unit_tax),
+            format_currency(amount.unit_price),
+            format_currency(amount.total)
+        ])
+    return {
+        'invoice_id': invoice.invoice_id,
+        'sale_date': invoice.printable_sale_date,
+        'customer_name': customer.name if customer else "",
+        'customer_lines': customer_lines,
+        'items': items,
+        'line_totals': line_totals,
+        'total': format_currency(pricing.in_rupees(pricing.bill_amounts(amounts).total)),
+    }
+
+
+def invoice_fingerprint(data):
+    """ Hash of an invoice snapshot and the company settings it is printed with """
+    content = json.dumps([data, company_details()], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def invoice_file_name(invoice):
+    """ File name of the :func:`invoice_data` snapshot ``invoice`` """
+    return "{}_{}.pdf".format(str(invoice['invoice_id']).replace("/", "-"), invoice['sale_date'])
+
+
 def draw_pdf(buffer, invoice):
-    """ Draws the invoice """
+    """ Draws the invoice, ``invoice`` is a sale or its :func:`invoice_data` """
+    draw_invoices(buffer, [invoice])
+
+
+def draw_invoices(buffer, invoices):
+    """ Draws each invoice starting on a new page of a single document """
     canvas = Canvas(buffer, pagesize=A4)
-    canvas.translate(0, 29.7 * cm)
-    canvas.setFont('Helvetica', 10)
+    for invoice in invoices:
+        if not isinstance(invoice, dict):
+            invoice = invoice_data(invoice)
+        draw_invoice(canvas, invoice)
+        canvas.showPage()
+    canvas.save()
+
+
+def render_invoice(invoice):
+    """ Rendered PDF of the :func:`invoice_data` snapshot ``invoice`` """
+    buffer = BytesIO()
+    draw_pdf(buffer, invoice)
+    return buffer.getvalue()
 
-    canvas.saveState()
-    draw_header(canvas)
-    canvas.restoreState()
 
-    canvas.saveState()
-    draw_footer(canvas)
-    canvas.restoreState()
+def summary_row(label, amount):
+    return ['', '', '', '', '', '', '', label, amount]
 
-    canvas.saveState()
-    draw_address(canvas)
-    canvas.restoreState()
+
+def paginate_items(canvas, invoice):
+    """
+    Split the item rows of ``invoice`` into pages, returns the row heights
+    and the ``(start, end)`` row range of each page. Every row is measured
+    once, so this is linear in the number of items.
+    """
+    rows = invoice['items']
+    table = Table([ITEM_HEADER] + rows + [summary_row('Carried\nforward:', invoice['total'])],
+                  colWidths=ITEM_COLUMNS)
+    table.setStyle(ITEM_TABLE_STYLE)
+    table.wrapOn(canvas, 19 * cm, ITEM_TABLE_HEIGHT)
+    heights = table._rowHeights
+    header, summary = heights[0], heights[-1]
+
+    pages, start, used = [], 0, header + summary
+    for index, height in enumerate(heights[1:-1]):
+        if used + height > ITEM_TABLE_HEIGHT and index > start:
+            pages.append((start, index))
+            start, used = index, header + 2 * summary  # brought and carried forward
+        used += height
+    pages.append((start, len(rows)))
+    return heights, pages
+
+
+def draw_invoice_page(canvas, invoice, page, pages):
+    """ Draws letterhead, client and invoice details of one page of ``invoice`` """
+    canvas.translate(0, 29.7 * cm)
+    canvas.setFont('Helvetica', 10)
+
+    letterhead.draw(canvas)
 
     # Client address
     textobject = canvas.beginText(1.5 * cm, -2.5 * cm)
-    contact_name = invoice.customer.name
-    contact_number = invoice.customer.contact_number.as_international
-    if contact_name:
-        textobject.textLine(contact_name)
-    if invoice.customer.address:
-        if invoice.customer.address.address_one:
-            textobject.textLine(invoice.customer.address.address_one)
-        if invoice.customer.address.address_two:
-            textobject.textLine(invoice.customer.address.address_two)
-        if invoice.customer.address.city:
-            textobject.textLine(invoice.customer.address.city.name)
-        # if invoice.customer.address.state:
-        #     textobject.textLine(invoice.address.state.name)
-        if invoice.customer.address.zip_code:
-            textobject.textLine(invoice.customer.address.zip_code)
-        if invoice.customer.address.country:
-            textobject.textLine(invoice.customer.address.country.name)
-    if contact_number:
-        textobject.textLine(contact_number)
+    for line in invoice['customer_lines']:
+        textobject.textLine(line)
     canvas.drawText(textobject)
 
     # Info
     textobject = canvas.beginText(1.5 * cm, -6.75 * cm)
-    textobject.textLine(u'Invoice ID: %s' % invoice.invoice_id)
-    textobject.textLine(u'Invoice Date: %s' % invoice.printable_sale_date)
-    textobject.textLine(u'Client: %s' % invoice.customer.name)
+    textobject.textLine(u'Invoice ID: %s' % invoice['invoice_id'])
+    textobject.textLine(u'Invoice Date: %s' % invoice['sale_date'])
+    textobject.textLine(u'Client: %s' % invoice['customer_name'])
+    if pages > 1:
+        textobject.textLine(u'Page: %s of %s' % (page, pages))
     canvas.drawText(textobject)
 
-    # Items
-    data = [['Qty.', 'Item', "Unit\nPrice", "Discount", "Tax\nRate", "Tax\nType", "Tax\nAmount", "Net\nAmount", 'Total\nAmount'], ]
-    col_size = [1 * cm, 6.000 * cm, 2.00 * cm, 2.000 * cm, 1.000 * cm, 1.500 * cm, 2.00 * cm, 2.00 * cm, 2.00 * cm]
-    for item in invoice.items.all():
-        data.append([
-            item.quantity,
-            item.cost.split_name(6 * 5),
-            format_currency(item.product_amount - item.tax_amount),
-            "-₹{}".format(item.calculate_discount),
-            "{} %".format(item.cost.tax),
-            '\n'.join(item.cost.get_tax_type_display().split("/")),
-            format_currency(item.tax_amount),
-            format_currency(item.get_effective_cost),
-            format_currency(item.get_total_effective_cost)
-        ])
-    data.append(['', '', '', '', '', '', '', 'Total:', format_currency(invoice.get_total)])
-    table = Table(data, colWidths=col_size)  # 22 cm total
-    table.setStyle([
-        # table header style
-        ('FONT', (0, 0), (-1, -1), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BACKGROUND', (0, 0), (-1, 0), (0.8, 0.8, 0.8)),
-        # table content style
-        ('FONT', (0, 1), (-1, -1), 'Vera'),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-        ('TEXTCOLOR', (0, 0), (-1, -1), (0.2, 0.2, 0.2)),
-        ('GRID', (0, 0), (-1, -2), 1, (0.7, 0.7, 0.7)),
-        ('GRID', (-2, -1), (-1, -1), 1, (0.7, 0.7, 0.7)),
-        ('ALIGN', (-2, 0), (-1, -1), 'LEFT'),
-    ])
-    tw, th, = table.wrapOn(canvas, 15 * cm, 22 * cm)  # 19 cm by default
-    table.drawOn(canvas, 0.6 * cm, -8 * cm - th)
-
-    canvas.showPage()
-    canvas.save()
+
+def draw_invoice(canvas, invoice):
+    """
+    Draws the :func:`invoice_data` snapshot ``invoice`` on as many pages of
+    ``canvas`` as its items need, repeating the table header and carrying
+    the subtotal forward from page to page
+    """
+    items = invoice['items']
+    heights, pages = paginate_items(canvas, invoice)
+    header, summary = heights[0], heights[-1]
+    subtotal = Decimal(0)
+    for page, (start, end) in enumerate(pages, 1):
+        if page > 1:
+            canvas.showPage()
+        draw_invoice_page(canvas, invoice, page, len(pages))
+
+        data, row_heights = [ITEM_HEADER], [header]
+        if start:
+            data.append(summary_row('Brought\nforward:', format_currency(subtotal)))
+            row_heights.append(summary)
+        data.extend(items[start:end])
+        row_heights.extend(heights[start + 1:end + 1])
+        if end < len(items):
+            subtotal += sum(invoice['line_totals'][start:end])
+            data.append(summary_row('Carried\nforward:', format_currency(subtotal)))
+        else:
+            data.append(summary_row('Total:', invoice['total']))
+        row_heights.append(summary)
+
+        table = Table(data, colWidths=ITEM_COLUMNS, rowHeights=row_heights)  # 22 cm total
+        table.setStyle(ITEM_TABLE_STYLE)
+        tw, th, = table.wrapOn(canvas, 19 * cm, ITEM_TABLE_HEIGHT)
+        table.drawOn(canvas, 0.6 * cm, ITEM_TABLE_TOP - th)
 
 
 if __name__ == "__main__":
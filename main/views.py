@@ -1,5 +1,153 @@
 # coding=utf-8
 __author__ = "Gahan Saraiya"
+import hashlib
+from calendar import timegm
+from collections import OrderedDict
+
+from django.db.models import Count, Max
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date, quote_etag
+from rest_framework import status, viewsets
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from core_settings.settings import SYNC_BATCH_SIZE
+from main import api_cache, sync
+from main.models import SyncTombstone, ageing_buckets
+from main.renderers import CSVRenderer
+
+__all__ = ["AgeingReportMixin", "BulkCreateMixin", "CachedListMixin", "FlatListMixin", "SyncViewSet"]
+
+
+class BulkCreateMixin(object):
+    """
+    Adds ``POST <route>/bulk/`` taking one bill or a list of bills with
+    nested ``items``, all created in a single transaction
+    """
+    bulk_serializer_class = None
+
+    @list_route(methods=["post"])
+    def bulk(self, request):
+        many = isinstance(request.data, list)
+        serializer = self.bulk_serializer_class(data=request.data, many=many,
+                                                context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class FlatListMixin(object):
+    """
+    List endpoint reading ``values()`` rows of only the requested columns
+    and serializing them with ``FlatSerializerMixin.flat_data``. Falls back
+    to the regular list when the serializer can not be flattened.
+    """
+    def list(self, request, *args, **kwargs):
+        serializer = self.get_serializer()
+        columns = serializer.flat_columns() if hasattr(serializer, "flat_columns") else None
+        if columns is None:
+            return super().list(request, *args, **kwargs)
+        ordering = [name.lstrip("-") for name in getattr(self.paginator, "ordering", ())]
+        rows = self.filter_queryset(self.get_queryset()).values(*set(columns + ordering + ["id"]))
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(serializer.flat_data(page))
+        return Response(serializer.flat_data(rows))
+
+
+class CachedListMixin(object):
+    """
+    Conditional and cached list endpoint. The ETag hashes the newest
+    ``date_updated``, the row count and the newest deletion of the listed
+    rows; a matching ``If-None-Match`` or ``If-Modified-Since`` is answered
+    with 304 before anything is serialized. Responses are kept in
+    :mod:`main.api_cache` until a row of the model is saved or deleted.
+    """
+    def list_validators(self, request):
+        """ ``(etag, last modified timestamp)`` of the list at ``request`` """
+        queryset = self.filter_queryset(self.get_queryset())
+        state = queryset.aggregate(updated=Max('date_updated'), count=Count('pk'))
+        names = [name for name, (model, fields, many) in sync.collections.items() if model is queryset.model]
+        deleted = SyncTombstone.objects.filter(name__in=names).aggregate(deleted=Max('date_deleted'))['deleted']
+        modified = max(filter(None, [state['updated'], deleted]), default=None)
+        etag = hashlib.md5("{}|{}|{}|{}".format(state['updated'], state['count'], deleted,
+                                                request.get_full_path()).encode()).hexdigest()
+        return etag, modified and timegm(modified.utctimetuple())
+
+    def list(self, request, *args, **kwargs):
+        key = api_cache.key(self.get_queryset().model, request.build_absolute_uri())
+        cached = api_cache.lookup(key)
+        etag, modified = cached[:2] if cached else self.list_validators(request)
+        response = get_conditional_response(request, etag=quote_etag(etag), last_modified=modified)
+        if response is None:
+            if cached:
+                response = Response(cached[2])
+            else:
+                response = super().list(request, *args, **kwargs)
+                if response.status_code == status.HTTP_200_OK:
+                    api_cache.store(key, (etag, modified, response.data))
+        response['ETag'] = quote_etag(etag)
+        if modified:
+            response['Last-Modified'] = http_date(modified)
+        return response
+
+
+class AgeingReportMixin(object):
+    """
+    List of the outstanding balance per ``party`` in ageing buckets at the
+    ``as_of`` date, today by default, also exported by ``?format=csv``.
+    Reports are cached until a row of one of ``cache_models`` changes.
+    """
+    renderer_classes = list(api_settings.DEFAULT_RENDERER_CLASSES) + [CSVRenderer]
+    report_name = None
+    party = None
+    cache_models = ()
+
+    def balances(self, as_of):
+        """ ``BaseBillQuerySet.ageing`` rows at ``as_of`` """
+        raise NotImplementedError
+
+    def list(self, request):
+        try:
+            as_of = parse_date(request.query_params["as_of"]) if "as_of" in request.query_params \
+                else timezone.localdate()
+        except ValueError:
+            as_of = None
+        if as_of is None:
+            raise ValidationError({"as_of": "Expected a date as YYYY-MM-DD"})
+        key = api_cache.key(self.cache_models[0], "{}?as_of={}".format(request.path, as_of), *self.cache_models[1:])
+        rows = api_cache.lookup(key)
+        if rows is None:
+            buckets = [name for name, first, last in ageing_buckets()]
+            rows = [OrderedDict([(self.party, row[self.party]), ("name", row[self.party + "__name"]),
+                                 ("bills", row["bills"])] + [(name, row[name]) for name in buckets + ["total"]])
+                    for row in self.balances(as_of)]
+            api_cache.store(key, rows)
+        response = Response(rows)
+        if request.accepted_renderer.format == CSVRenderer.format:
+            response["Content-Disposition"] = 'attachment; filename="{}-{}.csv"'.format(self.report_name, as_of)
+        return response
+
 
-# Create your views here.
+class SyncViewSet(viewsets.ViewSet):
+    """
+    list:
+    Rows changed and ids deleted since the `token` of a previous response, at most `limit` per collection;
+    request again with the new token while `more` is true. Without a token everything is sent with `reset`.
+    """
+    def list(self, request):
+        try:
+            limit = min(int(request.query_params.get("limit", SYNC_BATCH_SIZE)), SYNC_BATCH_SIZE)
+        except ValueError:
+            raise ValidationError({"limit": "Expected a number"})
+        if limit < 1:
+            raise ValidationError({"limit": "Expected a positive number"})
+        try:
+            return Response(sync.changes(request.query_params.get("token"), limit))
+        except sync.InvalidToken:
+            raise ValidationError({"token": "Invalid sync token, sync again without one"})
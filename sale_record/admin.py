@@ -1,10 +1,28 @@
+from io import BytesIO
+
 from django.contrib import admin
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.db.models import Case, IntegerField, Prefetch, Value, When
+from django.http import HttpResponse, StreamingHttpResponse
 from main.admin import *
+from .invoice_batch import batch_invoice_data, merge_invoices, render_invoices, zip_invoices
 from .models import *
 
 
 class CustomerDetailAdmin(BaseCustomerDetailAdmin):
-    pass
+    def get_search_results(self, request, queryset, search_term):
+        """ Ranked full-text search over name, numbers, address and IMEIs """
+        if not search_term:
+            return queryset, False
+        ids = CustomerSearchDocument.objects.search(search_term)
+        rank = Case(*[When(pk=pk, then=Value(index)) for index, pk in enumerate(ids)],
+                    default=Value(len(ids)), output_field=IntegerField())
+        return queryset.filter(pk__in=ids).annotate(search_rank=rank), False
+
+    def get_ordering(self, request):
+        if request.GET.get(SEARCH_VAR):
+            return ["search_rank"]
+        return super().get_ordering(request)
 
 
 class BaseSaleEffectiveCostAdmin(admin.ModelAdmin):
@@ -17,11 +35,12 @@ class BaseSaleEffectiveCostAdmin(admin.ModelAdmin):
 
 class SaleRecordAdmin(BaseSaleRecordAdmin):
     search_fields = ["name", "address"]
-    list_display = ["id", "invoice_id", "sale_date", "get_items",
+    list_display = ["id", "invoice_id", "sale_date", "get_items", "get_bill_amount",
                     "payment_mode", "customer", "get_reference_id"
                     ]
     list_filter = ["cancelled"]
     readonly_fields = ["get_total", "get_reference_id"]
+    actions = ["download_invoices", "download_merged_invoices", "cancel_sales"]
     fieldsets = (
         (None, {'fields': ["invoice_id", "sale_date", "cancelled"]}),
         ("Items", {'fields': ["items"]}),
@@ -40,6 +59,50 @@ class SaleRecordAdmin(BaseSaleRecordAdmin):
             return self.add_fieldsets
         return super().get_fieldsets(request, obj)
 
+    def get_queryset(self, request):
+        items = SaleEffectiveCost.objects.select_related('cost')
+        return super().get_queryset(request).select_related('customer').prefetch_related(
+            Prefetch('items', queryset=items))
+
+    @staticmethod
+    def selected_invoices(queryset):
+        return batch_invoice_data(SaleRecord.objects.filter(pk__in=queryset.values('pk')))
+
+    def download_invoices(self, request, queryset):
+        response = StreamingHttpResponse(zip_invoices(render_invoices(self.selected_invoices(queryset))),
+                                         content_type="application/zip")
+        response["Content-Disposition"] = "attachment; filename=\"invoices.zip\""
+        return response
+
+    def download_merged_invoices(self, request, queryset):
+        buffer = BytesIO()
+        merge_invoices(buffer, self.selected_invoices(queryset))
+        response = HttpResponse(buffer.getvalue(), content_type="application/pdf")
+        response["Content-Disposition"] = "attachment; filename=\"invoices.pdf\""
+        return response
+
+    def cancel_sales(self, request, queryset):
+        cancelled = queryset.cancel()
+        self.message_user(request, "Cancelled {} sales, their items are back in stock".format(cancelled))
+
+    download_invoices.short_description = "Download invoices of selected sales (ZIP)"
+    download_merged_invoices.short_description = "Download invoices of selected sales (single PDF)"
+    cancel_sales.short_description = "Cancel selected sales and restore their stock"
+
+
+class SalesRollupAdmin(admin.ModelAdmin):
+    list_display = ["day", "dimension", "key", "sales", "units", "gross", "discount", "tax", "total"]
+    list_filter = ["dimension", "day"]
+    search_fields = ["key"]
+    date_hierarchy = "day"
+    readonly_fields = ["day", "dimension", "key", "sales", "units", "gross", "discount", "tax"]
+
+    def has_add_permission(self, *args, **kwargs):
+        return False
+
+    def has_delete_permission(self, *args, **kwargs):
+        return False
+
 
 admin.site.register(City)
 admin.site.register(State)
@@ -49,3 +112,5 @@ admin.site.register(CustomerDetail, CustomerDetailAdmin)
 admin.site.register(SaleRecord, SaleRecordAdmin)
 admin.site.register(SaleEffectiveCost)
 admin.site.register(PathMapping)
+admin.site.register(InvoiceSequence)
+admin.site.register(SalesRollup, SalesRollupAdmin)
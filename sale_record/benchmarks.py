@@ -0,0 +1,405 @@
+# coding=utf-8
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from decimal import Decimal
+from io import BytesIO
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Q, Sum
+from django.db.models.functions import TruncMonth
+from django.db.models.signals import m2m_changed
+
+from core_settings.settings import CUSTOMER_SEARCH_LIMIT
+from inventory_management.management.commands.reconcile_stock import expected_stock
+from inventory_management.models import Distributor, EffectiveCost, ProductRecord, PurchaseRecord, StockMovement
+from main import pricing
+from main.benchmark import measure, register, report
+from main.invoice_cache import InvoiceCache
+from main.utils import draw_pdf, invoice_data, render_invoice
+from sale_record import gst, models as sale_models
+from sale_record.invoice_batch import batch_invoice_data, merge_invoices, render_invoices, zip_invoices
+from sale_record.models import *
+
+__author__ = "Gahan Saraiya"
+
+
+def make_catalogue(count, stock=0):
+    ProductRecord.objects.bulk_create([
+        ProductRecord(name="Handset {}".format(i), price=Decimal("9999.00") + i, launched_by="Brand {}".format(i % 10),
+                      available_stock=stock, hsn_code="8517", tax=[5, 12, 18, 28][i % 4], tax_type=1 + i % 2)
+        for i in range(count)])
+    return list(ProductRecord.objects.order_by('-pk')[:count])
+
+
+def make_sale(products, quantity=1, **kwargs):
+    kwargs.setdefault('invoice_id', "BENCH")
+    kwargs.setdefault('payment_mode', 1)
+    kwargs.setdefault('customer', CustomerDetail.objects.create(name="Customer", contact_number="+919988776655"))
+    sale = SaleRecord.objects.create(**kwargs)
+    sale.items.add(*[SaleEffectiveCost.objects.create(cost=product, quantity=quantity, discount=5)
+                     for product in products])
+    return sale
+
+
+def make_history(size, products, days, lines_per_sale=4):
+    """ ``size`` sale lines of ``products`` in bulk, spread over ``days`` days from 2016-01-01 """
+    Through = SaleRecord.items.through
+    for offset in range(0, size, 10000):
+        count = min(10000, size - offset)
+        SaleRecord.objects.bulk_create([
+            SaleRecord(invoice_id=str(offset + i), payment_mode=1 + i % 5,
+                       sale_date=datetime.date(2016, 1, 1) + datetime.timedelta(days=(offset + i) * days // size))
+            for i in range(0, count, lines_per_sale)])
+        sales = list(SaleRecord.objects.order_by('-pk').values_list('pk', flat=True)[
+                     :(count + lines_per_sale - 1) // lines_per_sale])[::-1]
+        SaleEffectiveCost.objects.bulk_create(SaleEffectiveCost.take_terms_of_products([
+            SaleEffectiveCost(cost=products[(offset + i) % len(products)], quantity=1, discount=5)
+            for i in range(count)]))
+        lines = list(SaleEffectiveCost.objects.order_by('-pk').values_list('pk', flat=True)[:count])[::-1]
+        Through.objects.bulk_create([Through(salerecord_id=sales[i // lines_per_sale], saleeffectivecost_id=line)
+                                     for i, line in enumerate(lines)])
+
+
+def legacy_update_stock(sender, instance, action, **kwargs):
+    """The per-item read-modify-write receiver the ledger replaced"""
+    if action == "post_add":
+        for item in instance.items.all():
+            item.cost.available_stock -= item.quantity
+            item.cost.save()
+
+
+@contextmanager
+def legacy_receiver():
+    m2m_changed.disconnect(sender=SaleRecord.items.through, dispatch_uid="update_stock_count")
+    m2m_changed.connect(legacy_update_stock, sender=SaleRecord.items.through, dispatch_uid="legacy_update_stock")
+    try:
+        yield
+    finally:
+        m2m_changed.disconnect(sender=SaleRecord.items.through, dispatch_uid="legacy_update_stock")
+        m2m_changed.connect(sale_models.update_stock, sender=SaleRecord.items.through,
+                            dispatch_uid="update_stock_count")
+
+
+def _bill_worker(product_id, bills):
+    retries = 0
+    try:
+        for _ in range(bills):
+            while True:
+                try:
+                    with transaction.atomic():
+                        sale = SaleRecord.objects.create(invoice_id="BENCH", payment_mode=1)
+                        sale.items.add(SaleEffectiveCost.objects.create(cost_id=product_id, quantity=1))
+                    break
+                except OperationalError:  # sqlite: database is locked
+                    retries += 1
+        return retries
+    finally:
+        connection.close()
+
+
+def _concurrent_billing(out, label, product, threads, bills):
+    ProductRecord.objects.filter(pk=product.pk).update(available_stock=threads * bills)
+    with measure(count_queries=False) as result:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            retries = sum(pool.map(_bill_worker, [product.pk] * threads, [bills] * threads))
+    report(out, label, result['seconds'], count=threads * bills, unit="bills")
+    product.refresh_from_db()
+    out.write("    lost updates: {}, lock retries: {}".format(product.available_stock, retries))
+
+
+@register("stock", size=200)
+def stock_ledger(out, size):
+    """Queries per bill and concurrent billing throughput of the stock ledger"""
+    products = make_catalogue(50, stock=10 ** 6)
+    for lines in (1, 10, 50):
+        for label, receiver in (("ledger", ExitStack), ("legacy", legacy_receiver)):
+            sale = SaleRecord.objects.create(invoice_id="BENCH", payment_mode=1)
+            items = [SaleEffectiveCost.objects.create(cost=product, quantity=1) for product in products[:lines]]
+            with receiver():
+                with measure() as result:
+                    sale.items.add(*items)
+            report(out, "{}: bill with {} lines".format(label, lines), result['seconds'], queries=result['queries'])
+
+    threads = 4
+    _concurrent_billing(out, "ledger: {} counters x {} bills".format(threads, size), products[0], threads, size)
+    with legacy_receiver():
+        _concurrent_billing(out, "legacy: {} counters x {} bills".format(threads, size), products[1], threads, size)
+    out.write("  ledger rows: {}".format(StockMovement.objects.count()))
+
+
+@register("invoice_batch", size=200)
+def invoice_batch(out, size):
+    """Bulk invoice rendering throughput, sequential vs. process pool"""
+    products = make_catalogue(20)
+    for i in range(size):
+        make_sale(products[i % 15:i % 15 + 5], invoice_id=str(1000 + i))
+    with measure() as result:
+        invoices = batch_invoice_data(SaleRecord.objects.all())
+    report(out, "load {} invoices".format(size), result['seconds'], count=size, unit="invoices",
+           queries=result['queries'])
+    for workers in sorted({1, 2, os.cpu_count() or 1}):
+        with measure(count_queries=False) as result:
+            archive = sum(len(chunk) for chunk in zip_invoices(render_invoices(invoices, workers)))
+        report(out, "zip, {} worker(s) ({} KiB)".format(workers, archive // 1024), result['seconds'],
+               count=size, unit="invoices")
+    with measure(count_queries=False) as result:
+        merge_invoices(BytesIO(), invoices)
+    report(out, "merged pdf, 1 process", result['seconds'], count=size, unit="invoices")
+
+
+def _print_invoices(render, invoices, threads):
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(map(len, pool.map(render, invoices)))
+
+
+@register("invoice_render", size=100)
+def invoice_render(out, size):
+    """Print latency of an invoice rendered to disk vs. in memory"""
+    products = make_catalogue(10)
+    sales = [make_sale(products[i % 5:i % 5 + 5], invoice_id=str(1000 + i)) for i in range(size)]
+    invoices = [invoice_data(sale) for sale in SaleRecord.objects.filter(
+        pk__in=[sale.pk for sale in sales])]
+    root = tempfile.mkdtemp()
+    cache = InvoiceCache(root=root)
+
+    def legacy(invoice):  # fixed file name under INV_ROOT, read back for the response
+        file_location = os.path.join(root, "invoice.pdf")
+        with open(file_location, "wb") as target:
+            draw_pdf(target, invoice)
+        with open(file_location, "rb") as source:
+            return source.read()
+
+    def cached(invoice):
+        with open(cache.get_or_render(invoice['invoice_id'], invoice)[0], "rb") as source:
+            return source.read()
+
+    try:
+        for threads in (1, 4):
+            for label, render in (("disk, shared file", legacy), ("disk cache, miss", cached),
+                                  ("disk cache, hit", cached), ("in memory", render_invoice)):
+                with measure(count_queries=False) as result:
+                    _print_invoices(render, invoices, threads)
+                report(out, "{} ({} thread(s))".format(label, threads), result['seconds'], count=size,
+                       unit="invoices")
+            shutil.rmtree(root)
+            os.makedirs(root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+@register("invoice_pages", size=1000)
+def invoice_pages(out, size):
+    """Render time and size of invoices with 10, 100 and ``size`` lines"""
+    products = make_catalogue(100)
+    for lines in sorted({10, 100, size}):
+        sale = make_sale((products * (lines // len(products) + 1))[:lines], invoice_id=str(lines))
+        invoice = invoice_data(SaleRecord.objects.get(pk=sale.pk))
+        with measure(count_queries=False) as result:
+            pdf = render_invoice(invoice)
+        report(out, "{} lines, {} pages ({} KiB)".format(lines, pdf.count(b"/Type /Page\n"), len(pdf) // 1024),
+               result['seconds'], count=lines, unit="lines")
+
+
+@register("imei", size=100000)
+def imei_lookup(out, size):
+    """IMEI lineage lookup latency against ``size`` sold lines"""
+    products = make_catalogue(20)
+    customer = CustomerDetail.objects.create(name="Customer")
+    Through = SaleRecord.items.through
+    for offset in range(0, size, 10000):
+        count = min(10000, size - offset)
+        SaleRecord.objects.bulk_create([SaleRecord(invoice_id=str(offset + i), payment_mode=1, customer=customer)
+                                        for i in range(0, count, 10)])
+        sales = list(SaleRecord.objects.order_by('-pk').values_list('pk', flat=True)[:(count + 9) // 10])[::-1]
+        SaleEffectiveCost.objects.bulk_create(SaleEffectiveCost.take_terms_of_products([
+            SaleEffectiveCost(cost=products[i % 20], quantity=1, imei="35{:013d}".format(offset + i))
+            for i in range(count)]))
+        lines = list(SaleEffectiveCost.objects.order_by('-pk').values_list('pk', flat=True)[:count])[::-1]
+        Through.objects.bulk_create([Through(salerecord_id=sales[i // 10], saleeffectivecost_id=line)
+                                     for i, line in enumerate(lines)])
+    imeis = ["35{:013d}".format(i * (size // 100)) for i in range(100)]
+    with measure() as result:
+        for imei in imeis:
+            imei_lineage([imei])
+    report(out, "single lookup, {} lines".format(size), result['seconds'] / len(imeis), queries=result['queries'])
+    with measure() as result:
+        imei_lineage(imeis)
+    report(out, "batch of {} IMEIs".format(len(imeis)), result['seconds'], count=len(imeis), unit="IMEIs",
+           queries=result['queries'])
+
+
+@register("customer_search", size=100000)
+def customer_search(out, size):
+    """Full-text customer search vs. icontains scans over ``size`` customers"""
+    cities = [City.objects.create(name=name) for name in ("Gandhinagar", "Ahmedabad", "Surat", "Rajkot", "Vadodara")]
+    for offset in range(0, size, 10000):
+        count = min(10000, size - offset)
+        Address.objects.bulk_create([Address(address_one="{} Sector {}".format(offset + i, (offset + i) % 30),
+                                             zip_code="{:06d}".format(380000 + (offset + i) % 1000),
+                                             city=cities[(offset + i) % 5]) for i in range(count)])
+        addresses = list(Address.objects.order_by('-pk').values_list('pk', flat=True)[:count])[::-1]
+        CustomerDetail.objects.bulk_create([
+            CustomerDetail(name="Customer{} Family{}".format(offset + i, (offset + i) % 997),
+                           contact_number="+9199{:08d}".format(offset + i), address_id=addresses[i])
+            for i in range(count)])
+    with measure() as result:
+        CustomerSearchDocument.objects.rebuild()
+    report(out, "index {} customers".format(size), result['seconds'], count=size, unit="customers")
+
+    def icontains(query):
+        customers = CustomerDetail.objects.all()
+        for word in query.split():
+            customers = customers.filter(Q(name__icontains=word) | Q(contact_number__icontains=word) |
+                                         Q(address__address_one__icontains=word) |
+                                         Q(address__city__name__icontains=word))
+        return list(customers.values_list('pk', flat=True)[:CUSTOMER_SEARCH_LIMIT])
+
+    for query in ("customer4217", "family12", "99000123", "surat sector", "nobody"):
+        for label, func in (("icontains", icontains), ("full-text", CustomerSearchDocument.objects.search)):
+            with measure() as result:
+                for _ in range(10):
+                    found = len(func(query))
+            report(out, "{}: {!r} ({} found)".format(label, query, found), result['seconds'] / 10)
+
+
+@register("sales_report", size=1000000)
+def sales_report(out, size):
+    """Brand by month report over ``size`` sale lines from the lines vs. the daily rollups"""
+    products = make_catalogue(200)
+    make_history(size, products, days=size // 1000)
+
+    with measure() as result:
+        rollups = SalesRollup.objects.rebuild()
+    report(out, "rebuild, {} lines".format(size), result['seconds'], count=size, unit="lines")
+
+    total = ExpressionWrapper((F('cost__price') - F('cost__price') * F('discount') / 100.0) * F('quantity'),
+                              output_field=DecimalField(max_digits=14, decimal_places=2))
+    with measure() as result:
+        rows = list(SaleEffectiveCost.objects.filter(salerecord__cancelled=False).annotate(
+            month=TruncMonth('salerecord__sale_date')).values('month', 'cost__launched_by').annotate(
+            total=Sum(total), units=Sum('quantity')).order_by('month', 'cost__launched_by'))
+    report(out, "brand by month from lines", result['seconds'], queries=result['queries'])
+    with measure() as result:
+        rows = list(SalesRollup.objects.report(SalesRollup.BRAND, "month"))
+    report(out, "brand by month from {} rollups".format(rollups), result['seconds'], queries=result['queries'])
+
+    sale = SaleRecord.objects.create(payment_mode=1)
+    with measure() as result:
+        sale.items.add(*[SaleEffectiveCost.objects.create(cost=product, quantity=1) for product in products[:3]])
+        sale.cancelled = True
+        sale.save()
+    report(out, "record and cancel a 3 line sale", result['seconds'], queries=result['queries'])
+
+
+def _drain(chunks, traced=False):
+    """ Bytes of ``chunks`` and the peak of memory allocated meanwhile when ``traced`` """
+    if traced:
+        tracemalloc.start()
+    size = sum(len(chunk) for chunk in chunks)
+    peak = tracemalloc.get_traced_memory()[1] if traced else 0
+    if traced:
+        tracemalloc.stop()
+    return size, peak
+
+
+@register("gst_export", size=1000000)
+def gst_export(out, size):
+    """GST summaries and line by line export of a year of ``size`` sale lines"""
+    make_history(size, make_catalogue(200), days=365)
+    year, month = (datetime.date(2016, 1, 1), datetime.date(2016, 12, 31)), \
+        (datetime.date(2016, 1, 1), datetime.date(2016, 1, 31))
+
+    with measure() as result:
+        totals = {}
+        sales = SaleRecord.objects.filter(sale_date__range=month, cancelled=False).prefetch_related('items__cost')
+        for sale in sales:
+            for line in sale.items.all():
+                row = totals.setdefault((line.cost.hsn_code, line.cost.tax, line.cost.tax_type), [0] * 6)
+                amounts = line.amounts
+                for index, amount in enumerate((line.quantity, amounts.total, amounts.taxable, amounts.igst,
+                                                amounts.cgst, amounts.sgst)):
+                    row[index] += amount
+    report(out, "HSN summary of a month, opening every bill", result['seconds'], queries=result['queries'])
+    for period, label in ((month, "a month"), (year, "the year")):
+        for section in ("hsn", "rate"):
+            with measure() as result:
+                rows = list(gst.SECTIONS[section](*period))
+            report(out, "{} summary of {}, grouped".format(section, label), result['seconds'],
+                   queries=result['queries'])
+
+    with measure() as result:
+        length, peak = _drain(gst.stream_csv(gst.SECTIONS["lines"](*year)))
+    report(out, "lines of the year as CSV, {:.1f} MB".format(length / 2 ** 20), result['seconds'], count=size,
+           unit="lines", queries=result['queries'])
+    for period, label in ((month, "a month"), (year, "the year")):
+        length, peak = _drain(gst.stream_csv(gst.SECTIONS["lines"](*period)), traced=True)
+        out.write("  {:<45} {:>10.1f} MB".format("peak memory, lines of {} as CSV".format(label), peak / 2 ** 20))
+
+
+@register("pricing", size=100000)
+def pricing_lines(out, size):
+    """Pricing ``size`` bill lines: the former per property formulas vs. the pricing engine"""
+    rng = random.Random(size)
+    lines = [(rng.randint(100, 10000000), rng.choice([0, 5, 10, 15]), rng.randint(1, 5), rng.choice([5, 12, 18, 28]),
+              rng.choice([1, 2])) for _ in range(size)]
+
+    def legacy(price, discount, quantity, rate):  # tax on the MRP, unrounded, and a float in the PDF column
+        price = Decimal(price) / 100
+        unit_discount = price * Decimal(discount) / 100
+        tax = price * Decimal(rate) / 100
+        return unit_discount, tax, price - price * Decimal(rate / 100), (price - unit_discount) * quantity
+
+    with measure(count_queries=False) as result:
+        former = [legacy(price, discount, quantity, rate) for price, discount, quantity, rate, tax_type in lines]
+    report(out, "former formulas, per line", result['seconds'], count=size, unit="lines")
+    with measure(count_queries=False) as result:
+        priced = pricing.price_lines(lines)
+    report(out, "pricing engine, in paise", result['seconds'], count=size, unit="lines")
+    with measure(count_queries=False) as result:
+        [pricing.in_rupees(line) for line in priced]
+    report(out, "pricing engine, converted to rupees", result['seconds'], count=size, unit="lines")
+    wrong = sum(1 for (_, tax, _, _), line in zip(former, priced)
+                if tax.quantize(Decimal("0.01")) * 100 != line.unit_tax)
+    out.write("  {:<45} {:>10}".format("lines whose former tax differs", wrong))
+
+
+@register("reconcile_stock", size=5000000)
+def reconcile_stock(out, size):
+    """Expected stock of 50k products from ``size`` purchase and sale lines, per product vs. grouped"""
+    products = make_catalogue(50000)
+    purchases = size // 5
+    distributor = Distributor.objects.create(name="Supplier")
+    Through = PurchaseRecord.items.through
+    for offset in range(0, purchases, 10000):
+        count = min(10000, purchases - offset)
+        PurchaseRecord.objects.bulk_create([PurchaseRecord(invoice_id=str(offset + i), purchased_from=distributor,
+                                                           payment_mode=1) for i in range(0, count, 100)])
+        bills = list(PurchaseRecord.objects.order_by('-pk').values_list('pk', flat=True)[:(count + 99) // 100])[::-1]
+        EffectiveCost.objects.bulk_create(EffectiveCost.take_terms_of_products([
+            EffectiveCost(cost=products[(offset + i) % len(products)], quantity=10) for i in range(count)]))
+        lines = list(EffectiveCost.objects.order_by('-pk').values_list('pk', flat=True)[:count])[::-1]
+        Through.objects.bulk_create([Through(purchaserecord_id=bills[i // 100], effectivecost_id=line)
+                                     for i, line in enumerate(lines)])
+    make_history(size - purchases, products, days=365)
+    SaleRecord.objects.filter(pk__in=SaleRecord.objects.order_by('pk').values_list('pk', flat=True)[::20]).update(
+        cancelled=True)
+
+    sample = [product.pk for product in products[:500]]
+    with measure() as result:
+        for pk in sample:
+            bought = EffectiveCost.objects.filter(purchaserecord__isnull=False, cost=pk).aggregate(
+                units=Sum('quantity'))['units'] or 0
+            sold = SaleEffectiveCost.objects.filter(salerecord__cancelled=False, cost=pk).aggregate(
+                units=Sum('quantity'))['units'] or 0
+    report(out, "per product, {} of {} products".format(len(sample), len(products)), result['seconds'],
+           count=len(sample), unit="products", queries=result['queries'])
+    with measure() as result:
+        expected = expected_stock()
+    report(out, "grouped, all products", result['seconds'], count=len(expected), unit="products",
+           queries=result['queries'])
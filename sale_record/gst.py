@@ -0,0 +1,174 @@
+# coding=utf-8
+"""
+GST return summaries of sales, GSTR-1 style.
+
+Amounts are those of :mod:`main.pricing`, rounded per unit of each line, so
+the summaries add up to the lines and the lines to the invoices: the
+summaries sum :func:`main.models.line_amounts` in SQL and the line by line
+export prices its rows with :func:`main.pricing.price_lines`.
+
+The HSN and rate summaries are single grouped queries over the lines of the
+period. The line by line export reads the lines of ``GST_EXPORT_BATCH_SIZE``
+sales at a time, walking the sales by primary key, so memory does not grow
+with the period; rows of every section are generated one by one and
+streamed as CSV or JSON.
+"""
+import csv
+import json
+from collections import OrderedDict
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Func, Sum, Value
+from django.db.models.functions import Coalesce
+
+from core_settings.settings import GST_EXPORT_BATCH_SIZE
+from main import pricing
+from main.models import line_amounts, line_terms
+from sale_record.models import SaleEffectiveCost, SaleRecord
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['SECTIONS', 'lines', 'previous_month', 'stream_csv', 'stream_json']
+
+ZERO = Decimal("0.00")
+
+
+def _split(value, tax, cgst, tax_type):
+    """ ``(taxable value, igst, cgst, sgst)`` of lines worth ``value`` with ``tax``, ``cgst`` if intra-state """
+    value, tax, cgst = [Decimal(amount or 0) for amount in (value, tax, cgst)]
+    if tax_type == pricing.IGST:
+        return value - tax, tax, ZERO, ZERO
+    return value - tax, ZERO, cgst, tax - cgst
+
+
+def previous_month(today):
+    """ First and last day of the month before ``today``, the usual return period """
+    end = today.replace(day=1) - timedelta(days=1)
+    return end.replace(day=1), end
+
+
+def lines(start, end):
+    """ Lines of the sales not cancelled from ``start`` to ``end`` """
+    return SaleEffectiveCost.objects.filter(salerecord__cancelled=False, salerecord__sale_date__gte=start,
+                                            salerecord__sale_date__lte=end)
+
+
+def _terms(queryset):
+    """ ``queryset`` with the price, rate and tax type of each line as ``line_price``, ``line_rate`` and so on """
+    return queryset.annotate(**dict(('line_' + name, term) for name, term in line_terms().items()))
+
+
+def _line(amount):
+    return ExpressionWrapper(amount * Coalesce(F('quantity'), 0),
+                             output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def _sums():
+    """ Value, tax and CGST, half of the unit tax rounded, of lines """
+    amounts = line_amounts()
+    half = Func(amounts['tax'] / Value(Decimal('2.0')), Value(2), function='ROUND',
+                output_field=DecimalField(max_digits=14, decimal_places=2))
+    return dict(value=Sum(_line(amounts['total'])), tax=Sum(_line(amounts['tax'])), half=Sum(_line(half)))
+
+
+def _supply(tax_type):
+    return "inter-state" if tax_type == pricing.IGST else "intra-state"
+
+
+def _taxes(row, tax_type):
+    taxes = _split(row['value'], row['tax'], row['half'], tax_type)
+    return list(zip(("taxable_value", "igst", "cgst", "sgst"), taxes))
+
+
+def hsn_summary(start, end):
+    """ Quantity, value and taxes per HSN code and rate """
+    rows = _terms(lines(start, end)).values('cost__hsn_code', 'line_rate', 'line_tax_type').annotate(
+        units=Coalesce(Sum('quantity'), 0), **_sums()).order_by(
+        'cost__hsn_code', 'line_rate', 'line_tax_type')
+    for row in rows:
+        rate, tax_type = row['line_rate'] or 0, row['line_tax_type']
+        yield OrderedDict([("hsn_code", row['cost__hsn_code'] or ""), ("rate", rate), ("supply", _supply(tax_type)),
+                           ("quantity", row['units']), ("value", Decimal(row['value'] or 0))]
+                          + _taxes(row, tax_type))
+
+
+def rate_summary(start, end):
+    """ Invoices, value and taxes per rate and intra or inter-state supply """
+    rows = _terms(lines(start, end)).values('line_rate', 'line_tax_type').annotate(
+        invoices=Count('salerecord', distinct=True), **_sums()).order_by('line_rate', 'line_tax_type')
+    for row in rows:
+        rate, tax_type = row['line_rate'] or 0, row['line_tax_type']
+        yield OrderedDict([("rate", rate), ("supply", _supply(tax_type)), ("invoices", row['invoices']),
+                           ("value", Decimal(row['value'] or 0))]
+                          + _taxes(row, tax_type))
+
+
+def line_details(start, end, batch_size=GST_EXPORT_BATCH_SIZE):
+    """ Invoice, HSN code, rate, value and taxes of every line, in order of the sales """
+    sales = SaleRecord.objects.filter(cancelled=False, sale_date__gte=start, sale_date__lte=end).order_by('pk')
+    queryset = _terms(SaleEffectiveCost.objects.order_by('salerecord', 'pk')).values_list(
+        'salerecord__invoice_id', 'salerecord__sale_date', 'cost__hsn_code', 'line_price', 'discount', 'quantity',
+        'line_rate', 'line_tax_type')
+    last = 0
+    while True:
+        batch = list(sales.filter(pk__gt=last).values_list('pk', flat=True)[:batch_size])
+        if not batch:
+            return
+        rows = list(queryset.filter(salerecord__in=batch))
+        priced = pricing.price_lines([(pricing.paise(price), discount, quantity, rate, tax_type)
+                                      for _, _, _, price, discount, quantity, rate, tax_type in rows])
+        for (invoice_id, sale_date, hsn_code, _, _, quantity, rate, tax_type), amounts in zip(rows, priced):
+            amounts = pricing.in_rupees(amounts)
+            yield OrderedDict([("invoice_id", invoice_id), ("sale_date", sale_date), ("hsn_code", hsn_code or ""),
+                               ("rate", rate or 0), ("supply", _supply(tax_type)), ("quantity", quantity),
+                               ("value", amounts.total), ("taxable_value", amounts.taxable), ("igst", amounts.igst),
+                               ("cgst", amounts.cgst), ("sgst", amounts.sgst)])
+        last = batch[-1]
+
+
+SECTIONS = OrderedDict([("hsn", hsn_summary), ("rate", rate_summary), ("lines", line_details)])
+
+
+class _Echo(object):
+    def write(self, value):
+        return value
+
+
+def _chunks(pieces, size=1000):
+    """ ``pieces`` joined ``size`` at a time, fewer and larger writes to the client """
+    chunk = []
+    for piece in pieces:
+        chunk.append(piece)
+        if len(chunk) == size:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def _csv_lines(rows):
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.writer(_Echo())
+            yield writer.writerow(list(row))
+        yield writer.writerow(list(row.values()))
+
+
+def _json_pieces(rows):
+    separator = "["
+    for row in rows:
+        yield separator + json.dumps(row, default=str)
+        separator = ",\n"
+    yield "[]" if separator == "[" else "]"
+
+
+def stream_csv(rows):
+    """ Chunks of the CSV lines of ``rows`` with a header of the keys of the first one """
+    return _chunks(_csv_lines(rows))
+
+
+def stream_json(rows):
+    """ Chunks of a JSON list of ``rows`` """
+    return _chunks(_json_pieces(rows))
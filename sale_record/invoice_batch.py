@@ -0,0 +1,99 @@
+# coding=utf-8
+"""
+Batch rendering of sale invoices, i.e. for month end printing.
+
+Invoice data of the whole batch is loaded with one prefetched query and
+turned into plain :func:`main.utils.invoice_data` snapshots, so that the
+worker processes only render and never touch the database.
+"""
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db.models import Prefetch
+
+from core_settings.settings import INV_BATCH_WORKERS
+from main.utils import draw_invoices, invoice_data, invoice_file_name, render_invoice
+from sale_record.models import SaleEffectiveCost
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['batch_invoice_data', 'render_invoices', 'zip_invoices', 'merge_invoices']
+
+
+def batch_invoice_data(queryset):
+    """ :func:`invoice_data` of every sale of ``queryset``, loaded in two queries """
+    items = SaleEffectiveCost.objects.select_related('cost')
+    sales = queryset.select_related(
+        'customer__address__city', 'customer__address__country').prefetch_related(
+        Prefetch('items', queryset=items)).order_by('sale_date', 'pk')
+    return [invoice_data(sale) for sale in sales]
+
+
+def render_invoices(invoices, workers=None, progress=None):
+    """
+    Yield ``(file name, pdf bytes)`` of each invoice snapshot in order,
+    rendered across ``workers`` processes (``INV_BATCH_WORKERS`` by default)
+    """
+    workers = workers or INV_BATCH_WORKERS or os.cpu_count() or 1
+    total = len(invoices)
+    if workers == 1 or total < 2:
+        rendered = map(render_invoice, invoices)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        rendered = pool.map(render_invoice, invoices, chunksize=max(1, min(16, total // (workers * 4))))
+    try:
+        for done, (invoice, pdf) in enumerate(zip(invoices, rendered), 1):
+            if progress:
+                progress(done, total)
+            yield invoice_file_name(invoice), pdf
+    finally:
+        if pool:
+            pool.shutdown()
+
+
+class _ChunkWriter(object):
+    """ Write-only file object collecting what ``zipfile`` writes to it """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data, self.chunks = b"".join(self.chunks), []
+        return data
+
+
+def zip_invoices(files):
+    """ Stream a ZIP archive of ``(file name, pdf bytes)`` as it is built """
+    writer = _ChunkWriter()
+    names = set()
+    with zipfile.ZipFile(writer, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, pdf in files:
+            base, suffix = name[:-4], 1
+            while name in names:  # same invoice id printed twice
+                suffix += 1
+                name = "{}_{}.pdf".format(base, suffix)
+            names.add(name)
+            archive.writestr(name, pdf)
+            yield writer.pop()
+    yield writer.pop()
+
+
+def merge_invoices(buffer, invoices, progress=None):
+    """
+    Draw all invoice snapshots as pages of one PDF; a single document can
+    not be split across processes so this renders in the calling process
+    """
+    def pages():
+        for done, invoice in enumerate(invoices, 1):
+            if progress:
+                progress(done, len(invoices))
+            yield invoice
+    draw_invoices(buffer, pages())
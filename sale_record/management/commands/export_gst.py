@@ -0,0 +1,36 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from sale_record import gst
+from sale_record.management.commands.generate_invoices import _date
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Write the GST summary per HSN code or rate, or the taxes of every sale line, of a period as CSV or JSON"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--section', choices=list(gst.SECTIONS), default="hsn")
+        parser.add_argument('--from', dest='date_from', type=_date,
+                            help="First sale date (YYYY-MM-DD), the first day of last month by default")
+        parser.add_argument('--to', dest='date_to', type=_date,
+                            help="Last sale date (YYYY-MM-DD), the last day of last month by default")
+        parser.add_argument('--format', choices=("csv", "json"), default="csv")
+        parser.add_argument('--output', help="Target file, standard output by default")
+
+    def handle(self, *args, **options):
+        start, end = gst.previous_month(timezone.localdate())
+        start, end = options['date_from'] or start, options['date_to'] or end
+        rows = gst.SECTIONS[options['section']](start, end)
+        chunks = gst.stream_csv(rows) if options['format'] == "csv" else gst.stream_json(rows)
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending="")
+            return
+        with open(options['output'], "w", newline="") as target:
+            for chunk in chunks:
+                target.write(chunk)
+        self.stdout.write(self.style.SUCCESS("Wrote the {} GST summary from {} to {} to {}".format(
+            options['section'], start, end, options['output'])))
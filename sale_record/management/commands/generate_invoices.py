@@ -0,0 +1,53 @@
+# coding=utf-8
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sale_record.invoice_batch import batch_invoice_data, merge_invoices, render_invoices, zip_invoices
+from sale_record.models import SaleRecord
+
+__author__ = "Gahan Saraiya"
+
+
+def _date(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    except ValueError:
+        raise CommandError("Dates must be given as YYYY-MM-DD, got {!r}".format(value))
+
+
+class Command(BaseCommand):
+    help = "Render the invoices of a date range into a ZIP archive or one merged PDF"
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help="Target file, .zip for one PDF per sale or .pdf for a merged document")
+        parser.add_argument('--from', dest='date_from', type=_date, help="First sale date (YYYY-MM-DD)")
+        parser.add_argument('--to', dest='date_to', type=_date, help="Last sale date (YYYY-MM-DD)")
+        parser.add_argument('--workers', type=int, help="Rendering processes, one per CPU by default")
+        parser.add_argument('--include-cancelled', action='store_true', dest='include_cancelled')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        if not output.endswith((".zip", ".pdf")):
+            raise CommandError("Output must be a .zip or .pdf file")
+        sales = SaleRecord.objects.all()
+        if options['date_from']:
+            sales = sales.filter(sale_date__gte=options['date_from'])
+        if options['date_to']:
+            sales = sales.filter(sale_date__lte=options['date_to'])
+        if not options['include_cancelled']:
+            sales = sales.filter(cancelled=False)
+
+        invoices = batch_invoice_data(sales)
+        with open(output, "wb") as target:
+            if output.endswith(".zip"):
+                for chunk in zip_invoices(render_invoices(invoices, options['workers'], self.progress)):
+                    target.write(chunk)
+            else:
+                merge_invoices(target, invoices, self.progress)
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS("Wrote {} invoices to {}".format(len(invoices), output)))
+
+    def progress(self, done, total):
+        self.stdout.write("\rRendered {}/{}".format(done, total), ending="")
+        self.stdout.flush()
@@ -0,0 +1,17 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from sale_record import search
+from sale_record.models import CustomerDetail, CustomerSearchDocument
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Rebuild the customer search documents and their full-text index"
+
+    def handle(self, *args, **options):
+        search.install(connection, CustomerSearchDocument._meta.db_table)
+        CustomerSearchDocument.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS("Indexed {} customers".format(CustomerDetail.objects.count())))
@@ -0,0 +1,14 @@
+# coding=utf-8
+from django.core.management.base import BaseCommand
+
+from sale_record.models import SalesRollup
+
+__author__ = "Gahan Saraiya"
+
+
+class Command(BaseCommand):
+    help = "Rebuild the daily sales rollups per brand, product and payment mode from the sale lines"
+
+    def handle(self, *args, **options):
+        rows = SalesRollup.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS("Rebuilt {} sales rollups".format(rows)))
@@ -1,20 +1,33 @@
 # coding=utf-8
 import os
+import re
+import threading
 from decimal import Decimal
+from functools import lru_cache
 
-from django.db import models
-from django.db.models.signals import m2m_changed
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce, TruncMonth, TruncYear
+from django.db.models.signals import m2m_changed, post_delete, post_migrate, post_save, pre_delete, pre_save
 from django.dispatch import receiver
 from django.urls import reverse_lazy
+from django.utils import timezone
 from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from djmoney.models.fields import MoneyField
 
+from main import api_cache, pricing, sync
 from main.models import *
-from core_settings.settings import PRODUCT_TYPE
-from inventory_management.models import ProductRecord
+from main.models import line_amounts
+from core_settings.settings import PRODUCT_TYPE, INV_NUMBER_START, INV_NUMBER_FY_PREFIX, INV_NUMBER_BLOCK_SIZE, \
+    CUSTOMER_SEARCH_LIMIT
+from inventory_management.models import ProductRecord, PurchaseRecord, StockMovement, bill_line_pairs
+from main.invoice_cache import invoice_cache
+from sale_record import search
 
-__all__ = ["CustomerDetail", "SaleRecord", "SaleEffectiveCost", "PathMapping", "Address", "City", "State", "Country"]
+__all__ = ["CustomerDetail", "SaleRecord", "SaleEffectiveCost", "PathMapping", "Address", "City", "State", "Country",
+           "InvoiceSequence", "invoice_numbers", "normalize_imei", "imei_lineage", "CustomerSearchDocument",
+           "SalesRollup", "settle_sale_stock"]
 
 __author__ = "Gahan Saraiya"
 
@@ -52,15 +65,111 @@ class Address(BaseAddress):
         return self.printable_address[:20] + "..." if len(self.printable_address) > 20 else self.printable_address
 
 
+def financial_year(date):
+    """Indian financial year (April-March) of ``date``, i.e. 2018-19"""
+    year = date.year if date.month >= 4 else date.year - 1
+    return "{}-{:02d}".format(year, (year + 1) % 100)
+
+
+class InvoiceSequenceQuerySet(models.QuerySet):
+    def reserve(self, prefix, count=1):
+        """
+        Atomically bump the counter of ``prefix`` by ``count`` and return the
+        reserved ``(first, last)`` numbers. The UPDATE row lock is held until
+        the read-back commits, so concurrent callers never share a number.
+        """
+        with transaction.atomic():
+            if not self.filter(prefix=prefix).update(last_number=F('last_number') + count):
+                try:
+                    with transaction.atomic():
+                        self.create(prefix=prefix, last_number=self.model.initial_number(prefix) + count)
+                except IntegrityError:  # created concurrently
+                    self.filter(prefix=prefix).update(last_number=F('last_number') + count)
+            last = self.filter(prefix=prefix).values_list('last_number', flat=True).get()
+        return last - count + 1, last
+
+
+class InvoiceSequence(models.Model):
+    """Last issued invoice number of each series (financial year)"""
+    prefix = models.CharField(max_length=20, unique=True, blank=True, default="")
+    last_number = models.IntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    objects = InvoiceSequenceQuerySet.as_manager()
+
+    @staticmethod
+    def format(prefix, number):
+        return "{}/{}".format(prefix, number) if prefix else str(number)
+
+    @classmethod
+    def initial_number(cls, prefix):
+        """Continue after the highest numeric invoice id already issued in the series"""
+        invoices = SaleRecord.objects.exclude(invoice_id=None)
+        if prefix:
+            invoices = invoices.filter(invoice_id__startswith=prefix + "/")
+        numbers = [int(number) for number in (invoice_id[len(prefix) + 1:] if prefix else invoice_id
+                                              for invoice_id in invoices.values_list('invoice_id', flat=True).iterator())
+                   if number.isdigit()]
+        return max(numbers) if numbers else INV_NUMBER_START - 1
+
+    def __str__(self):
+        return self.format(self.prefix, self.last_number)
+
+    class Meta:
+        verbose_name = "Invoice number sequence"
+
+
+class InvoiceNumberAllocator(object):
+    """
+    Hands out invoice numbers of the current series. With ``block_size > 1``
+    each process reserves numbers in blocks and serves them from memory;
+    unused numbers of a block are lost when the process exits.
+    """
+    def __init__(self, block_size=INV_NUMBER_BLOCK_SIZE, fy_prefix=INV_NUMBER_FY_PREFIX):
+        self.block_size = block_size
+        self.fy_prefix = fy_prefix
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def prefix(self, date=None):
+        return financial_year(date or timezone.now().date()) if self.fy_prefix else ""
+
+    def allocate(self, date=None):
+        prefix = self.prefix(date)
+        with self._lock:
+            blocks = self._blocks.get(prefix)
+            if blocks:
+                number, last = blocks[0]
+                if number < last:
+                    blocks[0] = (number + 1, last)
+                else:
+                    blocks.pop(0)
+                return InvoiceSequence.format(prefix, number)
+        number, last = InvoiceSequence.objects.reserve(prefix, self.block_size)
+        if number < last:
+            # only serve the rest of the block once the reservation is committed
+            transaction.on_commit(lambda: self._release(prefix, number + 1, last))
+        return InvoiceSequence.format(prefix, number)
+
+    def allocate_many(self, dates):
+        """ One number per date of ``dates``, reserving each series with a single update """
+        prefixes = [self.prefix(date) for date in dates]
+        numbers = {}
+        for prefix in set(prefixes):
+            first, last = InvoiceSequence.objects.reserve(prefix, prefixes.count(prefix))
+            numbers[prefix] = iter(range(first, last + 1))
+        return [InvoiceSequence.format(prefix, next(numbers[prefix])) for prefix in prefixes]
+
+    def _release(self, prefix, first, last):
+        with self._lock:
+            self._blocks.setdefault(prefix, []).append((first, last))
+
+
+invoice_numbers = InvoiceNumberAllocator()
+
+
 def increment_invoice_number():
-    last_invoice = SaleRecord.objects.all().order_by('id').last()
-    if not last_invoice:
-        return 1000
-    invoice_no = last_invoice.invoice_id
-    invoice_int = int(invoice_no)
-    new_invoice_int = invoice_int + 1
-    new_invoice_no = str(new_invoice_int)
-    return new_invoice_no
+    return invoice_numbers.allocate()
 
 
 class PathMapping(models.Model):
@@ -75,53 +184,66 @@ class PathMapping(models.Model):
         verbose_name = "Store Default path"
 
 
+def normalize_imei(value):
+    """ IMEI or barcode ``value`` without separators and in upper case, ``None`` when blank """
+    value = re.sub(r"[\s\-./]", "", value or "").upper()
+    return value or None
+
+
 class SaleEffectiveCost(BaseEffectiveCost):
     """
     This model is only to preserve effective cost of item
     """
     discount = models.IntegerField(default=0)
     cost = models.ForeignKey(ProductRecord, on_delete=models.CASCADE)
-    imei = models.CharField(max_length=30, blank=True, null=True,
+    imei = models.CharField(max_length=30, blank=True, null=True, db_index=True,
                             verbose_name=_("IMEI Number"),
                             help_text=_("Enter unique IMEI or barcode generated by Manufacturer"))
 
-    @property
-    def product_amount(self):
-        return self.cost.price.amount
+    objects = BaseEffectiveCostQuerySet.as_manager()
 
     @property
     def calculate_discount(self):
-        return (self.product_amount * Decimal(self.discount)) / 100
+        if hasattr(self, 'unit_discount'):
+            return self.unit_discount
+        return self.amounts.unit_discount
 
     @property
     def tax_amount(self):
-        if self.cost.tax:
-            return (self.product_amount * Decimal(self.cost.tax)) / 100
-        else:
-            return 0
+        if hasattr(self, 'unit_tax'):
+            return self.unit_tax
+        return self.amounts.unit_tax
 
     @property
     def get_effective_cost(self):
-        return self.product_amount - self.calculate_discount
+        if hasattr(self, 'unit_total'):
+            return self.unit_total
+        return self.amounts.unit_price
 
     @property
     def get_total_effective_cost(self):
-        return self.get_effective_cost * self.quantity
+        if hasattr(self, 'line_total'):
+            return self.line_total
+        return self.amounts.total
 
     @property
     def get_detail(self):
         return "{} >> [Disc. {}%] [MRP: {}] [Qty. {}] [item cost: {}] [total bill: {}]".format(
-            self.cost.name,  self.discount, self.cost.price, self.quantity,
+            self.cost.name,  self.discount, self.product_amount, self.quantity,
             self.get_effective_cost, self.get_total_effective_cost)
 
-    def clean(self):
-        self.cost.available_stock = self.cost.available_stock + self.quantity
+    def save(self, *args, **kwargs):
+        self.imei = normalize_imei(self.imei)
+        super().save(*args, **kwargs)
 
     def __str__(self):
-        return "{} >> [Disc. {}%] [MRP: {}] [Qty. {}]".format(self.cost.name, self.discount, self.cost.price, self.quantity)
+        return "{} >> [Disc. {}%] [MRP: {}] [Qty. {}]".format(self.cost.name, self.discount, self.product_amount, self.quantity)
 
     class Meta:
         verbose_name = verbose_name_plural = "Effective cost of " + PRODUCT_TYPE
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+        ]
 
 
 class CustomerDetail(BaseCustomer):
@@ -129,36 +251,601 @@ class CustomerDetail(BaseCustomer):
                                 verbose_name=_("Postal Address"),
                                 help_text=_("Address"))
 
+    class Meta(BaseCustomer.Meta):
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+        ]
+
+
+class SaleRecordQuerySet(BaseBillQuerySet):
+    def create_bills(self, bills):
+        """
+        Bulk create sales: number those without an invoice id, take their
+        lines out of stock with one ledger posting and index the customers
+        """
+        bills = list(bills)
+        with transaction.atomic(using=self.db):
+            unnumbered = [bill for bill, lines in bills if not bill.invoice_id]
+            for bill, invoice_id in zip(unnumbered, invoice_numbers.allocate_many(
+                    [bill.sale_date for bill in unnumbered])):
+                bill.invoice_id = invoice_id
+            for bill, lines in bills:
+                for line in lines:
+                    line.imei = normalize_imei(line.imei)
+            bills = super().create_bills(bills)
+            StockMovement.objects.post([
+                StockMovement(product_id=line.cost_id, quantity=-(line.quantity or 0), reason=StockMovement.SALE,
+                              bill_type=StockMovement.SALE_BILL, bill_id=bill.pk, line_id=line.pk)
+                for bill, lines in bills for line in lines])
+            CustomerSearchDocument.objects.rebuild({bill.customer_id for bill, lines in bills})
+            SalesRollup.objects.add_sales([bill.pk for bill, lines in bills])
+            api_cache.invalidate(SaleRecord)
+        return bills
+
+    def cancel(self):
+        """
+        Cancel the sales of the queryset not cancelled yet in one transaction
+        and a few statements for all of them: their lines go back to stock
+        and leave the sales rollups. Returns the number of sales cancelled.
+
+        The sales are locked, in order of primary key, before reading which of
+        them are still to cancel, so a concurrent cancel of the same sales
+        waits and then finds them cancelled instead of retracting them twice.
+        """
+        with transaction.atomic(using=self.db):
+            sales = [pk for pk, cancelled in self.select_for_update().order_by('pk').values_list('pk', 'cancelled')
+                     if not cancelled]
+            SalesRollup.objects.add_sales(sales, sign=-1)
+            SaleRecord._base_manager.using(self.db).filter(pk__in=sales).update(cancelled=True,
+                                                                                date_updated=timezone.now())
+            settle_sale_stock(sales)
+            api_cache.invalidate(SaleRecord)
+        for sale in sales:
+            invoice_cache.invalidate(sale)
+        return len(sales)
+
+    def outstanding(self, as_of):
+        """
+        Sales not cancelled and unpaid at ``as_of``: without a payment mode,
+        with the payment in transit or on credit until their payment date
+        """
+        return self.filter(Q(payment_mode__isnull=True) | Q(payment_status=True) | Q(
+            Q(payment_date__isnull=True) | Q(payment_date__gt=as_of), payment_mode=BaseSaleRecord.CREDIT),
+            cancelled=False)
+
+    def receivables(self, as_of):
+        """ Outstanding amount per customer in ageing buckets of the sale date """
+        return self.outstanding(as_of).ageing(['customer', 'customer__name'], 'sale_date', as_of)
+
 
 class SaleRecord(BaseSaleRecord):
-    invoice_id = models.CharField(max_length=500, default=increment_invoice_number, null=True, blank=True,
+    invoice_id = models.CharField(max_length=500, null=True, blank=True,
                                   verbose_name=_("Enter Invoice Number"),
-                                  help_text=_("Enter Order/Invoice Number"))
+                                  help_text=_("Enter Order/Invoice Number or leave blank to use the next number"))
     items = models.ManyToManyField(SaleEffectiveCost)
     customer = models.ForeignKey(CustomerDetail, null=True, blank=True, on_delete=models.CASCADE)
 
+    objects = SaleRecordQuerySet.as_manager()
+
+    @property
+    def amounts(self):
+        """ :class:`main.pricing.BillAmounts` in rupees from the terms kept on the lines, priced in one pass """
+        lines = self.items.all()
+        return pricing.in_rupees(pricing.bill_amounts(pricing.price_lines([line.pricing_terms for line in lines])))
+
     @property
     def get_total(self):
-        return sum([product.get_total_effective_cost for product in self.items.all()])
+        if hasattr(self, 'bill_total'):
+            return self.bill_total
+        return self.amounts.total
 
     @property
     def get_items(self):
         return ' | \n'.join([p.get_detail for p in self.items.all()])
 
+    def get_bill_amount(self):
+        return self.get_total
+
+    get_bill_amount.short_description = "Bill Amount"
+
     @property
     def printable_sale_date(self):
         return self.sale_date.strftime("%d %b %Y")
 
+    ROLLUP_FIELDS = ("sale_date", "payment_mode", "cancelled")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._rollup_state = instance.rollup_state()
+        return instance
+
+    def rollup_state(self):
+        """ Values of the fields the sales rollups depend on, None if any is deferred """
+        if any(name not in self.__dict__ for name in self.ROLLUP_FIELDS):
+            return None
+        return tuple(getattr(self, name) for name in self.ROLLUP_FIELDS)
+
+    def save(self, *args, **kwargs):
+        if not self.invoice_id:
+            self.invoice_id = invoice_numbers.allocate(self.sale_date)
+        super().save(*args, **kwargs)
+
     def get_reference_id(self):
         _id = self.id
         _url = reverse_lazy('generate_invoice', kwargs={"pk": _id})
         _href = "<a href='{0}'>print</a>".format(_url)
         return format_html(_href)
 
+    class Meta(BaseSaleRecord.Meta):
+        indexes = [
+            models.Index(fields=["date_created", "id"]),  # cursor pagination
+        ]
+
+
+def imei_lineage_query(imeis):
+    purchases = PurchaseRecord.objects.filter(
+        items__cost=OuterRef('saleeffectivecost__cost'),
+        purchase_date__lte=OuterRef('salerecord__sale_date')).order_by('-purchase_date', '-pk')
+    return SaleRecord.items.through.objects.filter(saleeffectivecost__imei__in=imeis).annotate(
+        purchase_id=Subquery(purchases.values('pk')[:1]),
+        purchase_invoice_id=Subquery(purchases.values('invoice_id')[:1]),
+        purchase_date=Subquery(purchases.values('purchase_date')[:1]),
+        distributor=Subquery(purchases.values('purchased_from__name')[:1]),
+    ).values(
+        'saleeffectivecost__imei', 'saleeffectivecost__quantity', 'saleeffectivecost__discount',
+        'salerecord_id', 'salerecord__invoice_id', 'salerecord__sale_date', 'salerecord__cancelled',
+        'salerecord__customer_id', 'salerecord__customer__name', 'salerecord__customer__contact_number',
+        'saleeffectivecost__cost_id', 'saleeffectivecost__cost__name', 'saleeffectivecost__cost__launched_by',
+        'saleeffectivecost__cost__hsn_code',
+        'purchase_id', 'purchase_invoice_id', 'purchase_date', 'distributor',
+    ).order_by('salerecord__sale_date', 'salerecord_id')
+
+
+@lru_cache(maxsize=64)
+def imei_lineage_sql(alias, count):
+    """
+    SQL, column names and selected expressions of :func:`imei_lineage_query`
+    for ``count`` IMEIs on database ``alias``, compiled once: building the
+    query takes far longer than running it on the IMEI index
+    """
+    queryset = imei_lineage_query([str(i) for i in range(count)]).using(alias)
+    compiler = queryset.query.get_compiler(alias)
+    sql, params = compiler.as_sql()
+    names = list(queryset.query.values_select) + list(queryset.query.annotation_select)
+    return sql, names, tuple(expression for expression, _, _ in compiler.select)
+
+
+def _convert(rows, expressions, connection):
+    """ ``rows`` of database values converted to Python ones as a queryset of ``expressions`` does """
+    converters = [(position, expression, connection.ops.get_db_converters(expression) +
+                   expression.get_db_converters(connection)) for position, expression in enumerate(expressions)]
+    converters = [converter for converter in converters if converter[2]]
+    for row in map(list, rows):
+        for position, expression, functions in converters:
+            for function in functions:
+                row[position] = function(row[position], expression, connection)
+        yield row
+
+
+def imei_lineage(imeis):
+    """
+    Sale, customer, product and last purchase of the product before the
+    sale for each of ``imeis``, in one query; returns ``{imei: lineage}``
+    """
+    imeis = sorted({normalize_imei(imei) for imei in imeis} - {None})
+    if not imeis:
+        return {}
+    alias = router.db_for_read(SaleRecord.items.through)
+    sql, names, expressions = imei_lineage_sql(alias, len(imeis))
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, imeis)
+        rows = [dict(zip(names, row)) for row in _convert(cursor.fetchall(), expressions, connection)]
+    lineage = {}
+    for row in rows:  # latest sale wins when a device was sold again
+        lineage[row['saleeffectivecost__imei']] = {
+            'imei': row['saleeffectivecost__imei'],
+            'sale': {
+                'id': row['salerecord_id'],
+                'invoice_id': row['salerecord__invoice_id'],
+                'sale_date': row['salerecord__sale_date'],
+                'cancelled': bool(row['salerecord__cancelled']),
+                'quantity': row['saleeffectivecost__quantity'],
+                'discount': row['saleeffectivecost__discount'],
+            },
+            'customer': {
+                'id': row['salerecord__customer_id'],
+                'name': row['salerecord__customer__name'],
+                'contact_number': str(row['salerecord__customer__contact_number'] or "") or None,
+            } if row['salerecord__customer_id'] else None,
+            'product': {
+                'id': row['saleeffectivecost__cost_id'],
+                'name': row['saleeffectivecost__cost__name'],
+                'launched_by': row['saleeffectivecost__cost__launched_by'],
+                'hsn_code': row['saleeffectivecost__cost__hsn_code'],
+            },
+            'purchase': {
+                'id': row['purchase_id'],
+                'invoice_id': row['purchase_invoice_id'],
+                'purchase_date': row['purchase_date'],
+                'distributor': row['distributor'],
+            } if row['purchase_id'] else None,
+        }
+    return lineage
+
+
+class CustomerSearchDocumentQuerySet(models.QuerySet):
+    def rebuild(self, customer_ids=None, batch_size=2000):
+        """ Rebuild the documents of ``customer_ids``, of every customer by default """
+        if customer_ids is None:
+            customer_ids = CustomerDetail.objects.order_by('pk').values_list('pk', flat=True)
+        customer_ids = [pk for pk in customer_ids if pk is not None]
+        for start in range(0, len(customer_ids), batch_size):
+            self._rebuild(customer_ids[start:start + batch_size])
+
+    def _rebuild(self, customer_ids):
+        imeis = {}
+        for customer_id, imei in SaleRecord.items.through.objects.filter(
+                salerecord__customer_id__in=customer_ids, saleeffectivecost__imei__isnull=False).values_list(
+                'salerecord__customer_id', 'saleeffectivecost__imei'):
+            imeis.setdefault(customer_id, []).append(imei)
+        customers = CustomerDetail.objects.filter(pk__in=customer_ids).select_related(
+            'address__city', 'address__state', 'address__country')
+        with transaction.atomic(using=self.db):
+            self.filter(customer_id__in=customer_ids).delete()
+            self.bulk_create([CustomerSearchDocument(customer=customer,
+                                                     document=CustomerSearchDocument.document_of(
+                                                         customer, imeis.get(customer.pk, [])))
+                              for customer in customers])
+
+    def search(self, query, limit=CUSTOMER_SEARCH_LIMIT):
+        """ Ids of the customers matching every word of ``query``, best match first """
+        return search.ranked_ids(connections[self.db], self.model._meta.db_table, query, limit)
+
+
+class CustomerSearchDocument(models.Model):
+    """
+    Everything a customer can be searched by, in one text column indexed
+    by :mod:`sale_record.search`
+    """
+    customer = models.OneToOneField(CustomerDetail, primary_key=True, on_delete=models.CASCADE,
+                                    related_name="search_document")
+    document = models.TextField()
+
+    objects = CustomerSearchDocumentQuerySet.as_manager()
+
+    @staticmethod
+    def document_of(customer, imeis=()):
+        words = [customer.name, customer.email_address]
+        for number in (customer.contact_number, customer.alternate_contact_number):
+            if number:
+                words += [number.as_e164, str(number.national_number)]
+        address = customer.address
+        if address:
+            words += [address.contact_name, address.address_one, address.address_two, address.zip_code]
+            words += [place.name for place in (address.city, address.state, address.country) if place]
+        words += imeis
+        return " ".join(word for word in words if word)
+
+    def __str__(self):
+        return self.document
+
+
+class SalesRollupQuerySet(models.QuerySet):
+    MEASURES = ("sales", "units", "gross", "discount", "tax")
+
+    def contributions(self, sale_ids):
+        """
+        ``{(day, dimension, key): [sales, units, gross, discount, tax]}`` of
+        the sales ``sale_ids`` as they are in the database, cancelled and
+        undated sales contribute nothing
+        """
+        quantity = Coalesce(F('quantity'), 0)
+        # prefixed, an annotation named after a field (``discount``) would replace it in the expressions
+        amounts = dict(('line_' + name, Sum(ExpressionWrapper(
+            line_amounts()[name] * quantity, output_field=DecimalField(max_digits=14, decimal_places=2))))
+            for name in ("gross", "discount", "tax"))
+        rows = SaleEffectiveCost.objects.filter(
+            salerecord__in=list(sale_ids), salerecord__cancelled=False, salerecord__sale_date__isnull=False).values(
+            'salerecord', 'salerecord__sale_date', 'salerecord__payment_mode', 'cost', 'cost__launched_by').annotate(
+            line_units=Sum(quantity), **amounts).order_by()
+        buckets, sales = {}, {}
+        for row in rows:
+            day = row['salerecord__sale_date']
+            for dimension, key in ((SalesRollup.BRAND, row['cost__launched_by']), (SalesRollup.PRODUCT, row['cost']),
+                                   (SalesRollup.PAYMENT_MODE, row['salerecord__payment_mode'])):
+                bucket = (day, dimension, "" if key is None else str(key))
+                totals = buckets.setdefault(bucket, [0, 0, Decimal(0), Decimal(0), Decimal(0)])
+                sales.setdefault(bucket, set()).add(row['salerecord'])
+                for index, name in enumerate(self.MEASURES[1:], 1):
+                    totals[index] += row['line_' + name] or 0
+        for bucket, totals in buckets.items():
+            totals[0] = len(sales[bucket])
+        return buckets
+
+    def add_sales(self, sale_ids, sign=1):
+        """ Add the current contribution of ``sale_ids`` to the rollups, or take it away with ``sign=-1`` """
+        if not sale_ids:
+            return
+        contributions = self.contributions(sale_ids)
+        existing = set(self.filter(day__in=set(day for day, dimension, key in contributions)).values_list(
+            'day', 'dimension', 'key'))
+        missing = [bucket for bucket in contributions if bucket not in existing]
+        if missing:
+            try:
+                with transaction.atomic(using=self.db):
+                    self.bulk_create([SalesRollup(day=day, dimension=dimension, key=key, **dict(
+                        (name, sign * value) for name, value in zip(self.MEASURES, contributions[day, dimension, key])))
+                        for day, dimension, key in missing])
+            except IntegrityError:  # created concurrently, add to them instead
+                existing.update(missing)
+        for (day, dimension, key), totals in contributions.items():
+            if (day, dimension, key) in existing:
+                self.filter(day=day, dimension=dimension, key=key).update(
+                    **dict((name, F(name) + sign * value) for name, value in zip(self.MEASURES, totals)))
+
+    def rebuild(self, batch_size=5000):
+        """ Recompute every rollup from the sale lines """
+        buckets = {}
+        sale_ids = list(SaleRecord.objects.order_by('pk').values_list('pk', flat=True))
+        for start in range(0, len(sale_ids), batch_size):
+            for bucket, totals in self.contributions(sale_ids[start:start + batch_size]).items():
+                merged = buckets.setdefault(bucket, [0, 0, Decimal(0), Decimal(0), Decimal(0)])
+                for index, value in enumerate(totals):
+                    merged[index] += value
+        with transaction.atomic(using=self.db):
+            self.all().delete()
+            self.bulk_create([SalesRollup(day=day, dimension=dimension, key=key, **dict(zip(self.MEASURES, totals)))
+                              for (day, dimension, key), totals in buckets.items()])
+        return len(buckets)
+
+    def report(self, dimension, period="month"):
+        """ Measures per ``period`` (``day``, ``month`` or ``year``) and key of ``dimension`` """
+        trunc = {"day": F('day'), "month": TruncMonth('day'), "year": TruncYear('day')}[period]
+        return self.filter(dimension=dimension).annotate(period=trunc).values('period', 'key').annotate(
+            **dict((name, Sum(name)) for name in self.MEASURES)).order_by('period', 'key')
+
+
+class SalesRollup(models.Model):
+    """
+    Daily sales totals per brand, product and payment mode, kept up to
+    date by the signals of sales and their lines
+    """
+    BRAND = 1
+    PRODUCT = 2
+    PAYMENT_MODE = 3
+    DIMENSIONS = (
+        (BRAND, _("Brand")),
+        (PRODUCT, _(PRODUCT_TYPE)),
+        (PAYMENT_MODE, _("Payment mode")),
+    )
+    day = models.DateField()
+    dimension = models.IntegerField(choices=DIMENSIONS)
+    key = models.CharField(max_length=300, blank=True,
+                           help_text=_("Brand name, product id or payment mode"))
+    sales = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    gross = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    tax = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    objects = SalesRollupQuerySet.as_manager()
+
+    @property
+    def total(self):
+        return self.gross - self.discount
+
+    def __str__(self):
+        return "{} {} {}".format(self.day, self.get_dimension_display(), self.key)
+
+    class Meta:
+        verbose_name = "Sales rollup"
+        verbose_name_plural = "Sales rollups"
+        unique_together = [("dimension", "key", "day")]
+        indexes = [
+            models.Index(fields=["dimension", "day"]),
+        ]
+
+
+@receiver(post_migrate, dispatch_uid="install_customer_search")
+def install_customer_search(sender, using, **kwargs):
+    connection = connections[using]
+    table = CustomerSearchDocument._meta.db_table
+    if sender.name == "sale_record" and table in connection.introspection.table_names():
+        search.install(connection, table)
+
+
+@receiver(post_save, sender=CustomerDetail, dispatch_uid="index_customer")
+def index_customer(sender, instance, raw=False, **kwargs):
+    if not raw:
+        CustomerSearchDocument.objects.rebuild([instance.pk])
+
+
+@receiver(post_save, sender=Address, dispatch_uid="index_customer")
+def index_customer_address(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        CustomerSearchDocument.objects.rebuild(instance.customerdetail_set.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=SaleRecord, dispatch_uid="index_customer")
+def index_sale_customer(sender, instance, raw=False, **kwargs):
+    if instance.customer_id and not raw:
+        CustomerSearchDocument.objects.rebuild([instance.customer_id])
+
+
+@receiver(m2m_changed, sender=SaleRecord.items.through, dispatch_uid="index_customer")
+def index_sale_items(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        if reverse:
+            customers = SaleRecord.objects.filter(pk__in=pk_set or []).values_list('customer_id', flat=True)
+        else:
+            customers = [instance.customer_id]
+        CustomerSearchDocument.objects.rebuild(customers)
+
+
+@receiver(post_save, sender=SaleEffectiveCost, dispatch_uid="index_customer")
+def index_sale_line(sender, instance, created, raw=False, **kwargs):
+    if not created and not raw:
+        CustomerSearchDocument.objects.rebuild(instance.salerecord_set.values_list('customer_id', flat=True))
+
+
+def settle_sale_stock(sale_ids, lines=None, reason=StockMovement.CANCELLATION):
+    """
+    Bring the stock ledger of the sales ``sale_ids``, or of their ``lines``
+    only, in line with their lines now: sold unless the sale is cancelled,
+    the line removed or either deleted. Stock coming back is recorded as
+    ``reason``.
+    """
+    sale_ids = list(sale_ids)
+    items = SaleRecord.items.through.objects.filter(salerecord_id__in=sale_ids, salerecord__cancelled=False)
+    if lines is not None:
+        lines = list(lines)
+        items = items.filter(saleeffectivecost_id__in=lines)
+    targets = dict(((sale_id, line_id, product_id), -(quantity or 0)) for sale_id, line_id, product_id, quantity in
+                   items.values_list('salerecord_id', 'saleeffectivecost_id', 'saleeffectivecost__cost_id',
+                                     'saleeffectivecost__quantity'))
+    return StockMovement.objects.settle(StockMovement.SALE_BILL, sale_ids, targets, (reason, StockMovement.SALE),
+                                        lines)
+
+
+def ledger_sales_of_line(line_pk):
+    """ Sales the stock ledger has movements of the line ``line_pk`` for, also once it left them """
+    return StockMovement.objects.filter(bill_type=StockMovement.SALE_BILL, line_id=line_pk).values_list(
+        'bill_id', flat=True).distinct()
+
 
 @receiver(m2m_changed, sender=SaleRecord.items.through, dispatch_uid="update_stock_count")
-def update_stock(sender, instance, action, **kwargs):
-    if action is "post_add":
-        for item in instance.items.all():
-            item.cost.available_stock -= item.quantity
-            item.cost.save()
+def update_stock(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "post_add" and pk_set:
+        StockMovement.objects.post_lines(StockMovement.SALE, StockMovement.SALE_BILL,
+                                         bill_line_pairs(instance, reverse, pk_set), SaleEffectiveCost, sign=-1)
+        if reverse:
+            settle_sale_stock(SaleRecord.objects.filter(pk__in=pk_set, cancelled=True).values_list('pk', flat=True),
+                              lines=[instance.pk])
+        elif instance.cancelled:
+            settle_sale_stock([instance.pk], lines=pk_set)
+    elif action in ("post_remove", "post_clear"):
+        if reverse:
+            settle_sale_stock(ledger_sales_of_line(instance.pk), lines=[instance.pk], reason=StockMovement.RETURN)
+        else:
+            settle_sale_stock([instance.pk], lines=pk_set, reason=StockMovement.RETURN)
+
+
+@receiver(pre_save, sender=SaleRecord, dispatch_uid="restore_stock")
+def note_cancellation(sender, instance, raw=False, **kwargs):
+    state = dict(zip(instance.ROLLUP_FIELDS, getattr(instance, '_rollup_state', None) or ()))
+    instance._cancellation_changed = instance.pk is not None and not raw and state.get(
+        'cancelled', not instance.cancelled) != instance.cancelled
+
+
+@receiver(post_save, sender=SaleRecord, dispatch_uid="restore_stock")
+def restore_cancelled_stock(sender, instance, **kwargs):
+    if getattr(instance, '_cancellation_changed', False):
+        settle_sale_stock([instance.pk])
+
+
+@receiver(post_delete, sender=SaleRecord, dispatch_uid="restore_stock")
+def restore_deleted_sale_stock(sender, instance, **kwargs):
+    settle_sale_stock([instance.pk])
+
+
+@receiver(post_save, sender=SaleEffectiveCost, dispatch_uid="restore_stock")
+@receiver(post_delete, sender=SaleEffectiveCost, dispatch_uid="restore_stock")
+def restore_line_stock(sender, instance, created=False, raw=False, **kwargs):
+    if not created and not raw:
+        settle_sale_stock(ledger_sales_of_line(instance.pk), lines=[instance.pk], reason=StockMovement.RETURN)
+
+
+@receiver(post_save, sender=SaleRecord, dispatch_uid="drop_cached_invoice")
+@receiver(post_delete, sender=SaleRecord, dispatch_uid="drop_cached_invoice")
+def drop_cached_invoice(sender, instance, **kwargs):
+    invoice_cache.invalidate(instance.pk)
+
+
+@receiver(m2m_changed, sender=SaleRecord.items.through, dispatch_uid="drop_cached_invoice")
+def drop_cached_invoice_items(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear"):
+        for bill_id in (pk_set or []) if reverse else [instance.pk]:
+            invoice_cache.invalidate(bill_id)
+
+
+@receiver(post_save, sender=SaleEffectiveCost, dispatch_uid="drop_cached_invoice")
+def drop_cached_invoice_line(sender, instance, created, **kwargs):
+    if not created:
+        for bill_id in instance.salerecord_set.values_list('pk', flat=True):
+            invoice_cache.invalidate(bill_id)
+
+
+def sales_of_line(line_pk):
+    return list(SaleRecord.items.through.objects.filter(saleeffectivecost_id=line_pk).values_list(
+        'salerecord_id', flat=True))
+
+
+@receiver(pre_save, sender=SaleRecord, dispatch_uid="update_sales_rollups")
+def retract_sale_rollups(sender, instance, raw=False, **kwargs):
+    state = getattr(instance, '_rollup_state', None)
+    instance._rollup_changed = instance.pk is not None and (state is None or state != instance.rollup_state())
+    if instance._rollup_changed and not raw:
+        SalesRollup.objects.add_sales([instance.pk], sign=-1)
+
+
+@receiver(post_save, sender=SaleRecord, dispatch_uid="update_sales_rollups")
+def apply_sale_rollups(sender, instance, created, raw=False, **kwargs):
+    if getattr(instance, '_rollup_changed', False) and not raw:
+        SalesRollup.objects.add_sales([instance.pk])
+    instance._rollup_state = instance.rollup_state()
+
+
+@receiver(pre_delete, sender=SaleRecord, dispatch_uid="update_sales_rollups")
+def delete_sale_rollups(sender, instance, **kwargs):
+    SalesRollup.objects.add_sales([instance.pk], sign=-1)
+
+
+@receiver(m2m_changed, sender=SaleRecord.items.through, dispatch_uid="update_sales_rollups")
+def update_sale_items_rollups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("pre_add", "post_add", "pre_remove", "post_remove", "pre_clear", "post_clear"):
+        return
+    if not reverse:
+        sales = [instance.pk]
+    elif action.endswith("_clear"):
+        if action == "pre_clear":
+            instance._rollup_sales = sales_of_line(instance.pk)
+        sales = getattr(instance, '_rollup_sales', [])
+    else:
+        sales = pk_set
+    SalesRollup.objects.add_sales(sales, sign=-1 if action.startswith("pre_") else 1)
+
+
+@receiver(pre_save, sender=SaleEffectiveCost, dispatch_uid="update_sales_rollups")
+@receiver(pre_delete, sender=SaleEffectiveCost, dispatch_uid="update_sales_rollups")
+def retract_line_rollups(sender, instance, raw=False, **kwargs):
+    instance._rollup_sales = [] if instance.pk is None or raw else sales_of_line(instance.pk)
+    SalesRollup.objects.add_sales(instance._rollup_sales, sign=-1)
+
+
+@receiver(post_save, sender=SaleEffectiveCost, dispatch_uid="update_sales_rollups")
+@receiver(post_delete, sender=SaleEffectiveCost, dispatch_uid="update_sales_rollups")
+def apply_line_rollups(sender, instance, **kwargs):
+    SalesRollup.objects.add_sales(getattr(instance, '_rollup_sales', []))
+
+
+@receiver(post_save, sender=SaleRecord, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=SaleRecord, dispatch_uid="invalidate_api_cache")
+@receiver(post_save, sender=SaleEffectiveCost, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=SaleEffectiveCost, dispatch_uid="invalidate_api_cache")
+@receiver(post_save, sender=CustomerDetail, dispatch_uid="invalidate_api_cache")
+@receiver(post_delete, sender=CustomerDetail, dispatch_uid="invalidate_api_cache")
+def invalidate_api_cache(sender, **kwargs):
+    api_cache.invalidate(sender)
+
+
+@receiver(m2m_changed, sender=SaleRecord.items.through, dispatch_uid="invalidate_api_cache")
+def invalidate_sale_api_cache(sender, action, **kwargs):
+    if action.startswith("post_"):
+        api_cache.invalidate(SaleRecord)
+
+
+sync.register("customers", CustomerDetail)
+sync.register("sale_items", SaleEffectiveCost)
+sync.register("sales", SaleRecord, many=["items"])
@@ -0,0 +1,117 @@
+# coding=utf-8
+"""
+Database specific full-text index over the customer search documents.
+
+Each customer has one denormalized document (name, phone numbers, email,
+address and IMEIs of purchased devices) in the table of
+:class:`sale_record.models.CustomerSearchDocument`. The table is indexed
+
+* on SQLite by an FTS5 table kept in sync by triggers, ranked by bm25,
+* on PostgreSQL by a ``pg_trgm`` GIN index, ranked by trigram similarity,
+* on MySQL by an ngram FULLTEXT index, ranked by relevance.
+
+Other databases, or SQLite builds without FTS5, fall back to LIKE scans of
+the documents.
+"""
+import re
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ['install', 'ranked_ids', 'terms']
+
+
+def terms(query):
+    """ Lower cased words of ``query``, punctuation and operators dropped """
+    return re.findall(r"\w+", (query or "").lower())
+
+
+def _fts_table(table):
+    return "{}_fts".format(table)
+
+
+def _has_fts5(connection):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+        if cursor.fetchone()[0]:
+            return True
+        try:  # FTS5 may be loaded as an extension
+            cursor.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+            cursor.execute("DROP TABLE temp.fts5_probe")
+            return True
+        except Exception:
+            return False
+
+
+def _backend(connection):
+    if connection.vendor == 'sqlite':
+        if not hasattr(connection, '_customer_search_fts5'):
+            connection._customer_search_fts5 = _has_fts5(connection)
+        return 'fts5' if connection._customer_search_fts5 else 'like'
+    if connection.vendor in ('postgresql', 'mysql'):
+        return connection.vendor
+    return 'like'
+
+
+def install(connection, table):
+    """ Create the search index of the document ``table``, safe to run repeatedly """
+    backend = _backend(connection)
+    with connection.cursor() as cursor:
+        if backend == 'fts5':
+            fts = _fts_table(table)
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE name = %s", [fts])
+            if cursor.fetchone():
+                return
+            cursor.execute(
+                "CREATE VIRTUAL TABLE {fts} USING fts5(document, content='{table}', content_rowid='customer_id', "
+                "tokenize='unicode61')".format(fts=fts, table=table))
+            cursor.execute(
+                "CREATE TRIGGER {fts}_ai AFTER INSERT ON {table} BEGIN "
+                "INSERT INTO {fts}(rowid, document) VALUES (new.customer_id, new.document); END".format(
+                    fts=fts, table=table))
+            cursor.execute(
+                "CREATE TRIGGER {fts}_ad AFTER DELETE ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, document) VALUES ('delete', old.customer_id, old.document); "
+                "END".format(fts=fts, table=table))
+            cursor.execute(
+                "CREATE TRIGGER {fts}_au AFTER UPDATE ON {table} BEGIN "
+                "INSERT INTO {fts}({fts}, rowid, document) VALUES ('delete', old.customer_id, old.document); "
+                "INSERT INTO {fts}(rowid, document) VALUES (new.customer_id, new.document); END".format(
+                    fts=fts, table=table))
+            cursor.execute("INSERT INTO {fts}({fts}) VALUES ('rebuild')".format(fts=fts))
+        elif backend == 'postgresql':
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute("CREATE INDEX IF NOT EXISTS {table}_trgm ON {table} USING gin (document gin_trgm_ops)"
+                           .format(table=table))
+        elif backend == 'mysql':
+            cursor.execute("SELECT 1 FROM information_schema.statistics WHERE table_schema = DATABASE() "
+                           "AND table_name = %s AND index_name = %s", [table, "{}_ngram".format(table)])
+            if not cursor.fetchone():
+                cursor.execute("ALTER TABLE {table} ADD FULLTEXT INDEX {table}_ngram (document) WITH PARSER ngram"
+                               .format(table=table))
+
+
+def ranked_ids(connection, table, query, limit):
+    """ Customer ids whose document matches every word of ``query``, best match first """
+    words = terms(query)
+    if not words:
+        return []
+    backend = _backend(connection)
+    if backend == 'fts5':  # prefix match of every word
+        sql = "SELECT rowid FROM {fts} WHERE {fts} MATCH %s ORDER BY rank LIMIT %s".format(fts=_fts_table(table))
+        params = [" ".join('"{}"*'.format(word) for word in words), limit]
+    elif backend == 'postgresql':
+        sql = ("SELECT customer_id FROM {table} WHERE {where} ORDER BY similarity(document, %s) DESC, customer_id "
+               "LIMIT %s").format(table=table, where=" AND ".join(["document ILIKE %s"] * len(words)))
+        params = ["%{}%".format(word) for word in words] + [" ".join(words), limit]
+    elif backend == 'mysql':
+        sql = ("SELECT customer_id FROM {table} WHERE MATCH (document) AGAINST (%s IN BOOLEAN MODE) "
+               "ORDER BY MATCH (document) AGAINST (%s IN BOOLEAN MODE) DESC, customer_id LIMIT %s").format(table=table)
+        match = " ".join('+"{}"'.format(word) for word in words)
+        params = [match, match, limit]
+    else:
+        sql = "SELECT customer_id FROM {table} WHERE {where} ORDER BY customer_id LIMIT %s".format(
+            table=table, where=" AND ".join(["LOWER(document) LIKE %s"] * len(words)))
+        params = ["%{}%".format(word) for word in words] + [limit]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
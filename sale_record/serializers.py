@@ -0,0 +1,84 @@
+# coding=utf-8
+from django.db import transaction
+from rest_framework import serializers
+
+from inventory_management.models import ProductRecord
+from main.serializers import BulkBillSerializer, BulkLineSerializer
+from sale_record.models import *
+
+__author__ = "Gahan Saraiya"
+
+__all__ = ["CustomerDetailSerializer", "SaleEffectiveCostSerializer", "SaleRecordSerializer",
+           "BulkSaleRecordSerializer"]
+
+
+class CustomerDetailSerializer(serializers.HyperlinkedModelSerializer):
+    address = serializers.PrimaryKeyRelatedField(queryset=Address.objects.all(), required=False, allow_null=True)
+    postal_address = serializers.StringRelatedField(source="address")
+
+    class Meta:
+        model = CustomerDetail
+        fields = ["id", "url", "name", "contact_number", "alternate_contact_number", "email_address", "address",
+                  "postal_address", "date_created", "date_updated"]
+
+
+class SaleEffectiveCostSerializer(serializers.HyperlinkedModelSerializer):
+    cost = serializers.HyperlinkedRelatedField(view_name="productrecord-detail", queryset=ProductRecord.objects.all())
+    product_name = serializers.CharField(source="cost.name", read_only=True)
+    unit_total = serializers.DecimalField(source="get_effective_cost", max_digits=14, decimal_places=2,
+                                          read_only=True)
+    line_total = serializers.DecimalField(source="get_total_effective_cost", max_digits=14, decimal_places=2,
+                                          read_only=True)
+    taxable_value = serializers.DecimalField(source="amounts.taxable", max_digits=14, decimal_places=2,
+                                             read_only=True)
+    igst = serializers.DecimalField(source="amounts.igst", max_digits=14, decimal_places=2, read_only=True)
+    cgst = serializers.DecimalField(source="amounts.cgst", max_digits=14, decimal_places=2, read_only=True)
+    sgst = serializers.DecimalField(source="amounts.sgst", max_digits=14, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = SaleEffectiveCost
+        fields = ["id", "url", "cost", "product_name", "quantity", "discount", "imei", "unit_total", "line_total",
+                  "taxable_value", "igst", "cgst", "sgst"]
+
+
+class SaleRecordSerializer(serializers.HyperlinkedModelSerializer):
+    items = SaleEffectiveCostSerializer(many=True)
+    customer = serializers.HyperlinkedRelatedField(view_name="customerdetail-detail", required=False,
+                                                   allow_null=True, queryset=CustomerDetail.objects.all())
+    customer_detail = CustomerDetailSerializer(source="customer", read_only=True)
+    total = serializers.DecimalField(source="get_total", max_digits=14, decimal_places=2, read_only=True)
+
+    class Meta:
+        model = SaleRecord
+        fields = ["id", "url", "invoice_id", "sale_date", "delivery_date", "items", "customer", "customer_detail",
+                  "payment_mode", "payment_status", "payment_date", "cancelled", "total",
+                  "date_created", "date_updated"]
+
+    def create(self, validated_data):
+        items = validated_data.pop("items")
+        with transaction.atomic():
+            sale = SaleRecord.objects.create(**validated_data)
+            sale.items.add(*[SaleEffectiveCost.objects.create(**item) for item in items])
+        sale.refresh_from_db()  # date defaults are datetimes until loaded back
+        return sale
+
+    def update(self, instance, validated_data):
+        validated_data.pop("items", None)  # lines are changed through their own endpoint
+        return super().update(instance, validated_data)
+
+
+class BulkSaleEffectiveCostSerializer(BulkLineSerializer):
+    class Meta(BulkLineSerializer.Meta):
+        model = SaleEffectiveCost
+        fields = BulkLineSerializer.Meta.fields + ["imei"]
+
+
+class BulkSaleRecordSerializer(BulkBillSerializer):
+    line_model = SaleEffectiveCost
+    product_model = ProductRecord
+    items = BulkSaleEffectiveCostSerializer(many=True)
+
+    class Meta(BulkBillSerializer.Meta):
+        model = SaleRecord
+        fields = ["invoice_id", "sale_date", "delivery_date", "customer", "payment_mode", "payment_status",
+                  "payment_date", "items"]
@@ -1,3 +1,659 @@
-from django.test import TestCase
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from reportlab.pdfgen.canvas import Canvas
+
+from inventory_management.models import Distributor, EffectiveCost, ProductRecord, PurchaseRecord, StockMovement
+from main.invoice_cache import invoice_cache
+from main.tests import SHARED_CACHES
+from main.utils import invoice_data, paginate_items, render_invoice
+from sale_record import gst
+from sale_record.models import *
+from sale_record.invoice_batch import batch_invoice_data, merge_invoices, render_invoices, zip_invoices
+from sale_record.models import InvoiceNumberAllocator
+
+
+class SaleStockTest(TestCase):
+    def setUp(self):
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand",
+                                                    available_stock=10)
+
+    def test_sale_decrements_stock_through_ledger(self):
+        sale = SaleRecord.objects.create(invoice_id="1000", payment_mode=1)
+        sale.items.add(SaleEffectiveCost.objects.create(cost=self.product, quantity=2),
+                       SaleEffectiveCost.objects.create(cost=self.product, quantity=1))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_stock, 7)
+        self.assertEqual(sum(StockMovement.objects.filter(bill_type=StockMovement.SALE_BILL, bill_id=sale.pk)
+                             .values_list('quantity', flat=True)), -3)
+
+    def stock(self):
+        self.product.refresh_from_db()
+        return self.product.available_stock
+
+    def sale(self, *quantities):
+        sale = SaleRecord.objects.create(payment_mode=1)
+        sale.items.add(*[SaleEffectiveCost.objects.create(cost=self.product, quantity=quantity)
+                         for quantity in quantities])
+        return sale
+
+    def test_cancellation_restores_stock_once(self):
+        sale = self.sale(2, 1)
+        sale.cancelled = True
+        sale.save()
+        self.assertEqual(self.stock(), 10)
+        sale.save()
+        self.assertEqual(settle_sale_stock([sale.pk]), [])  # a retry posts nothing
+        self.assertEqual(self.stock(), 10)
+        self.assertEqual(StockMovement.objects.filter(reason=StockMovement.CANCELLATION).count(), 2)
+        sale.items.add(SaleEffectiveCost.objects.create(cost=self.product, quantity=4))
+        self.assertEqual(self.stock(), 10)
+        sale.cancelled = False
+        sale.save()
+        self.assertEqual(self.stock(), 3)
+
+    def test_removed_and_deleted_lines_and_bills_restore_stock(self):
+        sale = self.sale(2, 1, 3)
+        first, second, third = sale.items.order_by('pk')
+        sale.items.remove(first)
+        self.assertEqual(self.stock(), 6)
+        second.quantity = 2
+        second.save()
+        self.assertEqual(self.stock(), 5)
+        third.delete()
+        self.assertEqual(self.stock(), 8)
+        other = self.sale(1, 1)
+        other.items.clear()
+        self.assertEqual(self.stock(), 8)
+        sale.delete()
+        self.assertEqual(self.stock(), 10)
+        self.assertEqual(sum(StockMovement.objects.filter(bill_type=StockMovement.SALE_BILL)
+                             .values_list('quantity', flat=True)), 0)
+
+    def test_bulk_cancel(self):
+        sales = [self.sale(1) for _ in range(6)]
+        with CaptureQueriesContext(connection) as one:
+            self.assertEqual(SaleRecord.objects.filter(pk=sales[0].pk).cancel(), 1)
+        with CaptureQueriesContext(connection) as many:
+            self.assertEqual(SaleRecord.objects.filter(pk__in=[sale.pk for sale in sales[1:5]]).cancel(), 4)
+        self.assertEqual(len(many), len(one))
+        self.assertEqual(self.stock(), 9)
+        self.assertEqual(SaleRecord.objects.filter(cancelled=True).cancel(), 0)
+        self.assertEqual(self.stock(), 9)
+
+
+class SaleTotalsTest(TestCase):
+    def setUp(self):
+        self.phone = ProductRecord.objects.create(name="Handset", price="999.00", launched_by="Brand", tax=12)
+        self.charger = ProductRecord.objects.create(name="Charger", price="149.50", launched_by="Brand", tax=None)
+        for i in range(3):
+            sale = SaleRecord.objects.create(payment_mode=1)
+            sale.items.add(SaleEffectiveCost.objects.create(cost=self.phone, quantity=i + 1, discount=7),
+                           SaleEffectiveCost.objects.create(cost=self.charger, quantity=2))
+
+    def test_annotated_totals_match_python_totals(self):
+        for sale in SaleRecord.objects.with_totals():
+            plain = SaleRecord.objects.get(pk=sale.pk)
+            lines = plain.items.all()
+            self.assertEqual(sale.get_total, plain.get_total)
+            self.assertEqual(sale.bill_discount, sum(line.calculate_discount * line.quantity for line in lines))
+            self.assertEqual(sale.bill_tax, sum(line.tax_amount * line.quantity for line in lines))
+
+    def test_annotated_line_amounts_match_properties(self):
+        for line in SaleEffectiveCost.objects.with_totals():
+            plain = SaleEffectiveCost.objects.get(pk=line.pk)
+            self.assertEqual(line.get_effective_cost, plain.get_effective_cost)
+            self.assertEqual(line.get_total_effective_cost, plain.get_total_effective_cost)
+            self.assertEqual(line.tax_amount, plain.tax_amount)
+
+    def test_listing_totals_takes_one_query(self):
+        with self.assertNumQueries(1):
+            totals = [sale.get_total for sale in SaleRecord.objects.with_totals()]
+        self.assertEqual(len(totals), 3)
+
+    def test_lines_keep_their_terms(self):
+        sale = SaleRecord.objects.with_totals().order_by('pk').first()
+        invoice = invoice_data(SaleRecord.objects.get(pk=sale.pk))
+        ProductRecord.objects.filter(pk=self.phone.pk).update(price=1299, tax=18, tax_type=2)
+        self.assertEqual(SaleRecord.objects.with_totals().get(pk=sale.pk).bill_total, sale.bill_total)
+        self.assertEqual(invoice_data(SaleRecord.objects.get(pk=sale.pk)), invoice)
+        line = SaleEffectiveCost.objects.create(cost_id=self.phone.pk, quantity=1)
+        self.assertEqual((line.mrp, line.tax_rate, line.tax_type), (Decimal("1299.00"), 18, 2))
+        line.cost = self.charger
+        line.save()
+        self.assertEqual((line.mrp, line.tax_rate), (Decimal("149.50"), None))
+
+    def test_lines_saved_before_terms_were_kept(self):
+        SaleEffectiveCost.objects.update(mrp=None, tax_rate=None, tax_type=None)
+        self.test_annotated_totals_match_python_totals()
+        self.assertNotEqual(SaleRecord.objects.with_totals().order_by('pk').first().get_total, 0)
+
+    def test_backfill_command(self):
+        SaleEffectiveCost.objects.filter(cost=self.charger).update(mrp=None, tax_rate=None, tax_type=None)
+        expected = [line.amounts for line in SaleEffectiveCost.objects.order_by('pk')]
+        out = StringIO()
+        call_command("backfill_line_terms", "--batch-size", "2", stdout=out)
+        self.assertIn("Backfilled 3 SaleEffectiveCost lines", out.getvalue())
+        self.assertFalse(SaleEffectiveCost.objects.filter(mrp__isnull=True).exists())
+        self.assertEqual([line.amounts for line in SaleEffectiveCost.objects.order_by('pk')], expected)
+
+
+class SaleAdminTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+
+    def add_sales(self, count):
+        for _ in range(count):
+            customer = CustomerDetail.objects.create(name="Customer")
+            sale = SaleRecord.objects.create(payment_mode=1, customer=customer)
+            sale.items.add(*[SaleEffectiveCost.objects.create(cost=self.product) for _ in range(3)])
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('admin:sale_record_salerecord_changelist'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_query_count_does_not_grow_with_rows(self):
+        self.add_sales(2)
+        few = self.changelist_queries()
+        self.add_sales(20)
+        self.assertEqual(self.changelist_queries(), few)
+
+    def test_cancel_action(self):
+        self.add_sales(3)
+        response = self.client.post(reverse('admin:sale_record_salerecord_changelist'), {
+            "action": "cancel_sales", "_selected_action": list(SaleRecord.objects.values_list('pk', flat=True)[:2])})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(SaleRecord.objects.filter(cancelled=True).count(), 2)
+        self.assertEqual(StockMovement.objects.filter(reason=StockMovement.CANCELLATION).count(), 6)
+
+
+class InvoicePdfTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.cache_root, invoice_cache.root = invoice_cache.root, tempfile.mkdtemp()
+        product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+        self.sale = SaleRecord.objects.create(payment_mode=1, customer=CustomerDetail.objects.create(name="Customer"))
+        self.line = SaleEffectiveCost.objects.create(cost=product, quantity=2)
+        self.sale.items.add(self.line)
+        self.url = reverse('generate_invoice', kwargs={"pk": self.sale.pk})
+
+    def tearDown(self):
+        shutil.rmtree(invoice_cache.root)
+        invoice_cache.root = self.cache_root
+
+    def cached_files(self):
+        return os.listdir(os.path.join(invoice_cache.root, str(self.sale.pk)))
+
+    def test_cached_invoice_revalidates_with_etag(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "application/pdf")
+        self.assertTrue(b"".join(response.streaming_content).startswith(b"%PDF"))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self.cached_files()), 1)
+
+    def test_changed_sale_is_rendered_again(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.line.quantity = 3
+        self.line.save()
+        self.assertEqual(self.cached_files(), [])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_prune_evicts_by_size(self):
+        self.client.get(self.url)
+        invoice_cache.max_size, max_size = 0, invoice_cache.max_size
+        try:
+            invoice_cache.prune()
+        finally:
+            invoice_cache.max_size = max_size
+        self.assertEqual(self.cached_files(), [])
+
+    @mock.patch('sale_record.views.INV_STORE_ON_DISK', False)
+    def test_in_memory_invoice_skips_the_cache(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content.startswith(b"%PDF"))
+        self.assertFalse(os.path.exists(os.path.join(invoice_cache.root, str(self.sale.pk))))
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(response.status_code, 304)
+
+    def test_long_invoice_spans_pages(self):
+        product = ProductRecord.objects.create(name="Charger", price=100, launched_by="Brand")
+        self.sale.items.add(*[SaleEffectiveCost.objects.create(cost=product, quantity=1) for _ in range(40)])
+        invoice = invoice_data(SaleRecord.objects.with_totals().get(pk=self.sale.pk))
+        heights, pages = paginate_items(Canvas(BytesIO()), invoice)
+        self.assertGreater(len(pages), 1)
+        self.assertEqual([start for start, end in pages[1:]], [end for start, end in pages[:-1]])
+        self.assertEqual((pages[0][0], pages[-1][1]), (0, 41))
+        self.assertEqual(sum(invoice['line_totals']), SaleRecord.objects.with_totals().get(pk=self.sale.pk).get_total)
+        self.assertEqual(render_invoice(invoice).count(b"/Type /Page\n"), len(pages))
+
+
+class InvoiceBatchTest(TestCase):
+    def setUp(self):
+        product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+        for i in range(4):
+            sale = SaleRecord.objects.create(payment_mode=1, customer=CustomerDetail.objects.create(name="Customer"))
+            sale.items.add(*[SaleEffectiveCost.objects.create(cost=product, quantity=i + 1) for _ in range(2)])
+
+    def test_invoice_data_is_loaded_in_constant_queries(self):
+        with self.assertNumQueries(2):
+            invoices = batch_invoice_data(SaleRecord.objects.all())
+        self.assertEqual(len(invoices), 4)
+        self.assertEqual(len(invoices[0]['items']), 2)
+
+    def test_zip_of_invoices_rendered_in_processes(self):
+        files = list(render_invoices(batch_invoice_data(SaleRecord.objects.all()), workers=2))
+        archive = zipfile.ZipFile(BytesIO(b"".join(zip_invoices(files))))
+        self.assertEqual(archive.namelist(), [name for name, pdf in files])
+        self.assertTrue(all(archive.read(name).startswith(b"%PDF") for name in archive.namelist()))
+
+    def test_merged_invoices(self):
+        buffer = BytesIO()
+        merge_invoices(buffer, batch_invoice_data(SaleRecord.objects.all()))
+        self.assertEqual(buffer.getvalue().count(b"/Type /Page\n"), 4)
+
+
+class InvoiceNumberTest(TestCase):
+    def test_numbers_continue_after_legacy_numeric_ids(self):
+        SaleRecord.objects.create(invoice_id="1041")
+        SaleRecord.objects.create(invoice_id="MANUAL-7")
+        self.assertEqual(SaleRecord.objects.create().invoice_id, "1042")
+        self.assertEqual(SaleRecord.objects.create().invoice_id, "1043")
+
+    def test_explicit_invoice_id_is_kept(self):
+        self.assertEqual(SaleRecord.objects.create(invoice_id="X-1").invoice_id, "X-1")
+
+    def test_financial_year_series(self):
+        allocator = InvoiceNumberAllocator(fy_prefix=True)
+        self.assertEqual(allocator.allocate(datetime.date(2018, 3, 31)), "2017-18/1000")
+        self.assertEqual(allocator.allocate(datetime.date(2018, 4, 1)), "2018-19/1000")
+        self.assertEqual(allocator.allocate(datetime.date(2018, 12, 1)), "2018-19/1001")
+
+
+class InvoiceNumberBlockTest(TransactionTestCase):
+    def test_block_reservation_serves_from_memory(self):
+        allocator = InvoiceNumberAllocator(block_size=10)
+        self.assertEqual(allocator.allocate(), "1000")
+        with self.assertNumQueries(0):
+            numbers = [allocator.allocate() for _ in range(9)]
+        self.assertEqual(numbers[-1], "1009")
+        self.assertEqual(InvoiceSequence.objects.get(prefix="").last_number, 1009)
+
+
+class ImeiLookupTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+        distributor = Distributor.objects.create(name="Supplier")
+        for invoice_id, date in (("P-1", datetime.date(2018, 1, 1)), ("P-2", datetime.date(2018, 3, 1)),
+                                 ("P-3", datetime.date(2018, 6, 1))):
+            purchase = PurchaseRecord.objects.create(invoice_id=invoice_id, purchase_date=date,
+                                                     purchased_from=distributor, payment_mode=1)
+            purchase.items.add(EffectiveCost.objects.create(cost=self.product, quantity=5))
+        self.sale = SaleRecord.objects.create(payment_mode=1, sale_date=datetime.date(2018, 4, 1),
+                                              customer=CustomerDetail.objects.create(name="Customer"))
+        self.sale.items.add(SaleEffectiveCost.objects.create(cost=self.product, imei="35-209900 176148 1"),
+                            SaleEffectiveCost.objects.create(cost=self.product, imei="abc.123"))
+
+    def test_imei_is_normalized_on_save(self):
+        self.assertEqual(sorted(self.sale.items.values_list('imei', flat=True)), ["352099001761481", "ABC123"])
+        self.assertIsNone(SaleEffectiveCost.objects.create(cost=self.product, imei=" - ").imei)
+
+    def test_lineage_in_one_query(self):
+        with self.assertNumQueries(1):
+            lineage = imei_lineage(["352099001761481", "abc-123", "000"])
+        self.assertEqual(set(lineage), {"352099001761481", "ABC123"})
+        self.assertEqual(lineage["ABC123"]['sale']['id'], self.sale.pk)
+        self.assertEqual(lineage["ABC123"]['customer']['name'], "Customer")
+        self.assertEqual(lineage["ABC123"]['product']['id'], self.product.pk)
+        self.assertEqual(lineage["ABC123"]['purchase']['invoice_id'], "P-2")
+        self.assertEqual(lineage["ABC123"]['purchase']['purchase_date'], datetime.date(2018, 3, 1))
+        self.assertIs(lineage["ABC123"]['sale']['cancelled'], False)
+
+    def test_single_and_batched_lookup_endpoints(self):
+        response = self.client.get(reverse('imei-detail', kwargs={"imei": "35 2099 0017 6148 1"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['sale']['invoice_id'], self.sale.invoice_id)
+        self.assertEqual(self.client.get(reverse('imei-detail', kwargs={"imei": "000"})).status_code, 404)
+        response = self.client.post(reverse('imei-lookup'), json.dumps({"imei": ["abc123", "000", "352099001761481"]}),
+                                    content_type="application/json")
+        self.assertEqual([row['imei'] for row in response.json()['results']], ["ABC123", "352099001761481"])
+        self.assertEqual(response.json()['missing'], ["000"])
+        response = self.client.post(reverse('imei-lookup'), json.dumps({"imei": "abc123"}), content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+
+class CustomerSearchTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        address = Address.objects.create(address_one="12 MG Road", zip_code="382021",
+                                         city=City.objects.create(name="Gandhinagar"))
+        self.ravi = CustomerDetail.objects.create(name="Ravi Patel", contact_number="+919988776655", address=address)
+        self.ravina = CustomerDetail.objects.create(name="Ravina Shah", contact_number="+919812345678")
+        product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand")
+        self.line = SaleEffectiveCost.objects.create(cost=product, imei="352099001761481")
+        SaleRecord.objects.create(payment_mode=1, customer=self.ravina).items.add(self.line)
+
+    def search(self, query):
+        return CustomerSearchDocument.objects.search(query)
+
+    def test_search_by_name_number_address_and_imei(self):
+        self.assertEqual(self.search("ravi patel"), [self.ravi.pk])
+        self.assertEqual(sorted(self.search("ravi")), sorted([self.ravi.pk, self.ravina.pk]))
+        self.assertEqual(self.search("99887"), [self.ravi.pk])
+        self.assertEqual(self.search("gandhinagar mg"), [self.ravi.pk])
+        self.assertEqual(self.search("3520990017"), [self.ravina.pk])
+        self.assertEqual(self.search("ravi OR NOT *"), [])
+
+    def test_documents_follow_changes(self):
+        self.ravi.address.address_one = "7 Station Road"
+        self.ravi.address.save()
+        self.assertEqual(self.search("station"), [self.ravi.pk])
+        self.line.imei = "490154203237518"
+        self.line.save()
+        self.assertEqual(self.search("490154203237518"), [self.ravina.pk])
+        self.assertEqual(self.search("352099001761481"), [])
+        self.ravi.delete()
+        self.assertEqual(self.search("patel"), [])
+
+    def test_api_and_admin_search(self):
+        response = self.client.get(reverse('customer_search-list'), {"q": "9812"})
+        self.assertEqual([customer['name'] for customer in response.json()], ["Ravina Shah"])
+        response = self.client.get(reverse('admin:sale_record_customerdetail_changelist'), {"q": "gandhinagar"})
+        self.assertEqual(list(response.context['cl'].result_list), [self.ravi])
+
+
+class SaleApiTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand", tax=12,
+                                                    available_stock=100)
+
+    def make_sales(self, count):
+        for i in range(count):
+            address = Address.objects.create(address_one="Road", city=City.objects.create(name="City"))
+            sale = SaleRecord.objects.create(payment_mode=1, customer=CustomerDetail.objects.create(
+                name="Customer", address=address))
+            sale.items.add(*[SaleEffectiveCost.objects.create(cost=self.product, quantity=2) for _ in range(3)])
+
+    def queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_sale_page_in_constant_queries(self):
+        self.make_sales(2)
+        response, few = self.queries(reverse('salerecord-list'))
+        self.make_sales(20)
+        response, many = self.queries(reverse('salerecord-list'))
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, 5)  # session, user, sales, items
+        sale = response.json()['results'][0]
+        self.assertEqual(len(sale['items']), 3)
+        self.assertEqual(sale['customer_detail']['name'], "Customer")
+        self.assertEqual(sale['total'], str(sum(Decimal(item['line_total']) for item in sale['items'])))
+
+    def test_create_sale_with_items(self):
+        customer = CustomerDetail.objects.create(name="Customer")
+        response = self.client.post(reverse('salerecord-list'), json.dumps({
+            "payment_mode": 1,
+            "customer": reverse('customerdetail-detail', kwargs={"pk": customer.pk}),
+            "items": [{"cost": reverse('productrecord-detail', kwargs={"pk": self.product.pk}), "quantity": 3,
+                       "discount": 0, "imei": "35 2099"}],
+        }), content_type="application/json")
+        self.assertEqual(response.status_code, 201, response.content)
+        sale = SaleRecord.objects.get(pk=response.json()['id'])
+        self.assertEqual(sale.customer, customer)
+        self.assertEqual(list(sale.items.values_list('quantity', 'imei')), [(3, "352099")])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_stock, 97)
+
+
+class BulkSaleTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.products = [ProductRecord.objects.create(name="Handset {}".format(i), price=1000, launched_by="Brand",
+                                                      available_stock=1000) for i in range(3)]
+        self.customer = CustomerDetail.objects.create(name="Customer")
+
+    def bill(self, lines, **kwargs):
+        kwargs.setdefault("payment_mode", 1)
+        kwargs.setdefault("customer", self.customer.pk)
+        kwargs["items"] = [{"cost": self.products[i % 3].pk, "quantity": 2, "discount": 0,
+                            "imei": "35-{:06d}".format(i)} for i in range(lines)]
+        return kwargs
+
+    def post(self, data):
+        return self.client.post(reverse('salerecord-bulk'), json.dumps(data), content_type="application/json")
+
+    def test_bills_created_in_bulk_statements(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post([self.bill(300), self.bill(200, invoice_id="X-1")])
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertLess(len(queries), 60)  # constant, whatever the number of lines
+        created = response.json()
+        self.assertEqual(created[1]['invoice_id'], "X-1")
+        sale = SaleRecord.objects.get(pk=created[0]['id'])
+        self.assertEqual(sale.items.count(), 300)
+        self.assertEqual(sale.items.filter(imei="35000299").count(), 1)
+        self.assertEqual(StockMovement.objects.filter(bill_type=StockMovement.SALE_BILL, bill_id=sale.pk).count(), 300)
+        for product in self.products:
+            product.refresh_from_db()
+        self.assertEqual(sum(product.available_stock for product in self.products), 3000 - 2 * 500)
+        self.assertEqual(CustomerSearchDocument.objects.search("35000299"), [self.customer.pk])
+
+    def test_single_bill_and_validation(self):
+        response = self.post(self.bill(2))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(SaleRecord.objects.get(pk=response.json()['id']).items.count(), 2)
+        bad = self.bill(1)
+        bad["items"][0]["cost"] = 0
+        response = self.post([self.bill(1), bad])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(SaleRecord.objects.count(), 1)
+
+
+class SalesRollupTest(TestCase):
+    def setUp(self):
+        self.products = [ProductRecord.objects.create(name="Handset {}".format(i), price=1000 * (i + 1), tax=12,
+                                                      launched_by=brand, available_stock=100)
+                         for i, brand in enumerate(["Nokia", "Nokia", "Sony"])]
+        self.sales = []
+        for day, mode in ((1, 1), (1, 3), (20, 1)):
+            sale = SaleRecord.objects.create(payment_mode=mode, sale_date=datetime.date(2018, 4, day))
+            sale.items.add(*[SaleEffectiveCost.objects.create(cost=product, quantity=i + 1, discount=10)
+                             for i, product in enumerate(self.products)])
+            self.sales.append(sale)
+
+    def walk(self):
+        """ Brand totals by walking every sale line """
+        totals = {}
+        for sale in SaleRecord.objects.filter(cancelled=False):
+            for line in sale.items.all():
+                brand = totals.setdefault(line.cost.launched_by, [set(), 0, Decimal(0)])
+                brand[0].add(sale.pk)
+                brand[1] += line.quantity
+                brand[2] += line.get_total_effective_cost
+        return dict((key, (len(sales), units, total)) for key, (sales, units, total) in totals.items())
+
+    def report(self):
+        return dict((row['key'], (row['sales'], row['units'], row['gross'] - row['discount']))
+                    for row in SalesRollup.objects.report(SalesRollup.BRAND, "year").filter(sales__gt=0))
+
+    def test_rollups_follow_sales(self):
+        self.assertEqual(self.report(), self.walk())
+        self.assertEqual(self.report()["Nokia"][:2], (3, 9))
+
+        self.sales[0].cancelled = True
+        self.sales[0].save()
+        self.assertEqual(self.report(), self.walk())
+        self.sales[0].cancelled = False
+        self.sales[0].save()
+
+        line = self.sales[1].items.get(cost=self.products[2])
+        line.quantity = 7
+        line.save()
+        self.sales[1].items.remove(self.sales[1].items.get(cost=self.products[0]))
+        self.sales[2].delete()
+        self.assertEqual(self.report(), self.walk())
+
+        SaleRecord.objects.create_bills([(SaleRecord(payment_mode=1, sale_date=datetime.date(2018, 5, 1)),
+                                          [SaleEffectiveCost(cost=self.products[2], quantity=2)])])
+        self.assertEqual(self.report(), self.walk())
+
+    def test_rebuild_and_api(self):
+        expected = set(SalesRollup.objects.values_list('day', 'dimension', 'key', 'sales', 'units', 'gross', 'tax'))
+        SalesRollup.objects.rebuild()
+        self.assertEqual(set(SalesRollup.objects.values_list(
+            'day', 'dimension', 'key', 'sales', 'units', 'gross', 'tax')), expected)
+
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        rows = self.client.get(reverse('sales_report-list'), {"dimension": "payment_mode", "period": "day",
+                                                              "from": "2018-04-01", "to": "2018-04-01"}).json()
+        self.assertEqual([(row['period'], row['key'], row['sales']) for row in rows],
+                         [("2018-04-01", "1", 1), ("2018-04-01", "3", 1)])
+        self.assertEqual(Decimal(rows[0]['total']), sum(line.get_total_effective_cost
+                                                        for line in self.sales[0].items.all()))
+        for params in ({"from": "2018-02-30"}, {"to": "2018-04"}):
+            self.assertEqual(self.client.get(reverse('sales_report-list'), params).status_code, 400)
+
+
+@override_settings(CACHES=SHARED_CACHES)
+class ReceivablesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        self.product = ProductRecord.objects.create(name="Handset", price=1000, launched_by="Brand",
+                                                    available_stock=100)
+        self.today = datetime.date(2018, 6, 30)
+        self.customers = [CustomerDetail.objects.create(name=name) for name in ("Anil", "Bina")]
+        self.sales = [self.sale(customer, days, quantity, **kwargs) for customer, days, quantity, kwargs in (
+            (0, 10, 2, {"payment_mode": SaleRecord.CREDIT, "payment_date": None}),
+            (0, 45, 1, {"payment_mode": None}),
+            (1, 100, 1, {"payment_mode": 3, "payment_status": True}),
+            (1, 5, 1, {"payment_mode": 1}),  # paid
+            (0, 70, 1, {"payment_mode": SaleRecord.CREDIT, "payment_date": datetime.date(2018, 6, 1)}),  # settled
+            (1, 20, 1, {"payment_mode": SaleRecord.CREDIT, "payment_date": None, "cancelled": True}),
+        )]
+
+    def sale(self, customer, days, quantity, **kwargs):
+        sale = SaleRecord.objects.create(customer=self.customers[customer],
+                                         sale_date=self.today - datetime.timedelta(days=days), **kwargs)
+        sale.items.add(SaleEffectiveCost.objects.create(cost=self.product, quantity=quantity, discount=10))
+        return sale
+
+    def get(self, **params):
+        return self.client.get(reverse('receivables-list'), dict({"as_of": self.today.isoformat()}, **params))
+
+    def balances(self):
+        return dict((row['name'], (row['bills'], Decimal(row['days_0_30']), Decimal(row['days_31_60']),
+                                   Decimal(row['days_61_90']), Decimal(row['days_over_90']), Decimal(row['total'])))
+                    for row in self.get(format="json").json())
+
+    def test_ageing_buckets_and_invalidation(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.balances(), {"Anil": (2, 1800, 900, 0, 0, 2700), "Bina": (1, 0, 0, 0, 900, 900)})
+        with CaptureQueriesContext(connection) as cached:
+            self.balances()
+        self.assertEqual(len(queries) - len(cached), 1)  # the grouped query, then served from the cache
+
+        self.sales[0].payment_mode = 1
+        self.sales[0].save()
+        self.assertEqual(self.balances(), {"Anil": (1, 0, 900, 0, 0, 900), "Bina": (1, 0, 0, 0, 900, 900)})
+        self.sales[1].items.add(SaleEffectiveCost.objects.create(cost=self.product, quantity=1, discount=0))
+        self.assertEqual(self.balances()["Anil"], (1, 0, 1900, 0, 0, 1900))
+
+    def test_csv_export(self):
+        response = self.get(format="csv")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Disposition"], 'attachment; filename="receivables-2018-06-30.csv"')
+        lines = response.content.decode().splitlines()
+        self.assertEqual(lines[0], "customer,name,bills,days_0_30,days_31_60,days_61_90,days_over_90,total")
+        self.assertEqual(lines[1], "{},Anil,2,1800.00,900.00,0.00,0.00,2700.00".format(self.customers[0].pk))
+        self.assertEqual(self.get(as_of="2018-02-30").status_code, 400)
+
+
+class GstExportTest(TestCase):
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("admin", "admin@example.com", "password"))
+        phone = ProductRecord.objects.create(name="Handset", price=1120, tax=12, tax_type=1, hsn_code="8517",
+                                             available_stock=100)
+        charger = ProductRecord.objects.create(name="Charger", price=590, tax=18, tax_type=2, hsn_code="8504",
+                                               available_stock=100)
+        for day, cancelled in ((5, False), (20, False), (21, True)):
+            sale = SaleRecord.objects.create(sale_date=datetime.date(2018, 5, day), payment_mode=1,
+                                             cancelled=cancelled)
+            sale.items.add(SaleEffectiveCost.objects.create(cost=phone, quantity=2, discount=0),
+                           SaleEffectiveCost.objects.create(cost=charger, quantity=1, discount=0))
+        SaleRecord.objects.create(sale_date=datetime.date(2018, 6, 1), payment_mode=1).items.add(
+            SaleEffectiveCost.objects.create(cost=phone, quantity=1, discount=0))
+
+    def get(self, **params):
+        response = self.client.get(reverse('gst_return-list'), dict({"from": "2018-05-01", "to": "2018-05-31"},
+                                                                     **params))
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_lines_add_up_to_summaries(self):
+        cover = ProductRecord.objects.create(name="Cover", price=Decimal("10.19"), tax=5, tax_type=1, hsn_code="3926")
+        SaleRecord.objects.create(sale_date=datetime.date(2018, 7, 2), payment_mode=1).items.add(
+            SaleEffectiveCost.objects.create(cost=cover, quantity=3, discount=0))
+        july = datetime.date(2018, 7, 1), datetime.date(2018, 7, 31)
+        taxes = ["taxable_value", "igst", "cgst", "sgst"]
+        line, = gst.line_details(*july)
+        summary, = gst.hsn_summary(*july)
+        self.assertEqual([line[name] for name in ["value"] + taxes],
+                         [Decimal(amount) for amount in ("30.57", "29.10", "0", "0.75", "0.72")])
+        self.assertEqual([summary[name] for name in ["value"] + taxes], [line[name] for name in ["value"] + taxes])
+        SaleEffectiveCost.objects.filter(cost=cover).update(mrp=None, tax_rate=None, tax_type=None)
+        self.assertEqual(list(gst.line_details(*july)), [line])
+        self.assertEqual(list(gst.hsn_summary(*july)), [summary])
+
+    def test_hsn_and_rate_summaries(self):
+        rows = json.loads(self.get(section="hsn"))
+        self.assertEqual(rows, [
+            {"hsn_code": "8504", "rate": 18, "supply": "inter-state", "quantity": 2, "value": "1180.00",
+             "taxable_value": "1000.00", "igst": "180.00", "cgst": "0.00", "sgst": "0.00"},
+            {"hsn_code": "8517", "rate": 12, "supply": "intra-state", "quantity": 4, "value": "4480.00",
+             "taxable_value": "4000.00", "igst": "0.00", "cgst": "240.00", "sgst": "240.00"}])
+        lines = self.get(section="rate", format="csv").splitlines()
+        self.assertEqual(lines, ["rate,supply,invoices,value,taxable_value,igst,cgst,sgst",
+                                 "12,intra-state,2,4480.00,4000.00,0.00,240.00,240.00",
+                                 "18,inter-state,2,1180.00,1000.00,180.00,0.00,0.00"])
+
+    def test_lines_in_batches(self):
+        rows = list(gst.line_details(datetime.date(2018, 5, 1), datetime.date(2018, 6, 30), batch_size=2))
+        self.assertEqual([(row['sale_date'], row['hsn_code'], row['taxable_value']) for row in rows], [
+            (datetime.date(2018, 5, 5), "8517", Decimal("2000.00")), (datetime.date(2018, 5, 5), "8504",
+                                                                      Decimal("500.00")),
+            (datetime.date(2018, 5, 20), "8517", Decimal("2000.00")), (datetime.date(2018, 5, 20), "8504",
+                                                                       Decimal("500.00")),
+            (datetime.date(2018, 6, 1), "8517", Decimal("1000.00"))])
+        self.assertEqual(json.loads(self.get(section="lines", to="2018-04-30")), [])
+
+    def test_command(self):
+        out = StringIO()
+        call_command("export_gst", "--from", "2018-05-01", "--to", "2018-05-31", "--section", "rate", stdout=out)
+        self.assertEqual(out.getvalue().splitlines()[1], "12,intra-state,2,4480.00,4000.00,0.00,240.00,240.00")
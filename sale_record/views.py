@@ -1,14 +1,30 @@
 import os
 
-from django.http import HttpResponse, HttpResponseBadRequest, FileResponse
+from django.db.models import Prefetch
+from django.http import HttpResponse, HttpResponseBadRequest, FileResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.utils import timezone
+from django.utils.dateparse import parse_date
 
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.views.generic.base import View
 from reportlab.pdfgen import canvas
+from rest_framework import viewsets
+from rest_framework.decorators import list_route
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
 
-from core_settings.settings import INV_ROOT
-from main.utils import draw_pdf
+from core_settings.settings import IMEI_LOOKUP_LIMIT, INV_ROOT, INV_STORE_ON_DISK
+from inventory_management.models import ProductRecord
+from main.invoice_cache import invoice_cache
+from main.utils import draw_pdf, invoice_data, invoice_file_name, invoice_fingerprint, pdf_response
+from main.renderers import CSVRenderer
+from main.views import AgeingReportMixin, BulkCreateMixin
+from sale_record import gst
 from sale_record.models import *
+from sale_record.serializers import *
 
 __author__ = "Gahan Saraiya"
 
@@ -18,13 +34,177 @@ class InvoiceGenerateView(View):
         print("Generating invoice..")
         pk = self.kwargs.get("pk")
         try:
-            sale_invoice = SaleRecord.objects.get(pk=pk)
-            print("Found invoice id: {}".format(sale_invoice.invoice_id))
-            file_name = "{}_{}.pdf".format(sale_invoice.invoice_id, sale_invoice.printable_sale_date)
-            file_location = os.path.join(INV_ROOT, file_name)
-            draw_pdf(file_location, sale_invoice)
-            return FileResponse(open(file_location, "rb"), content_type="application/pdf")
+            sale_invoice = SaleRecord.objects.select_related(
+                'customer__address__city', 'customer__address__country').get(pk=pk)
         except SaleRecord.DoesNotExist as e:
             err_msg = str(e)
             response = "No invoice exist for given query"
             return HttpResponse(response)
+        print("Found invoice id: {}".format(sale_invoice.invoice_id))
+        data = invoice_data(sale_invoice)
+        if INV_STORE_ON_DISK:
+            file_location, fingerprint = invoice_cache.get_or_render(sale_invoice.pk, data)
+            last_modified = int(os.path.getmtime(file_location))
+        else:
+            fingerprint, last_modified = invoice_fingerprint(data), None
+        etag = quote_etag(fingerprint)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            if INV_STORE_ON_DISK:
+                response = FileResponse(open(file_location, "rb"), content_type="application/pdf")
+                response["Content-Disposition"] = "inline; filename=\"{}\"".format(invoice_file_name(data))
+            else:
+                response = pdf_response(draw_pdf, invoice_file_name(data), data, disposition="inline")
+        response["ETag"] = etag
+        if last_modified:
+            response["Last-Modified"] = http_date(last_modified)
+        return response
+
+
+class CustomerDetailViewSet(viewsets.ModelViewSet):
+    serializer_class = CustomerDetailSerializer
+    queryset = CustomerDetail.objects.select_related(
+        'address__city', 'address__state', 'address__country')
+
+
+class SaleEffectiveCostViewSet(viewsets.ModelViewSet):
+    serializer_class = SaleEffectiveCostSerializer
+    queryset = SaleEffectiveCost.objects.select_related('cost')
+
+
+class SaleRecordViewSet(BulkCreateMixin, viewsets.ModelViewSet):
+    """
+    Sales with their items and customer nested, a page loads in a fixed
+    number of queries whatever its size
+    """
+    serializer_class = SaleRecordSerializer
+    bulk_serializer_class = BulkSaleRecordSerializer
+    queryset = SaleRecord.objects.select_related(
+        'customer__address__city', 'customer__address__state', 'customer__address__country').prefetch_related(
+        Prefetch('items', queryset=SaleEffectiveCost.objects.select_related('cost')))
+
+
+class ImeiLookupViewSet(viewsets.ViewSet):
+    """
+    retrieve:
+    Sale, customer, product and purchase lineage of one IMEI or barcode.
+
+    lookup:
+    Lineage of each IMEI posted as `{"imei": [...]}`, unknown ones are listed in `missing`.
+    """
+    lookup_field = "imei"
+    lookup_value_regex = "[^/]+"
+
+    def retrieve(self, request, imei=None):
+        lineage = imei_lineage([imei]).get(normalize_imei(imei))
+        if lineage is None:
+            raise NotFound("No sale found for IMEI {}".format(imei))
+        return Response(lineage)
+
+    @list_route(methods=["post"])
+    def lookup(self, request):
+        data = request.data
+        imeis = data.getlist("imei") if hasattr(data, "getlist") else data.get("imei")
+        if not isinstance(imeis, list) or not all(isinstance(imei, str) for imei in imeis):
+            raise ValidationError({"imei": "Expected a list of IMEI numbers"})
+        if len(imeis) > IMEI_LOOKUP_LIMIT:
+            raise ValidationError({"imei": "At most {} IMEI numbers per request".format(IMEI_LOOKUP_LIMIT)})
+        imeis = [normalize_imei(imei) for imei in imeis]
+        lineage = imei_lineage(imeis)
+        return Response({
+            "results": [lineage[imei] for imei in dict.fromkeys(imeis) if imei in lineage],
+            "missing": [imei for imei in dict.fromkeys(imeis) if imei and imei not in lineage],
+        })
+
+
+class CustomerSearchViewSet(viewsets.ViewSet):
+    """
+    list:
+    Customers matching every word of `q` in their name, phone numbers, email, address or IMEIs, best match first.
+    """
+    def list(self, request):
+        ids = CustomerSearchDocument.objects.search(request.query_params.get("q", ""))
+        customers = CustomerDetail.objects.select_related(
+            'address__city', 'address__state', 'address__country').in_bulk(ids)
+        return Response(CustomerDetailSerializer([customers[pk] for pk in ids if pk in customers], many=True,
+                                                 context={"request": request}).data)
+
+
+class SalesReportViewSet(viewsets.ViewSet):
+    """
+    list:
+    Sales count, units, gross, discount, tax and total per `period` (day, month or year; default month) and
+    `dimension` (brand, product or payment_mode; default brand), from the daily sales rollups.
+    Optional filters: `from` and `to` dates, `key` (a brand, product id or payment mode).
+    """
+    dimensions = {"brand": SalesRollup.BRAND, "product": SalesRollup.PRODUCT,
+                  "payment_mode": SalesRollup.PAYMENT_MODE}
+
+    def list(self, request):
+        params = request.query_params
+        dimension = self.dimensions.get(params.get("dimension", "brand"))
+        period = params.get("period", "month")
+        if dimension is None or period not in ("day", "month", "year"):
+            raise ValidationError({"dimension": "Expected dimension brand, product or payment_mode and "
+                                                "period day, month or year"})
+        rollups = SalesRollup.objects.all()
+        for param, lookup in (("from", "day__gte"), ("to", "day__lte")):
+            if params.get(param):
+                try:
+                    day = parse_date(params[param])
+                except ValueError:
+                    day = None
+                if day is None:
+                    raise ValidationError({param: "Expected a date as YYYY-MM-DD"})
+                rollups = rollups.filter(**{lookup: day})
+        if "key" in params:
+            rollups = rollups.filter(key=params["key"])
+        return Response([dict(row, total=row["gross"] - row["discount"])
+                         for row in rollups.report(dimension, period).filter(sales__gt=0)])
+
+
+class ReceivablesViewSet(AgeingReportMixin, viewsets.ViewSet):
+    """
+    list:
+    Amount due per customer for sales not paid, in transit or on credit until their payment date, in buckets
+    of days since the sale date at `as_of` (default today). Export with `format=csv`.
+    """
+    report_name = "receivables"
+    party = "customer"
+    cache_models = (SaleRecord, SaleEffectiveCost, ProductRecord, CustomerDetail)
+
+    def balances(self, as_of):
+        return SaleRecord.objects.receivables(as_of)
+
+
+class GstReturnViewSet(viewsets.ViewSet):
+    """
+    list:
+    GST summary of the sales from `from` to `to` (default the previous month) per HSN code and rate
+    (`section=hsn`, default), per rate (`section=rate`) or of every line (`section=lines`), streamed as JSON
+    or, with `format=csv`, as CSV.
+    """
+    renderer_classes = [JSONRenderer, CSVRenderer]
+
+    def list(self, request):
+        params = request.query_params
+        section = params.get("section", "hsn")
+        if section not in gst.SECTIONS:
+            raise ValidationError({"section": "Expected one of {}".format(", ".join(gst.SECTIONS))})
+        period = list(gst.previous_month(timezone.localdate()))
+        for index, param in enumerate(("from", "to")):
+            if params.get(param):
+                try:
+                    period[index] = parse_date(params[param])
+                except ValueError:
+                    period[index] = None
+                if period[index] is None:
+                    raise ValidationError({param: "Expected a date as YYYY-MM-DD"})
+        rows = gst.SECTIONS[section](*period)
+        if request.accepted_renderer.format == CSVRenderer.format:
+            response = StreamingHttpResponse(gst.stream_csv(rows), content_type="text/csv; charset=utf-8")
+        else:
+            response = StreamingHttpResponse(gst.stream_json(rows), content_type="application/json")
+        response["Content-Disposition"] = 'attachment; filename="gst-{}-{}-{}.{}"'.format(
+            section, period[0], period[1], request.accepted_renderer.format)
+        return response